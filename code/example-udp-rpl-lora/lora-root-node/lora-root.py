@@ -5,7 +5,9 @@ import sys
 from loguru import logger
 from pyloramac import *
 from ipaddress import IPv6Address, AddressValueError
-from scapy.all import *
+from scapy.layers.inet6 import IPv6
+from scapy.layers.inet import UDP
+from scapy.packet import Raw
 from time import *
 ###### LOG Configuration ######
 LOG_FORMAT = "<green>("+str(perf_counter_ns())+"){time: HH:mm:ss.SSS}</green> | "+\
@@ -0,0 +1,98 @@
+"""Import time benchmark for pyloramac.
+
+Runs `python -X importtime` in a fresh interpreter for each measured
+statement and compares the cumulative import time, minus the time of the
+interpreter startup imports, against a budget.
+
+Usage:
+    python benchmarks/bench_import.py [--runs N] [--scale FACTOR]
+
+The exit code is 1 if a budget is exceeded or if scapy is imported by a
+statement that must not import it.
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src")
+
+"""
+(name, statement, budget in ms, scapy allowed)
+The budgets are for a CI-class Linux box, use --scale on slower machines.
+"""
+CASES = [
+    ("import pyloramac", "import pyloramac", 120, False),
+    ("from pyloramac *", "from pyloramac import *", 120, False),
+    ("import all layers", "import pyloramac.lora_ip", 150, False),
+    ("build the stack", "import pyloramac; pyloramac.NetworkStack()", 120, False),
+]
+
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def measure(statement: str):
+    """Run the statement with -X importtime in a fresh interpreter.
+
+    Args:
+        statement (str): The python statement to run.
+
+    Returns:
+        tuple: The total cumulative import time (in ms) of the top level
+               modules and the set of imported modules.
+    """
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [SRC_DIR, env.get("PYTHONPATH")]))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        env=env, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL,
+        universal_newlines=True, check=True,
+    )
+
+    total_us = 0
+    modules = set()
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match is None:
+            continue
+        _, cumulative, indent, module = match.groups()
+        modules.add(module)
+        if len(indent) == 1:  # top level import
+            total_us += int(cumulative)
+    return total_us / 1000, modules
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="number of runs per case")
+    parser.add_argument("--scale", type=float, default=1.0, help="budget multiplier")
+    args = parser.parse_args()
+
+    startup = statistics.median(measure("pass")[0] for _ in range(args.runs))
+
+    failed = False
+    for name, statement, budget, scapy_allowed in CASES:
+        times = []
+        modules = set()
+        for _ in range(args.runs):
+            elapsed, modules = measure(statement)
+            times.append(elapsed - startup)
+        median = statistics.median(times)
+        limit = budget * args.scale
+        status = "OK"
+        if median > limit:
+            status = "OVER BUDGET"
+            failed = True
+        if not scapy_allowed and any(m.split(".")[0] == "scapy" for m in modules):
+            status = "IMPORTS SCAPY"
+            failed = True
+        print(f"{name:<20} median {median:8.1f} ms  budget {limit:6.0f} ms  {status}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,390 @@
+"""Micro benchmarks of the LoRaMAC stack.
+
+Measures the time per operation of the codec, the address translation,
+the MAC dispatch and the full uplink/downlink path through a fake PHY
+(the UART responses are fed to the real parser and command engine), and
+compares it against a baseline.
+
+Usage:
+    python benchmarks/bench_stack.py [--repeat N] [--threshold PCT] [--confirm N] [--save [--runs N]] [CASE ...]
+
+The baseline is benchmarks/baseline.json, written with --save. The exit
+code is 1 if a case is slower than its baseline by more than the threshold.
+The cases are compared by their cost relative to a fixed pure python
+workload measured just before each measure, so that a slower (or
+throttled) machine does not report regressions. The change shown is the
+change of this relative cost.
+
+The relative cost still drifts from run to run. --save keeps the median
+of --runs measures of each case and their spread (noise, in percent),
+which is added to the threshold of the case. A case over its threshold
+is measured again (up to --confirm times) and is a regression only if
+its best measure is still over.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+from pyloramac import lora_iphc  # noqa: E402
+from pyloramac.lora_frag import LoraFrag  # noqa: E402
+from pyloramac.lora_ip import LoraIP  # noqa: E402
+from pyloramac.lora_mac import LoraMac  # noqa: E402
+from pyloramac.lora_phy import LoraPhy, LoraAddr, LoraFrame, MacCommand, UartCommand, UartResponse  # noqa: E402
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+MIN_RUN_TIME = 0.1  # minimum duration (in seconds) of a measure
+NODE_ID = 0x0A05
+ROOT = LoraAddr(1, 0)
+
+"""
+A 10 bytes UDP payload in an IPv6 packet, as sent by a sensor
+(IPv6 and UDP headers, addresses elided).
+"""
+UDP_PAYLOAD = bytes(range(10))
+ELIDED_PACKET = (
+    bytes.fromhex("6000000000121140")  # IPv6 base header: payload length 18, UDP, hop limit 64
+    + bytes.fromhex("162e22b60012a1b2")  # UDP header: 5678 -> 8886, length 18
+    + UDP_PAYLOAD
+)
+
+
+class FakePhy(LoraPhy):
+    """LoraPhy with an instant radio.
+
+    Each UART command is written and answered at once: the responses go
+    through the UART parser, the command engine and the LoRa frame decoding.
+    The frames sent by the peers are given to feed() as radio_rx lines.
+    """
+
+    RESPONSES = {
+        UartCommand.TX: b"radio_tx_ok\r\n",
+        UartCommand.MAC_PAUSE: b"4294967245\r\n",
+    }
+
+    def __init__(self):
+        super().__init__(listen_on_error=True, duty_cycle=False, txBufSize=100)
+        self.sent = 0  # number of written commands
+        self.frames = None  # iterator of the frames returned by getFrame()
+
+    def init(self):
+        self._configure(after_reset=True)
+
+    def getFrame(self) -> LoraFrame:
+        frame = next(self.frames)
+        # the reception ends with the frame, as with radio_rx
+        self._engine.on_response(UartResponse.RADIO_RX)
+        self._is_listen = False
+        return frame
+
+    def feed(self, data: bytes):
+        for response, payload in self._parser.feed(data):
+            if self._on_uart_response(response, payload):
+                self._pump()
+
+    def _send_phy(self, data) -> bool:
+        result = self._engine.submit(data)
+        self._pump()
+        return result
+
+    def _pump(self):
+        while True:
+            data = self._engine.pop()
+            if data is None:
+                return
+            self._engine.started(data)
+            self.sent += 1
+            if data.cmd == UartCommand.RX:
+                return  # answered by feed()
+            self.feed(self.RESPONSES.get(data.cmd, b"ok\r\n"))
+
+
+def rx_line(frame: LoraFrame) -> bytes:
+    return b"radio_rx  " + frame.toHex().encode() + b"\r\n"
+
+
+def joined_stack():
+    """Build a root (fake PHY, MAC, IP) with one joined child.
+
+    Returns:
+        tuple: The PHY, MAC and IP layers and the address of the child.
+    """
+    phy = FakePhy()
+    mac = LoraMac(phy, threaded=False)
+    ip = LoraIP(LoraFrag(mac))
+    ip.register_raw_listener(lambda src, packet: None)
+    ip.init()
+    phy.feed(rx_line(LoraFrame(LoraAddr(NODE_ID & 0xFF, NODE_ID), ROOT, MacCommand.JOIN, b"")))
+    child = mac.childs[min(mac.childs)].addr
+    return phy, mac, ip, child
+
+
+def child_frames(child: LoraAddr, command: MacCommand, payload: bytes = b"", k: bool = False) -> list:
+    """The frames of a child for every sequence number, from 1 (the first after the join)."""
+    return [LoraFrame(child, ROOT, command, payload, (1 + i) % 256, k) for i in range(256)]
+
+
+# the cases: each function prepares the case and returns run(n), which runs n operations
+
+def case_frame_tohex():
+    frame = LoraFrame(ROOT, LoraAddr(2, NODE_ID), MacCommand.DATA, ELIDED_PACKET, 7, True)
+
+    def run(n):
+        for _ in range(n):
+            frame.toHex()
+    return run
+
+
+def case_frame_build():
+    data = LoraFrame(LoraAddr(2, NODE_ID), ROOT, MacCommand.DATA, ELIDED_PACKET, 7, True).toHex()
+
+    def run(n):
+        for _ in range(n):
+            LoraFrame.build(data)
+    return run
+
+
+def case_lora_to_ipv6():
+    addrs = [LoraAddr(prefix, NODE_ID + prefix) for prefix in range(2, 34)]
+
+    def run(n):
+        for i in range(n):
+            LoraIP.lora_to_ipv6(addrs[i & 31])
+    return run
+
+
+def case_ipv6_to_lora():
+    addrs = [LoraIP.lora_to_ipv6(LoraAddr(prefix, NODE_ID + prefix)) for prefix in range(2, 34)]
+
+    def run(n):
+        for i in range(n):
+            LoraIP.ipv6_to_lora(addrs[i & 31])
+    return run
+
+
+def case_ip_serialize():
+    from scapy.layers.inet import UDP
+    from scapy.layers.inet6 import IPv6
+    from scapy.packet import Raw
+    packet = (IPv6(src=str(LoraIP.lora_to_ipv6(ROOT)), dst=str(LoraIP.lora_to_ipv6(LoraAddr(2, NODE_ID))))
+              / UDP(sport=8765, dport=5678) / Raw(UDP_PAYLOAD))
+
+    def run(n):
+        for _ in range(n):
+            LoraIP.serialize_ip_packet(packet)
+    return run
+
+
+def case_ip_build():
+    import scapy.layers.inet  # noqa: F401 (UDP dissection)
+    src = LoraAddr(2, NODE_ID)
+
+    def run(n):
+        for _ in range(n):
+            LoraIP.build_ip_packet(ELIDED_PACKET, src, ROOT)
+    return run
+
+
+def case_iphc_compress():
+    def run(n):
+        for _ in range(n):
+            lora_iphc.compress(ELIDED_PACKET)
+    return run
+
+
+def case_iphc_decompress():
+    data = lora_iphc.compress(ELIDED_PACKET)
+    src = LoraIP.lora_to_packed(LoraAddr(2, NODE_ID))
+    dest = LoraIP.lora_to_packed(ROOT)
+
+    def run(n):
+        for _ in range(n):
+            lora_iphc.decompress(data, src, dest)
+    return run
+
+
+def case_mac_dispatch():
+    """LoraMac._rx_process with QUERY frames (answered by an ACK)."""
+    phy, mac, _, child = joined_stack()
+    frames = child_frames(child, MacCommand.QUERY)
+
+    def run(n):
+        phy.frames = (frames[i & 255] for i in range(n))
+        try:
+            mac._rx_process()
+        except StopIteration:
+            pass
+        # the next run starts again at the first sequence number
+        mac.childs[child.prefix].expected_sn = 1
+    return run
+
+
+def case_uplink():
+    """A confirmed DATA frame received by the radio, delivered to the IP listener and acknowledged."""
+    phy, mac, _, child = joined_stack()
+    lines = [rx_line(frame) for frame in child_frames(child, MacCommand.DATA, ELIDED_PACKET, True)]
+
+    def run(n):
+        for i in range(n):
+            phy.feed(lines[i & 255])
+        mac.childs[child.prefix].expected_sn = 1
+    return run
+
+
+def case_downlink():
+    """An IPv6 packet sent to a child, then sent to the radio when the child polls."""
+    phy, mac, ip, child = joined_stack()
+    packet = LoraIP.restore_addresses(ELIDED_PACKET, ROOT, child)
+    lines = [rx_line(frame) for frame in child_frames(child, MacCommand.QUERY)]
+
+    def run(n):
+        for i in range(n):
+            ip.send_bytes(child, packet)
+            phy.feed(lines[i & 255])
+        mac.childs[child.prefix].expected_sn = 1
+    return run
+
+
+CASES = {
+    "frame_tohex": case_frame_tohex,
+    "frame_build": case_frame_build,
+    "lora_to_ipv6": case_lora_to_ipv6,
+    "ipv6_to_lora": case_ipv6_to_lora,
+    "ip_serialize": case_ip_serialize,
+    "ip_build": case_ip_build,
+    "iphc_compress": case_iphc_compress,
+    "iphc_decompress": case_iphc_decompress,
+    "mac_dispatch": case_mac_dispatch,
+    "uplink": case_uplink,
+    "downlink": case_downlink,
+}
+
+
+def calibration():
+    """A fixed pure python workload used to measure the speed of the machine."""
+    table = {i: i * 3 for i in range(64)}
+
+    def run(n):
+        for i in range(n):
+            total = 0
+            for j in range(32):
+                total += table[(i + j) & 63]
+            bytes(8).hex()
+    return run
+
+
+def operations(run) -> int:
+    """Return the number of operations that last at least MIN_RUN_TIME."""
+    n = 1
+    while True:
+        elapsed = timed(run, n) * n
+        if elapsed >= MIN_RUN_TIME:
+            return n
+        n = n * 2 if elapsed < MIN_RUN_TIME / 10 else int(n * MIN_RUN_TIME / elapsed) + 1
+
+
+def timed(run, n: int) -> float:
+    """Return the time (in seconds) per operation of n operations."""
+    start = time.perf_counter()
+    run(n)
+    return (time.perf_counter() - start) / n
+
+
+def measure(run, reference, repeat: int) -> tuple:
+    """Measure a case, interleaved with the calibration workload.
+
+    Returns:
+        tuple: The best time per operation (in microseconds) and the median
+               cost relative to the calibration workload measured just before.
+    """
+    n = operations(run)
+    m = operations(reference)
+    best = float("inf")
+    ratios = []
+    for _ in range(repeat):
+        ref = timed(reference, m)
+        t = timed(run, n)
+        best = min(best, t)
+        ratios.append(t / ref)
+    return best * 1e6, statistics.median(ratios)
+
+
+def spread(values: list) -> float:
+    """Return the spread (in percent of the median) of measures."""
+    median = statistics.median(values)
+    return (max(values) - min(values)) / median * 100
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("cases", nargs="*", help=f"cases to run (default: all): {', '.join(CASES)}")
+    parser.add_argument("--repeat", type=int, default=7, help="number of measures per case")
+    parser.add_argument("--threshold", type=float, default=25.0,
+                        help="slowdown (in percent) over the baseline reported as a regression, plus the noise of the case")
+    parser.add_argument("--confirm", type=int, default=2,
+                        help="number of measures again of a case over its threshold")
+    parser.add_argument("--runs", type=int, default=5, help="number of measures per case saved with --save")
+    parser.add_argument("--save", action="store_true", help="save the results as the new baseline")
+    parser.add_argument("--baseline", default=BASELINE, help="path of the baseline file")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.cases if name not in CASES]
+    if unknown:
+        parser.error(f"unknown cases: {', '.join(unknown)}")
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = {}
+
+    reference = calibration()
+    results = {}
+    failed = False
+    for name in args.cases or CASES:
+        try:
+            run = CASES[name]()
+        except ImportError as e:
+            print(f"{name:<16} skipped ({e})")
+            continue
+        measures = [measure(run, reference, args.repeat) for _ in range(args.runs if args.save else 1)]
+        us = min(m[0] for m in measures)
+        relative = statistics.median(m[1] for m in measures)
+        results[name] = {"us": round(us, 3), "relative": round(relative, 4),
+                         "noise": round(spread([m[1] for m in measures]), 1)}
+        saved = baseline.get(name, None)
+        if saved is None:
+            print(f"{name:<16} {us:10.2f} us/op")
+            continue
+        limit = args.threshold + saved.get("noise", 0.0)
+        change = (relative - saved["relative"]) / saved["relative"] * 100
+        for _ in range(args.confirm):
+            if change <= limit:
+                break
+            # a single slow measure is not a regression
+            us_again, relative_again = measure(run, reference, args.repeat)
+            us, relative = min(us, us_again), min(relative, relative_again)
+            change = (relative - saved["relative"]) / saved["relative"] * 100
+        status = "OK"
+        if change > limit:
+            status = "REGRESSION"
+            failed = True
+        print(f"{name:<16} {us:10.2f} us/op  baseline {saved['us']:10.2f} us/op  {change:+7.1f}%"
+              f"  (limit {limit:+.0f}%)  {status}")
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"baseline saved to {args.baseline}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,32 +1,77 @@
-from pyloramac.lora_ip import LoraIP
-from pyloramac.lora_mac import LoraMac
-from pyloramac.lora_phy import LoraPhy
 from loguru import logger
 
+# The layers are imported when the stack is initialised (or when they are
+# accessed as attributes of the package) so that `import pyloramac` stays cheap.
+# They are not in __all__: `from pyloramac import *` would import them all.
+_LAZY_IMPORTS = {
+    "AsyncNetworkStack": "pyloramac.lora_async",
+    "LoraFrag": "pyloramac.lora_frag",
+    "LoraIP": "pyloramac.lora_ip",
+    "LoraMac": "pyloramac.lora_mac",
+    "LoraPhy": "pyloramac.lora_phy",
+}
+
+__all__ = ["NetworkStack", "NETWORK_STACK"]
+
+
+def __getattr__(name):
+    module = _LAZY_IMPORTS.get(name, None)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import importlib
+    return getattr(importlib.import_module(module), name)
+
 
 class NetworkStack:
     def __init__(self):
         self.phy = None
         self.mac = None
+        self.frag = None
         self.ip = None
         self.node_lr_addr = None
         self.node_ip_addr = None
         self.send = None
+        self.send_bytes = None
+        self.submit = None
+        self.submit_bytes = None
         self.register_listener = None
-    
+        self.register_raw_listener = None
+        self.register_handler = None
+        self.unregister_handler = None
+        self.register_default_handler = None
+        self.handler_stats = None
+        self.delivery_stats = None
+
     def init(self, txBufSize=10, rxBufSize=10, port="/dev/ttyUSB0",
              baudrate="57600", frequence="868100000", bandwidth="125", cr="4/5",
-             pwr="1", sf="sf10"):
-        
-        params = locals()
+             pwr="1", sf="sf10", turnaround=None, config_cache=None, mac_state=None, delivery_workers=None):
+        params = dict(locals())
         params.pop('self')
+        params.pop('mac_state')
+        params.pop('delivery_workers')
+
+        from pyloramac.lora_frag import LoraFrag
+        from pyloramac.lora_ip import LoraIP
+        from pyloramac.lora_mac import LoraMac
+        from pyloramac.lora_phy import LoraPhy
+
         self.phy = LoraPhy(listen_on_error=True, **params)
-        self.mac = LoraMac(self.phy)
-        self.ip = LoraIP(self.mac)
+        self.mac = LoraMac(self.phy, state_path=mac_state, delivery_workers=delivery_workers)
+        self.frag = LoraFrag(self.mac)
+        self.ip = LoraIP(self.frag)
         self.node_lr_addr = self.mac.addr
         self.node_ip_addr = self.ip.lora_to_ipv6(self.node_lr_addr)
         self.send = self.ip.send
+        self.send_bytes = self.ip.send_bytes
+        self.submit = self.ip.submit
+        self.submit_bytes = self.ip.submit_bytes
         self.register_listener = self.ip.register_listener
+        self.register_raw_listener = self.ip.register_raw_listener
+        self.register_handler = self.ip.register_handler
+        self.unregister_handler = self.ip.unregister_handler
+        self.register_default_handler = self.ip.register_default_handler
+        self.handler_stats = self.ip.handler_stats
+        self.delivery_stats = self.mac.delivery_stats
         self.ip.init()
 
 
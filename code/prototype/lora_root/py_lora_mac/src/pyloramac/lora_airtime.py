@@ -0,0 +1,132 @@
+import math
+import time
+import threading
+from typing import Callable
+
+MAX_FRAME_SIZE = 255  # maximum size of a frame sent by the RN2483 (bytes)
+PREAMBLE_LENGTH = 8  # preamble length used by the RN2483 (symbols)
+LOW_DR_OPTIMIZE_SYMBOL_TIME = 0.016  # low data rate optimization above 16 ms per symbol
+
+"""
+Time (in seconds) between the end of a frame sent by a child and the moment
+the child listens again. After a transmission the child sets the radio
+watchdog and then sends `radio rx 0`. The value is the delay measured on the
+testbed, that the root used to sleep before each transmission.
+"""
+DEFAULT_TURNAROUND = 0.30648
+
+
+def parse_sf(sf) -> int:
+    """Parse a spreading factor ("sf7" ... "sf12" or an integer)."""
+    if isinstance(sf, str):
+        sf = sf.lower().replace("sf", "")
+    return int(sf)
+
+
+def parse_bandwidth(bandwidth) -> int:
+    """Parse a bandwidth given in KHz ("125", "250", "500") to Hz."""
+    return int(bandwidth) * 1000
+
+
+def parse_cr(cr) -> int:
+    """Parse a coding rate ("4/5" ... "4/8") to the CR of the Semtech formula (1 ... 4)."""
+    if isinstance(cr, str):
+        return int(cr.split("/")[1]) - 4
+    return int(cr)
+
+
+def time_on_air(payload_size: int, sf=10, bandwidth=125, cr="4/5",
+                preamble_length=PREAMBLE_LENGTH, explicit_header=True, crc=True) -> float:
+    """Compute the LoRa time on air of a frame.
+
+    Follows the formula of the Semtech SX1272/3/6/7/8 LoRa Modem Designer's Guide (AN1200.13).
+
+    Args:
+        payload_size (int): The size of the PHY payload in bytes.
+        sf: The spreading factor (7 to 12 or "sf7" to "sf12").
+        bandwidth: The bandwidth in KHz.
+        cr: The coding rate ("4/5" to "4/8").
+        preamble_length (int): The number of programmed preamble symbols.
+        explicit_header (bool): True if the PHY header is sent.
+        crc (bool): True if the payload CRC is sent.
+
+    Returns:
+        float: The time on air in seconds.
+    """
+
+    sf = parse_sf(sf)
+    symbol_time = (1 << sf) / parse_bandwidth(bandwidth)
+    de = 1 if symbol_time > LOW_DR_OPTIMIZE_SYMBOL_TIME else 0
+    ih = 0 if explicit_header else 1
+
+    preamble_time = (preamble_length + 4.25) * symbol_time
+    payload_symbols = 8 + max(
+        math.ceil((8 * payload_size - 4 * sf + 28 + 16 * crc - 20 * ih) / (4 * (sf - 2 * de)))
+        * (parse_cr(cr) + 4),
+        0,
+    )
+    return preamble_time + payload_symbols * symbol_time
+
+
+class TxScheduler:
+    """Schedules the transmissions of the PHY layer.
+
+    The scheduler computes the time on air of the frames with the radio
+    configuration and only enforces the turnaround gap the peer needs
+    between the end of its frame and the beginning of the response.
+
+    Attributes:
+        sf: The spreading factor.
+        bandwidth: The bandwidth in KHz.
+        cr: The coding rate.
+        turnaround: The minimum time (in seconds) between a reception and a transmission.
+    """
+
+    def __init__(self, sf="sf10", bandwidth="125", cr="4/5", turnaround=DEFAULT_TURNAROUND,
+                 clock: Callable[[], float] = time.monotonic):
+        self.sf = parse_sf(sf)
+        self.bandwidth = int(bandwidth)
+        self.cr = parse_cr(cr)
+        self.turnaround = float(turnaround)
+        # time on air for each possible frame size
+        self._airtimes = [
+            time_on_air(size, self.sf, self.bandwidth, self.cr) for size in range(MAX_FRAME_SIZE + 1)
+        ]
+        self._clock = clock
+        self._last_rx = None  # end of the last reception
+        self._lock = threading.Lock()
+
+    def airtime(self, frame_size: int) -> float:
+        """Return the time on air of a frame.
+
+        Args:
+            frame_size (int): The size of the frame in bytes.
+
+        Returns:
+            float: The time on air in seconds.
+        """
+        if frame_size <= MAX_FRAME_SIZE:
+            return self._airtimes[frame_size]
+        return time_on_air(frame_size, self.sf, self.bandwidth, self.cr)
+
+    def notify_rx(self):
+        """Notify the scheduler that a frame has been received."""
+        with self._lock:
+            self._last_rx = self._clock()
+
+    def delay(self) -> float:
+        """Return the time to wait before the next transmission.
+
+        Returns:
+            float: The delay in seconds.
+        """
+        with self._lock:
+            if self._last_rx is None:
+                return 0.0
+            return max(0.0, self._last_rx + self.turnaround - self._clock())
+
+    def wait(self):
+        """Wait until the turnaround gap since the last reception has elapsed."""
+        delay = self.delay()
+        if delay > 0:
+            time.sleep(delay)
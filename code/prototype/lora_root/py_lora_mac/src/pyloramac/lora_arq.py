@@ -0,0 +1,177 @@
+"""Sliding window ARQ of LoRaMAC, used with the childs that negotiate CAP_WINDOW.
+
+Instead of one frame per round trip (stop and wait), the sender sends up
+to `size` frames in a burst: each frame but the last one has the burst
+flag, so that the receiver listens again at once. The receiver gives the
+frames it has received in the ACK field of its next frame (c.f. LoraFrame):
+
+    - cumulative: the next sequence number (SN) expected, all the frames
+      before it are received.
+    - bitmap: bit i is set if the frame cumulative + 1 + i is received.
+
+The sender retransmits the frames that are not acknowledged in its next
+burst, each at most MAX_RETRANSMIT times. A frame given up is never sent
+again: when the receiver sees a SN beyond its window, it slides its
+window to this SN, the frames skipped are lost.
+"""
+import collections
+from dataclasses import dataclass
+from typing import List, Tuple
+
+from pyloramac.lora_phy import LoraFrame
+
+WINDOW_SIZE = 4  # default number of frames in flight
+MAX_WINDOW_SIZE = 8  # the frames after cumulative that the bitmap can acknowledge
+SN_MODULO = 256
+HALF_SN_SPACE = SN_MODULO // 2
+
+
+def sn_distance(start: int, sn: int) -> int:
+    """Return the number of SNs from start to sn (negative if sn is before start)."""
+    distance = (sn - start) % SN_MODULO
+    return distance - SN_MODULO if distance >= HALF_SN_SPACE else distance
+
+
+@dataclass
+class Outstanding:
+    """A frame sent and not acknowledged.
+
+    Attributes:
+        frame: The frame.
+        transmissions: The number of times the frame has been sent.
+    """
+
+    frame: LoraFrame
+    transmissions: int = 0
+
+
+class SendWindow:
+    """The frames in flight to a receiver.
+
+    Attributes:
+        size: The maximum number of frames in flight.
+        retransmissions: The number of retransmitted frames.
+        given_up: The number of frames given up after MAX_RETRANSMIT retransmissions.
+    """
+
+    def __init__(self, size: int = WINDOW_SIZE, max_retransmit: int = 3):  # c.f. lora_mac.MAX_RETRANSMIT
+        if not 1 <= size <= MAX_WINDOW_SIZE:
+            raise ValueError(f"invalid window size {size}: must be from 1 to {MAX_WINDOW_SIZE}")
+        self.size = size
+        self.max_retransmit = max_retransmit
+        self.retransmissions = 0
+        self.given_up = 0
+        self._in_flight = collections.OrderedDict()  # SN -> Outstanding, in the order of the SNs
+
+    def __len__(self) -> int:
+        return len(self._in_flight)
+
+    def has_room(self) -> bool:
+        """Return True if a new frame can be sent."""
+        return len(self._in_flight) < self.size
+
+    def add(self, frame: LoraFrame):
+        """Add a new frame (with its SN) to the window."""
+        self._in_flight[frame.seq] = Outstanding(frame)
+
+    def on_ack(self, ack: Tuple[int, int]) -> List[LoraFrame]:
+        """Remove the frames acknowledged by an ACK field.
+
+        Args:
+            ack (tuple): The cumulative SN and the bitmap.
+
+        Returns:
+            list: The frames acknowledged.
+        """
+        cumulative, bitmap = ack
+        acked = []
+        for sn in self._in_flight:
+            distance = sn_distance(cumulative, sn)
+            if distance < 0 or (distance > 0 and bitmap >> (distance - 1) & 1):
+                acked.append(sn)
+        return [self._in_flight.pop(sn).frame for sn in acked]
+
+    def to_retransmit(self, given_up: List[LoraFrame] = None) -> List[LoraFrame]:
+        """Return the frames not acknowledged, to send again.
+
+        The frames already sent max_retransmit + 1 times are given up.
+
+        Args:
+            given_up (list): If not None, the frames given up are appended to it.
+
+        Returns:
+            list: The frames, in the order of their SNs.
+        """
+        frames = []
+        for sn, outstanding in list(self._in_flight.items()):
+            if outstanding.transmissions > self.max_retransmit:
+                del self._in_flight[sn]
+                self.given_up += 1
+                if given_up is not None:
+                    given_up.append(outstanding.frame)
+            elif outstanding.transmissions > 0:
+                frames.append(outstanding.frame)
+        return frames
+
+    def clear(self) -> List[LoraFrame]:
+        """Remove all the frames in flight.
+
+        Returns:
+            list: The frames, in the order of their SNs.
+        """
+        frames = [outstanding.frame for outstanding in self._in_flight.values()]
+        self._in_flight.clear()
+        return frames
+
+    def sent(self, frame: LoraFrame):
+        """Count a transmission of a frame of the window."""
+        outstanding = self._in_flight.get(frame.seq, None)
+        if outstanding is not None:
+            if outstanding.transmissions:
+                self.retransmissions += 1
+            outstanding.transmissions += 1
+
+
+class ReceiveWindow:
+    """The frames received from a sender.
+
+    Attributes:
+        size: The window size of the sender.
+        next_sn: The next SN expected (the cumulative SN of the ACK field).
+    """
+
+    def __init__(self, size: int = WINDOW_SIZE, next_sn: int = 1):
+        self.size = size
+        self.next_sn = next_sn
+        self._received = set()  # SNs received after next_sn
+
+    def accept(self, sn: int) -> bool:
+        """Record a received SN.
+
+        Returns:
+            bool: True if the frame is new, False if it is a duplicate.
+        """
+        distance = sn_distance(self.next_sn, sn)
+        if distance < 0 or sn in self._received:
+            return False
+        if distance >= self.size:
+            # the sender has given up the frames before its window
+            self.next_sn = (sn - self.size + 1) % SN_MODULO
+            self._received = {s for s in self._received if sn_distance(self.next_sn, s) >= 0}
+        self._received.add(sn)
+        while self.next_sn in self._received:
+            self._received.remove(self.next_sn)
+            self.next_sn = (self.next_sn + 1) % SN_MODULO
+        return True
+
+    def ack(self) -> Tuple[int, int]:
+        """Return the ACK field (cumulative SN, bitmap)."""
+        bitmap = 0
+        for sn in self._received:
+            bitmap |= 1 << (sn_distance(self.next_sn, sn) - 1)
+        return self.next_sn, bitmap
+
+    @property
+    def complete(self) -> bool:
+        """True if no frame is missing before the last one received."""
+        return not self._received
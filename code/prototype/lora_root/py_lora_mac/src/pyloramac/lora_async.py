@@ -0,0 +1,258 @@
+"""asyncio engine for the LoRaMAC stack.
+
+The serial connection is watched by the event loop (loop.add_reader) and the
+UART commands are written from the loop, so the whole stack runs in a single
+thread and can share its loop with other asyncio services.
+
+Example:
+    stack = AsyncNetworkStack()
+    await stack.init(port="/dev/ttyUSB0")
+    async for packet in stack.packets():
+        await stack.send(reply_to(packet))
+"""
+from __future__ import annotations
+import asyncio
+import queue
+from typing import TYPE_CHECKING, AsyncIterator
+
+import serial
+from loguru import logger as log
+
+from pyloramac.lora_frag import LoraFrag
+from pyloramac.lora_ip import LoraIP
+from pyloramac.lora_mac import LoraMac
+from pyloramac.lora_phy import LoraPhy, LoraAddr, UartFrame, UartCommand
+from pyloramac.lora_sched import Priority
+
+if TYPE_CHECKING:
+    from scapy.layers.inet6 import IPv6
+
+PACKET_BUF_SIZE = 100  # size of the buffer of received packets
+
+
+class AsyncLoraPhy(LoraPhy):
+    """The LoRaMAC PHY layer driven by an asyncio event loop.
+
+    Same UART protocol as LoraPhy but without the RX and TX threads:
+    the serial file descriptor is read when the loop reports it readable
+    and the next command is written as soon as the previous one is answered.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None, **params):
+        super().__init__(**params)
+        self._loop = loop
+        self._tx_waiters = []  # futures resolved at the next radio tx
+        self._timer = None  # handle of the timer used for the deadlines
+
+    def init(self):
+        """Init the PHY layer.
+
+        - Set the serial connection and register it to the event loop
+        - Prepare the RN2483 for communications (mac pause, radio set)
+
+        Must be called from the event loop.
+        """
+        log.info("Init PHY")
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        try:
+            self._con = serial.Serial(
+                port=self._params.get('port', "/dev/ttyUSB0"),
+                baudrate=self._params.get('baudrate', 57600),
+                timeout=0,
+            )
+        except serial.serialutil.SerialException as e:
+            log.error(str(e))
+            raise
+        self._loop.add_reader(self._con.fileno(), self._on_readable)
+        self._configure()
+
+    def close(self):
+        """Unregister the serial connection from the event loop and close it."""
+        if self._con is None:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._loop.remove_reader(self._con.fileno())
+        self._con.close()
+        self._con = None
+
+    async def wait_tx(self):
+        """Wait until the next LoRa frame is written to the radio."""
+        future = self._loop.create_future()
+        self._tx_waiters.append(future)
+        await future
+
+    def _send_phy(self, data: UartFrame) -> bool:
+        result = super()._send_phy(data)
+        self._pump()
+        return result
+
+    def _pump(self):
+        """Write the next UART paquet if the radio is ready and check the
+        deadline of the command in flight."""
+        if self._con is None:
+            return
+        wait = self._engine.expire()
+        data = self._engine.pop()
+        if data is None:
+            self._set_timer(wait)
+            return
+        delay = self.scheduler.delay() if data.cmd == UartCommand.TX else 0
+        if delay > 0:
+            self._loop.call_later(delay, self._write_frame, data)
+        else:
+            self._write_frame(data)
+
+    def _set_timer(self, delay: float):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = None if delay is None else self._loop.call_later(delay, self._pump)
+
+    def _write_frame(self, data: UartFrame):
+        self._engine.started(data)
+        self._write(data)
+        self._set_timer(data.timeout)
+        if data.cmd == UartCommand.TX:
+            waiters, self._tx_waiters = self._tx_waiters, []
+            for future in waiters:
+                if not future.done():
+                    future.set_result(None)
+
+    def _on_readable(self):
+        """Read the available data when the serial connection is readable."""
+        try:
+            data = self._con.read(self._con.in_waiting or 1)
+        except serial.serialutil.SerialException as e:
+            log.error(str(e))
+            return
+
+        for response, payload in self._parser.feed(data):
+            if self._on_uart_response(response, payload):
+                # It is the expected response, the next command can be sent
+                self._pump()
+
+
+class AsyncNetworkStack:
+    """The LoRaMAC stack running in an asyncio event loop.
+
+    Attributes:
+        phy: The PHY layer.
+        mac: The MAC layer.
+        frag: The fragmentation layer.
+        ip: The IP layer.
+        node_lr_addr: The LoRaMAC address of the root.
+        node_ip_addr: The IPv6 address of the root.
+    """
+
+    def __init__(self):
+        self.phy = None
+        self.mac = None
+        self.frag = None
+        self.ip = None
+        self.node_lr_addr = None
+        self.node_ip_addr = None
+        self._packets = None
+
+    async def init(self, txBufSize=10, rxBufSize=10, port="/dev/ttyUSB0",
+                   baudrate="57600", frequence="868100000", bandwidth="125", cr="4/5",
+                   pwr="1", sf="sf10", turnaround=None, config_cache=None,
+                   packetBufSize=PACKET_BUF_SIZE, mac_state=None):
+        params = dict(locals())
+        params.pop('self')
+        params.pop('packetBufSize')
+        params.pop('mac_state')
+
+        loop = asyncio.get_running_loop()
+        self.phy = AsyncLoraPhy(loop, listen_on_error=True, **params)
+        self.mac = LoraMac(self.phy, threaded=False, state_path=mac_state)
+        self.mac.timers.on_start = lambda: loop.call_soon(self._poll_timers)
+        self.frag = LoraFrag(self.mac)
+        self.ip = LoraIP(self.frag)
+        self.node_lr_addr = self.mac.addr
+        self.node_ip_addr = self.ip.lora_to_ipv6(self.node_lr_addr)
+        self._packets = asyncio.Queue(packetBufSize)
+        self.ip.register_raw_listener(self._on_packet)
+        self.ip.init()
+
+    def close(self):
+        """Stop watching the serial connection and close it."""
+        self.phy.close()
+
+    async def send(self, ip_packet: IPv6) -> bool:
+        """Send a scapy IPv6 packet.
+
+        Wait (without blocking the loop) while the TX buffer of the
+        destination is full.
+
+        Args:
+            ip_packet (IPv6): The packet to send.
+
+        Returns:
+            bool: False if the destination is unreachable, True otherwise.
+        """
+        while True:
+            try:
+                return self.ip.send(ip_packet, block=False)
+            except queue.Full:
+                await self.phy.wait_tx()
+
+    async def send_bytes(self, dest: LoraAddr, ipv6_packet: bytes) -> bool:
+        """Send an IPv6 packet given as bytes.
+
+        Args:
+            dest (LoraAddr): The LoRaMAC destination address.
+            ipv6_packet (bytes): The packet to send.
+
+        Returns:
+            bool: False if the destination is unreachable, True otherwise.
+        """
+        while True:
+            try:
+                return self.ip.send_bytes(dest, ipv6_packet, block=False)
+            except queue.Full:
+                await self.phy.wait_tx()
+
+    def submit_bytes(self, dest: LoraAddr, ipv6_packet: bytes, lifetime: float = None,
+                     priority: Priority = Priority.NORMAL) -> asyncio.Future:
+        """Send an IPv6 packet given as bytes, without waiting for room in the TX buffer.
+
+        Args:
+            dest (LoraAddr): The LoRaMAC destination address.
+            ipv6_packet (bytes): The packet to send.
+            lifetime (float): If not None, the packet is dropped if it is
+                              not sent within lifetime seconds.
+            priority (Priority): The priority class of the packet (c.f. lora_sched).
+
+        Returns:
+            asyncio.Future: Resolved with the SendStatus of the packet
+                            (c.f. LoraMac.mac_submit).
+        """
+        return asyncio.wrap_future(self.ip.submit_bytes(dest, ipv6_packet, lifetime, priority))
+
+    async def packets(self, raw: bool = False) -> AsyncIterator:
+        """Iterate over the received IPv6 packets.
+
+        Args:
+            raw (bool): If True, yield (LoraAddr, bytes) tuples instead of
+                        scapy IPv6 packets.
+        """
+        while True:
+            src, packet = await self._packets.get()
+            if raw:
+                yield src, packet
+            else:
+                from scapy.layers.inet6 import IPv6
+                yield IPv6(packet)
+
+    def _poll_timers(self):
+        """Run the retransmission timers of the MAC layer until none is pending."""
+        delay = self.mac.poll_timers()
+        if delay is not None:
+            asyncio.get_running_loop().call_later(delay, self._poll_timers)
+
+    def _on_packet(self, src: LoraAddr, packet: bytes):
+        try:
+            self._packets.put_nowait((src, packet))
+        except asyncio.QueueFull:
+            log.warning("Packet buffer full -> packet dropped")
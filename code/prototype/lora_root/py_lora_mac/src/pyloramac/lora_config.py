@@ -0,0 +1,200 @@
+import json
+import os
+import threading
+import dataclasses
+from dataclasses import dataclass
+from typing import Optional
+from loguru import logger as log
+
+# the parameters, with the name used by `radio get` and `radio set`
+RADIO_PARAMS = {
+    'mode': "mod",
+    'frequence': "freq",
+    'bandwidth': "bw",
+    'cr': "cr",
+    'pwr': "pwr",
+    'sf': "sf",
+    'wdt': "wdt",
+}
+
+FREQUENCY_RANGES = ((433050000, 434790000), (863000000, 870000000))  # Hz, included
+BANDWIDTHS = ("125", "250", "500")  # KHz
+CODING_RATES = ("4/5", "4/6", "4/7", "4/8")
+SPREADING_FACTORS = ("sf7", "sf8", "sf9", "sf10", "sf11", "sf12")
+MIN_PWR = -3
+MAX_PWR = 15
+MAX_WDT = 4294967295  # ms
+
+DEFAULT_CACHE_PATH = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "pyloramac",
+    "radio.json",
+)
+
+
+@dataclass(frozen=True)
+class RadioConfig:
+    """The configuration of the RN2483 radio.
+
+    The values are kept as the strings written to the UART. A parameter
+    set to None is not managed.
+
+    Attributes:
+        mode: The modulation method (lora or fsk).
+        frequence: The frequency in Hz.
+        bandwidth: The bandwidth in KHz.
+        cr: The coding rate.
+        pwr: The transceiver output power.
+        sf: The spreading factor.
+        wdt: The time-out of the radio watchdog timer in milliseconds.
+    """
+
+    mode: str = "lora"
+    frequence: str = "868100000"
+    bandwidth: str = "125"
+    cr: str = "4/5"
+    pwr: str = "1"
+    sf: str = "sf10"
+    wdt: Optional[str] = None
+
+    @staticmethod
+    def from_params(params: dict):
+        """Build a configuration from the parameters given to the PHY layer.
+
+        Raises:
+            ValueError: If a parameter value is not valid.
+        """
+        values = {}
+        for name in RADIO_PARAMS:
+            value = params.get(name, None)
+            if value is not None:
+                values[name] = str(value).strip().lower()
+        config = RadioConfig(**values)
+        config.validate()
+        return config
+
+    def validate(self):
+        """Check the values before they are sent to the RN2483.
+
+        Raises:
+            ValueError: If a value is not valid.
+        """
+        if self.mode not in ("lora", "fsk"):
+            raise ValueError(f"invalid mode {self.mode!r}: must be lora or fsk")
+        frequency = _parse_int("frequence", self.frequence)
+        if not any(low <= frequency <= high for low, high in FREQUENCY_RANGES):
+            raise ValueError(f"invalid frequence {self.frequence!r}: must be in {FREQUENCY_RANGES}")
+        if self.bandwidth not in BANDWIDTHS:
+            raise ValueError(f"invalid bandwidth {self.bandwidth!r}: must be one of {BANDWIDTHS}")
+        if self.cr not in CODING_RATES:
+            raise ValueError(f"invalid cr {self.cr!r}: must be one of {CODING_RATES}")
+        if not MIN_PWR <= _parse_int("pwr", self.pwr) <= MAX_PWR:
+            raise ValueError(f"invalid pwr {self.pwr!r}: must be from {MIN_PWR} to {MAX_PWR}")
+        if self.sf not in SPREADING_FACTORS:
+            raise ValueError(f"invalid sf {self.sf!r}: must be one of {SPREADING_FACTORS}")
+        if self.wdt is not None and not 0 <= _parse_int("wdt", self.wdt) <= MAX_WDT:
+            raise ValueError(f"invalid wdt {self.wdt!r}: must be from 0 to {MAX_WDT}")
+
+    def diff(self, other: Optional["RadioConfig"]) -> dict:
+        """Return the parameters to set to go from the other configuration to this one.
+
+        Args:
+            other (RadioConfig): The current configuration, None if unknown.
+
+        Returns:
+            dict: name -> value, in the order of RADIO_PARAMS.
+        """
+        changes = {}
+        for name in RADIO_PARAMS:
+            value = getattr(self, name)
+            if value is not None and (other is None or getattr(other, name) != value):
+                changes[name] = value
+        return changes
+
+    def to_dict(self) -> dict:
+        return dataclasses.asdict(self)
+
+
+"""
+The configuration of the RN2483 after a reset
+(RN2483 LoRa Technology Module Command Reference User's Guide).
+"""
+RN2483_DEFAULT_CONFIG = RadioConfig(
+    mode="lora", frequence="868100000", bandwidth="125", cr="4/5", pwr="1", sf="sf12", wdt="15000"
+)
+
+
+def _parse_int(name: str, value: str) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid {name} {value!r}: must be an integer") from None
+
+
+class RadioConfigCache:
+    """The last configuration applied to the RN2483, per serial port.
+
+    The configurations are persisted in a JSON file so that a restarted
+    root does not send again the `radio set` commands already applied.
+    The file is read once, when the cache is created, and written when a
+    configuration changes. A missing or corrupted file is an empty cache.
+
+    Attributes:
+        path: The path of the JSON file.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._configs = self._read()  # port -> values of the configuration
+
+    def load(self, port: str) -> Optional[RadioConfig]:
+        """Return the configuration applied to the radio on a port, or None."""
+        with self._lock:
+            values = self._configs.get(port, None)
+        if values is None:
+            return None
+        try:
+            return RadioConfig(**values)
+        except TypeError:
+            log.warning(f"Invalid radio configuration cached for {port}")
+            return None
+
+    def store(self, port: str, config: RadioConfig):
+        """Save the configuration applied to the radio on a port."""
+        self._update(port, config.to_dict())
+
+    def invalidate(self, port: str):
+        """Forget the configuration of the radio on a port."""
+        self._update(port, None)
+
+    def _update(self, port: str, values: Optional[dict]):
+        with self._lock:
+            if self._configs.get(port, None) == values:
+                return
+            # the file is read again to keep the ports written by other roots since
+            configs = self._read()
+            if values is None:
+                configs.pop(port, None)
+            else:
+                configs[port] = values
+            self._configs = configs
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                tmp_path = self.path + ".tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(configs, f, indent=2)
+                os.replace(tmp_path, self.path)  # atomic: never a half written file
+            except OSError as e:
+                log.warning(f"Radio configuration cache not saved: {e}")
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path) as f:
+                configs = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            log.warning(f"Radio configuration cache ignored: {e}")
+            return {}
+        return configs if isinstance(configs, dict) else {}
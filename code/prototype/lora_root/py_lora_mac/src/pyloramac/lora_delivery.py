@@ -0,0 +1,204 @@
+"""Delivery of the received payloads to the upper layer, out of the RX thread.
+
+The radio listens again only when a frame has been processed: if the
+upper layer (reassembly, IPv6, application) is called in the RX thread,
+a slow handler keeps the radio deaf and the uplinks are lost. The
+payloads are put in a bounded queue and given to an executor (a pool of
+worker threads by default).
+
+The payloads of a source are delivered in their order of arrival: a
+source has at most one payload in the executor, the next one is given
+when it is done. When the queue is full, the new payloads are dropped
+(the frames are already acknowledged to the childs).
+
+With more than one worker, the payloads of different sources are
+delivered in parallel: the listener (and the handlers of the upper
+layers) then runs concurrently in several threads and must be thread
+safe. A listener that blocks (e.g. one that answers with a blocking
+NetworkStack.send) holds a worker for that time. The default is one
+worker, which calls the listener from a single thread as the RX thread
+did.
+
+The executor must run the listener in threads of this process: the
+listener is a bound method of the stack (with its locks), it can not be
+sent to a process pool.
+"""
+import collections
+import functools
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Hashable
+
+from loguru import logger as log
+
+DELIVERY_WORKERS = 1  # threads of the default executor, the listeners run concurrently if more than 1
+DELIVERY_QUEUE_SIZE = 64  # payloads queued or being delivered
+
+
+def _timed_call(listener: Callable, src, payload: bytes) -> float:
+    """Call the listener (in a worker) and return its duration in seconds."""
+    start = time.perf_counter()
+    listener(src, payload)
+    return time.perf_counter() - start
+
+
+class LatencyStat:
+    """Count, mean and maximum of durations.
+
+    Attributes:
+        count: The number of samples.
+        total: The sum of the samples (s).
+        max: The largest sample (s).
+    """
+
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration: float):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def to_dict(self) -> dict:
+        return {"count": self.count, "mean": self.total / self.count if self.count else None, "max": self.max}
+
+
+class DeliveryQueue:
+    """Bounded queue of the payloads to deliver to the upper layer.
+
+    With workers=0 and no executor, the payloads are delivered at once in
+    the calling thread (e.g. a stack driven by a simulation or an event loop).
+    An executor given by the owner must be a ThreadPoolExecutor.
+
+    Attributes:
+        listener: The Callable[[LoraAddr, bytes], None] that receives the payloads.
+        maxsize: The maximum number of payloads queued or being delivered.
+        stats: Counters of the delivered, dropped and failed payloads.
+        wait: The time spent by the payloads in the queue.
+        handler: The time spent in the listener.
+    """
+
+    def __init__(self, workers: int = DELIVERY_WORKERS, maxsize: int = DELIVERY_QUEUE_SIZE,
+                 executor: ThreadPoolExecutor = None, clock: Callable[[], float] = time.monotonic):
+        self.listener = None
+        self.maxsize = maxsize
+        self.clock = clock
+        if executor is not None and not isinstance(executor, ThreadPoolExecutor):
+            raise TypeError(f"invalid executor {executor!r}: must be a ThreadPoolExecutor")
+        self._own_executor = executor is None and workers > 0
+        if self._own_executor:
+            executor = ThreadPoolExecutor(workers, thread_name_prefix="lora-delivery")
+        self._executor = executor
+        self.stats = {"delivered": 0, "dropped": 0, "errors": 0, "max_depth": 0}
+        self.wait = LatencyStat()
+        self.handler = LatencyStat()
+        self._lock = threading.Lock()
+        self._empty = threading.Condition(self._lock)
+        self._depth = 0
+        self._pending = {}  # src -> deque of (payload, queued at), the sources being delivered
+
+    @property
+    def depth(self) -> int:
+        """The number of payloads queued or being delivered."""
+        return self._depth
+
+    def metrics(self) -> dict:
+        """Return the depth of the queue, the counters and the latencies (wait and handler)."""
+        with self._lock:
+            return {"depth": self._depth, **self.stats, "wait": self.wait.to_dict(), "handler": self.handler.to_dict()}
+
+    def put(self, src: Hashable, payload: bytes) -> bool:
+        """Queue a payload for the listener.
+
+        Args:
+            src (LoraAddr): The source of the payload.
+            payload (bytes): The payload.
+
+        Returns:
+            bool: False if the payload is dropped (queue full or no listener).
+        """
+        if self.listener is None:
+            log.warning("Upper layer not defined. Please call `register_listener` before.")
+            return False
+        if self._executor is None:
+            self._call(src, payload)
+            return True
+
+        with self._lock:
+            if self._depth >= self.maxsize:
+                self.stats["dropped"] += 1
+                log.warning(f"Delivery queue full -> payload of {src} dropped")
+                return False
+            self._depth += 1
+            self.stats["max_depth"] = max(self.stats["max_depth"], self._depth)
+            queued = self._pending.get(src, None)
+            if queued is not None:
+                # a payload of this source is being delivered: wait for it
+                queued.append((payload, self.clock()))
+                return True
+            self._pending[src] = collections.deque()
+            self.wait.add(0.0)
+        self._submit(src, payload)
+        return True
+
+    def join(self, timeout: float = None) -> bool:
+        """Wait until all the queued payloads are delivered.
+
+        Returns:
+            bool: False if the timeout expired before.
+        """
+        with self._empty:
+            return self._empty.wait_for(lambda: not self._depth, timeout)
+
+    def close(self, wait: bool = True):
+        """Stop the executor, if created by the queue."""
+        if self._own_executor:
+            self._executor.shutdown(wait)
+
+    def _call(self, src: Hashable, payload: bytes):
+        """Deliver a payload in the calling thread."""
+        try:
+            duration = _timed_call(self.listener, src, payload)
+        except Exception:
+            self.stats["errors"] += 1
+            log.exception(f"Error in the upper layer for a payload of {src}")
+            return
+        self.stats["delivered"] += 1
+        self.handler.add(duration)
+
+    def _submit(self, src: Hashable, payload: bytes):
+        try:
+            future = self._executor.submit(_timed_call, self.listener, src, payload)
+        except RuntimeError as e:  # executor shut down
+            future = Future()
+            future.set_exception(e)
+        future.add_done_callback(functools.partial(self._on_done, src))
+
+    def _on_done(self, src: Hashable, future: Future):
+        """Account for a delivered payload and give the next one of its source."""
+        error = future.exception()
+        with self._lock:
+            self._depth -= 1
+            if error is None:
+                self.stats["delivered"] += 1
+                self.handler.add(future.result())
+            else:
+                self.stats["errors"] += 1
+            queued = self._pending[src]
+            if queued:
+                payload, queued_at = queued.popleft()
+                self.wait.add(self.clock() - queued_at)
+            else:
+                del self._pending[src]
+                payload = None
+            if not self._depth:
+                self._empty.notify_all()
+        if error is not None:
+            log.opt(exception=error).error(f"Error in the upper layer for a payload of {src}")
+        if payload is not None:
+            self._submit(src, payload)
@@ -0,0 +1,188 @@
+import collections
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+DUTY_CYCLE_WINDOW = 3600  # sliding window (in seconds) over which the duty cycle is computed
+
+
+@dataclass(frozen=True)
+class SubBand:
+    """A sub-band with a duty-cycle limit.
+
+    Attributes:
+        name: The name of the sub-band.
+        min_freq: The lowest frequency of the sub-band (Hz, included).
+        max_freq: The highest frequency of the sub-band (Hz, included).
+        duty_cycle: The maximum fraction of time the transmitter can be on.
+    """
+
+    name: str
+    min_freq: int
+    max_freq: int
+    duty_cycle: float
+
+    def contains(self, frequency: int) -> bool:
+        return self.min_freq <= frequency <= self.max_freq
+
+
+"""
+The EU868 sub-bands for non-specific short range devices
+(ETSI EN 300 220, ERC Recommendation 70-03 annex 1).
+"""
+EU868_SUB_BANDS = (
+    SubBand("h1.3", 863000000, 865000000, 0.001),
+    SubBand("h1.4", 865000000, 868000000, 0.01),
+    SubBand("h1.5", 868000000, 868600000, 0.01),
+    SubBand("h1.6", 868700000, 869200000, 0.001),
+    SubBand("h1.7", 869400000, 869650000, 0.1),
+    SubBand("h1.9", 869700000, 870000000, 0.01),
+)
+
+
+class DutyCycleLedger:
+    """Accounts the time on air per sub-band over a sliding window.
+
+    A frequency that is not in a known sub-band has no limit.
+
+    Attributes:
+        sub_bands: The sub-bands with their duty-cycle limit.
+        window: The size of the sliding window in seconds.
+    """
+
+    def __init__(self, sub_bands=EU868_SUB_BANDS, window: float = DUTY_CYCLE_WINDOW,
+                 clock: Callable[[], float] = time.monotonic):
+        self.sub_bands = tuple(sub_bands)
+        self.window = window
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._sub_band_cache = {}  # frequency -> SubBand
+        self._transmissions = {band: collections.deque() for band in self.sub_bands}  # (time, airtime)
+        self._used = {band: 0.0 for band in self.sub_bands}  # time on air in the window
+
+    def sub_band(self, frequency: int) -> Optional[SubBand]:
+        """Return the sub-band that contains the frequency or None."""
+        band = self._sub_band_cache.get(frequency, False)
+        if band is False:
+            band = next((b for b in self.sub_bands if b.contains(frequency)), None)
+            self._sub_band_cache[frequency] = band
+        return band
+
+    def _expire(self, band: SubBand, now: float):
+        transmissions = self._transmissions[band]
+        limit = now - self.window
+        while transmissions and transmissions[0][0] <= limit:
+            _, airtime = transmissions.popleft()
+            self._used[band] -= airtime
+        if not transmissions:
+            self._used[band] = 0.0  # avoid the accumulation of rounding errors
+
+    def remaining(self, frequency: int) -> float:
+        """Return the remaining time on air for a frequency.
+
+        Args:
+            frequency (int): The frequency in Hz.
+
+        Returns:
+            float: The remaining time on air in seconds in the current window.
+        """
+        band = self.sub_band(frequency)
+        if band is None:
+            return float("inf")
+        with self._lock:
+            self._expire(band, self._clock())
+            return max(0.0, band.duty_cycle * self.window - self._used[band])
+
+    def can_send(self, frequency: int, airtime: float) -> bool:
+        """Return True if a frame with this time on air can be sent now."""
+        return airtime <= self.remaining(frequency)
+
+    def wait_time(self, frequency: int, airtime: float) -> float:
+        """Return the time to wait before a frame with this time on air can be sent.
+
+        Args:
+            frequency (int): The frequency in Hz.
+            airtime (float): The time on air of the frame in seconds.
+
+        Returns:
+            float: The time to wait in seconds (inf if the frame can never be sent).
+        """
+        band = self.sub_band(frequency)
+        if band is None:
+            return 0.0
+        budget = band.duty_cycle * self.window
+        if airtime > budget:
+            return float("inf")
+        with self._lock:
+            now = self._clock()
+            self._expire(band, now)
+            excess = self._used[band] + airtime - budget
+            if excess <= 0:
+                return 0.0
+            # wait until enough transmissions leave the window
+            for sent_at, sent_airtime in self._transmissions[band]:
+                excess -= sent_airtime
+                if excess <= 0:
+                    return max(0.0, sent_at + self.window - now)
+        return float("inf")
+
+    def record(self, frequency: int, airtime: float):
+        """Record a transmission.
+
+        Args:
+            frequency (int): The frequency in Hz.
+            airtime (float): The time on air of the frame in seconds.
+        """
+        band = self.sub_band(frequency)
+        if band is None:
+            return
+        with self._lock:
+            now = self._clock()
+            self._expire(band, now)
+            self._transmissions[band].append((now, airtime))
+            self._used[band] += airtime
+
+
+class TokenBucket:
+    """A token bucket of time on air, to limit the rate of a kind of frames.
+
+    Attributes:
+        rate: The time on air (in seconds) earned per second.
+        capacity: The maximum time on air (in seconds) that can be spent at once.
+    """
+
+    def __init__(self, rate: float, capacity: float, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._tokens = capacity
+        self._updated_at = clock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def wait_time(self, airtime: float) -> float:
+        """Return the time to wait (in seconds) before airtime can be spent."""
+        self._refill(self._clock())
+        missing = min(airtime, self.capacity) - self._tokens
+        return max(0.0, missing / self.rate) if self.rate > 0 or missing <= 0 else float("inf")
+
+    def consume(self, airtime: float) -> bool:
+        """Spend airtime if the bucket holds enough tokens.
+
+        Returns:
+            bool: True if the tokens have been spent.
+        """
+        self._refill(self._clock())
+        if self._tokens < min(airtime, self.capacity):
+            return False
+        self._tokens -= airtime
+        return True
+
+    def charge(self, airtime: float):
+        """Spend airtime even if the bucket does not hold enough tokens: the
+        next frames wait until the debt is paid back."""
+        self._refill(self._clock())
+        self._tokens -= airtime
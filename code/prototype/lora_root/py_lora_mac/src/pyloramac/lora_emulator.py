@@ -0,0 +1,379 @@
+"""Emulator of the RN2483 on a pseudo-terminal.
+
+The emulator opens a pty and answers the UART commands used by LoraPhy
+(mac pause, radio set/get, radio rx, radio tx, sys reset) like a RN2483
+would, with the time on air of the frames and the radio watchdog timer.
+The stack runs unchanged against it:
+
+    emulator = RN2483Emulator()
+    emulator.start()
+    NETWORK_STACK.init(port=emulator.port)
+
+The frames sent by the stack are given to the on_transmit hook and the
+frames of the peers are given to the radio with inject().
+
+Usage:
+    python -m pyloramac.lora_emulator [--time-scale FACTOR] [--verbose] [--check]
+
+With --check, the emulation of the watchdog timer is checked (c.f.
+check_watchdog) instead of starting the emulator.
+"""
+import argparse
+import dataclasses
+import heapq
+import itertools
+import os
+import select
+import threading
+import time
+import tty
+from typing import Callable, Optional
+from loguru import logger as log
+from pyloramac.lora_airtime import time_on_air, MAX_FRAME_SIZE
+from pyloramac.lora_config import RADIO_PARAMS, RN2483_DEFAULT_CONFIG
+
+VERSION = "RN2483 1.0.4 Oct 12 2017 14:59:25"  # the answer to sys reset
+MAC_PAUSE_DURATION = "4294967245"  # the answer to mac pause (ms)
+
+# name used by `radio set` -> attribute of RadioConfig
+CONFIG_ATTRIBUTES = {param: name for name, param in RADIO_PARAMS.items()}
+
+
+class RN2483Emulator:
+    """A RN2483 on a pseudo-terminal.
+
+    The state of the radio is idle, rx (listening or receiving) or tx.
+    As on the real module, the radio commands are answered by `busy` while
+    the mac is not paused or while a reception or a transmission is running.
+
+    Attributes:
+        port: The path of the pty to give to the PHY layer.
+        config: The radio configuration.
+        time_scale: Factor applied to the time on air and to the watchdog
+                    timer (e.g. 0.01 to run 100 times faster than real time).
+        on_transmit: Called with the bytes of each frame sent by the radio.
+        stats: Counters of the emulated events.
+    """
+
+    def __init__(self, time_scale: float = 1.0, on_transmit: Callable[[bytes], None] = None):
+        self.time_scale = time_scale
+        self.on_transmit = on_transmit
+        self.config = RN2483_DEFAULT_CONFIG
+        self.stats = {"commands": 0, "tx": 0, "rx": 0, "radio_err": 0, "busy": 0, "lost": 0}
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._lock = threading.RLock()
+        self._buffer = bytearray()
+        self._mac_paused = False
+        self._state = "idle"
+        self._receiving = False  # True when a frame is being received
+        self._timers = []  # heap of (time, id, callback)
+        self._timer_ids = itertools.count()
+        self._state_timer = None  # the timer ending the current rx (watchdog) or tx
+        self._rx_timer = None  # the timer ending the reception of a frame
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        """Start the emulator thread."""
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the emulator thread and close the pty."""
+        self._running = False
+        self._wake()
+        if self._thread is not None:
+            self._thread.join()
+        for fd in (self._master, self._slave, self._wakeup_r, self._wakeup_w):
+            os.close(fd)
+
+    @property
+    def listening(self) -> bool:
+        """True if the radio listens and no frame is being received."""
+        with self._lock:
+            return self._state == "rx" and not self._receiving
+
+    def airtime(self, size: int) -> float:
+        """Return the time on air (in seconds, scaled) of a frame with the current configuration."""
+        return time_on_air(size, self.config.sf, self.config.bandwidth, self.config.cr) * self.time_scale
+
+    def inject(self, data: bytes) -> bool:
+        """Send a frame to the radio, as a peer would.
+
+        The frame is received at the end of its time on air if the radio
+        listens when the transmission begins, otherwise it is lost. As on
+        the module, the watchdog timer also ends a reception in progress:
+        the frame is then lost and the radio answers radio_err.
+
+        Args:
+            data (bytes): The LoRa frame.
+
+        Returns:
+            bool: True if the radio receives the frame.
+        """
+        with self._lock:
+            if not self.listening:
+                self.stats["lost"] += 1
+                return False
+            self._receiving = True
+            self._rx_timer = self._schedule(self.airtime(len(data)), lambda: self._end_rx(data))
+            return True
+
+    def _run(self):
+        while self._running:
+            with self._lock:
+                now = time.monotonic()
+                while self._timers and self._timers[0][0] <= now:
+                    _, timer_id, callback = heapq.heappop(self._timers)
+                    if callback is not None:
+                        callback()
+                timeout = max(0.0, self._timers[0][0] - now) if self._timers else None
+            readable, _, _ = select.select([self._master, self._wakeup_r], [], [], timeout)
+            if self._wakeup_r in readable:
+                os.read(self._wakeup_r, 1024)
+            if self._master in readable:
+                try:
+                    data = os.read(self._master, 1024)
+                except OSError:
+                    return
+                self._feed(data)
+
+    def _wake(self):
+        os.write(self._wakeup_w, b"\0")
+
+    def _schedule(self, delay: float, callback: Callable[[], None]) -> list:
+        entry = [time.monotonic() + delay, next(self._timer_ids), callback]
+        heapq.heappush(self._timers, entry)
+        self._wake()
+        return entry
+
+    @staticmethod
+    def _cancel(entry: Optional[list]):
+        if entry is not None:
+            entry[2] = None  # lazy deletion
+
+    def _write(self, line: str):
+        log.debug(f"RN2483 > {line}")
+        os.write(self._master, (line + "\r\n").encode())
+
+    def _feed(self, data: bytes):
+        self._buffer += data
+        while True:
+            end = self._buffer.find(b"\r\n")
+            if end < 0:
+                return
+            line = bytes(self._buffer[:end]).decode(errors="replace")
+            del self._buffer[:end + 2]
+            with self._lock:
+                self._on_command(line)
+
+    def _on_command(self, line: str):
+        """Answer an UART command."""
+        log.debug(f"RN2483 < {line}")
+        self.stats["commands"] += 1
+        words = line.split()
+        if line == "sys reset":
+            self._reset()
+            self._write(VERSION)
+        elif line == "mac pause":
+            self._mac_paused = True
+            self._write(MAC_PAUSE_DURATION)
+        elif line == "mac resume":
+            self._mac_paused = False
+            self._write("ok")
+        elif words[:2] == ["radio", "get"] and len(words) == 3:
+            value = getattr(self.config, CONFIG_ATTRIBUTES.get(words[2], ""), None)
+            self._write("invalid_param" if value is None else value)
+        elif words[:1] != ["radio"] or len(words) < 2:
+            self._write("invalid_param")
+        elif words[1] == "rxstop" and len(words) == 2:
+            self._stop_rx()
+            self._write("ok")
+        elif not self._mac_paused or self._state != "idle":
+            self.stats["busy"] += 1
+            self._write("busy")
+        elif words[1] == "set" and len(words) == 4:
+            self._set(words[2], words[3])
+        elif words[1] == "rx" and len(words) == 3:
+            self._rx(words[2])
+        elif words[1] == "tx" and len(words) == 3:
+            self._tx(words[2])
+        else:
+            self._write("invalid_param")
+
+    def _reset(self):
+        self._cancel(self._state_timer)
+        self._cancel(self._rx_timer)
+        self._state_timer = self._rx_timer = None
+        self._state = "idle"
+        self._receiving = False
+        self._mac_paused = False
+        self.config = RN2483_DEFAULT_CONFIG
+
+    def _set(self, param: str, value: str):
+        name = CONFIG_ATTRIBUTES.get(param, None)
+        if name is None:
+            self._write("invalid_param")
+            return
+        config = dataclasses.replace(self.config, **{name: value})
+        try:
+            config.validate()
+        except ValueError:
+            self._write("invalid_param")
+            return
+        self.config = config
+        self._write("ok")
+
+    def _rx(self, window: str):
+        if not window.isdigit():
+            self._write("invalid_param")
+            return
+        self._write("ok")
+        self._state = "rx"
+        self._receiving = False
+        # radio rx 0 listens until a frame is received, the watchdog timer still applies
+        wdt = int(self.config.wdt)
+        if wdt:
+            self._state_timer = self._schedule(wdt / 1000 * self.time_scale, self._rx_timeout)
+
+    def _rx_timeout(self):
+        if self._receiving:
+            # the reception is cut off by the watchdog
+            self._cancel(self._rx_timer)
+            self._rx_timer = None
+            self._receiving = False
+            self.stats["lost"] += 1
+        self._state = "idle"
+        self._state_timer = None
+        self.stats["radio_err"] += 1
+        self._write("radio_err")
+
+    def _end_rx(self, data: bytes):
+        self._cancel(self._state_timer)
+        self._state = "idle"
+        self._state_timer = self._rx_timer = None
+        self._receiving = False
+        self.stats["rx"] += 1
+        self._write("radio_rx  " + data.hex().upper())
+
+    def _stop_rx(self):
+        if self._state == "rx":
+            self._cancel(self._state_timer)
+            self._cancel(self._rx_timer)
+            self._state_timer = self._rx_timer = None
+            self._state = "idle"
+            self._receiving = False
+
+    def _tx(self, data: str):
+        try:
+            frame = bytes.fromhex(data)
+        except ValueError:
+            self._write("invalid_param")
+            return
+        if not frame or len(frame) > MAX_FRAME_SIZE:
+            self._write("invalid_param")
+            return
+        self._write("ok")
+        self._state = "tx"
+        self._state_timer = self._schedule(self.airtime(len(frame)), lambda: self._end_tx(frame))
+
+    def _end_tx(self, frame: bytes):
+        self._state = "idle"
+        self._state_timer = None
+        self.stats["tx"] += 1
+        self._write("radio_tx_ok")
+        if self.on_transmit is not None:
+            self.on_transmit(frame)
+
+
+class _UartClient:
+    """A minimal client of the UART of the emulator, for the checks."""
+
+    def __init__(self, port: str):
+        self._fd = os.open(port, os.O_RDWR | os.O_NOCTTY)
+        self._buffer = bytearray()
+
+    def close(self):
+        os.close(self._fd)
+
+    def command(self, line: str, timeout: float = 1.0) -> Optional[str]:
+        os.write(self._fd, (line + "\r\n").encode())
+        return self.read_line(timeout)
+
+    def read_line(self, timeout: float) -> Optional[str]:
+        """Return the next line, None if none is received before the timeout."""
+        deadline = time.monotonic() + timeout
+        while b"\r\n" not in self._buffer:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([self._fd], [], [], remaining)[0]:
+                return None
+            self._buffer += os.read(self._fd, 1024)
+        line, _, rest = bytes(self._buffer).partition(b"\r\n")
+        self._buffer = bytearray(rest)
+        return line.decode(errors="replace")
+
+
+def check_watchdog() -> bool:
+    """Check that the watchdog timer ends a reception in progress.
+
+    A frame whose time on air is longer than the watchdog timeout must
+    not be received (radio_err), a shorter one must be.
+
+    Returns:
+        bool: True if the emulator behaves as the module.
+    """
+    emulator = RN2483Emulator()
+    emulator.start()
+    client = _UartClient(emulator.port)
+    ok = True
+    try:
+        for line in ("mac pause", "radio set sf sf7", "radio set wdt 100"):
+            client.command(line)
+        for size, expected in ((MAX_FRAME_SIZE, "radio_err"), (8, "radio_rx")):
+            client.command("radio rx 0")
+            airtime = emulator.airtime(size)
+            emulator.inject(bytes(size))
+            answer = client.read_line(airtime + 1.0) or ""
+            passed = answer.split(" ")[0] == expected
+            ok = ok and passed
+            print(f"{size} bytes ({airtime * 1000:.0f} ms on air), wdt 100 ms: {answer[:20]!r}"
+                  f" -> {'OK' if passed else 'FAILED, expected ' + expected}")
+    finally:
+        client.close()
+        emulator.stop()
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulate a RN2483 on a pseudo-terminal.")
+    parser.add_argument("--time-scale", type=float, default=1.0,
+                        help="factor applied to the time on air and the watchdog timer")
+    parser.add_argument("--verbose", action="store_true", help="log the UART traffic")
+    parser.add_argument("--check", action="store_true", help="check the emulation of the watchdog timer and exit")
+    args = parser.parse_args()
+
+    if args.verbose:
+        log.enable("pyloramac")
+    else:
+        log.disable(__name__)  # run as __main__
+    if args.check:
+        raise SystemExit(0 if check_watchdog() else 1)
+    emulator = RN2483Emulator(time_scale=args.time_scale,
+                              on_transmit=lambda frame: print(f"TX {frame.hex().upper()}", flush=True))
+    emulator.start()
+    print(f"RN2483 emulator listening on {emulator.port}", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,363 @@
+"""Fragmentation of the packets larger than a LoRaMAC frame (c.f. RFC 4944).
+
+The fragmentation layer sits between LoraIP and LoraMac. A packet that
+does not fit in one frame is split in fragments, sent as consecutive DATA
+frames: the root sets has_next on each of them so that the child polls
+again at once and the whole packet is sent within one QUERY window.
+
+The fragment headers are the ones of RFC 4944 (size in bits):
+
+    FRAG1: | 11000 | datagram size (11) | datagram tag (16) |
+    FRAGN: | 11100 | datagram size (11) | datagram tag (16) | datagram offset (8) |
+
+The datagram size is the size of the packet given to the layer (the IPv6
+packet without addresses, compressed or not) and the offset is in units
+of 8 bytes. The first byte of a fragment (110xxxxx or 111xxxxx) can not
+start an IPv6 packet (0110xxxx) or a compressed packet (0111xxxx).
+"""
+import collections
+import itertools
+import struct
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, List
+
+from loguru import logger as log
+from concurrent.futures import Future
+from pyloramac.lora_mac import LoraMac, CAP_FRAG, SendStatus, done_future
+from pyloramac.lora_sched import Priority
+from pyloramac.lora_phy import LoraAddr, MAX_PAYLOAD_SIZE
+
+FRAG1_DISPATCH = 0xC0
+FRAGN_DISPATCH = 0xE0
+FRAG_DISPATCH_MASK = 0xF8
+FRAG1_HEADER = struct.Struct(">HH")  # dispatch and datagram size, datagram tag
+FRAGN_HEADER = struct.Struct(">HHB")  # dispatch and datagram size, datagram tag, datagram offset
+DATAGRAM_SIZE_MASK = 0x07FF
+MAX_DATAGRAM_SIZE = DATAGRAM_SIZE_MASK
+OFFSET_UNIT = 8  # bytes
+
+
+# reassembly
+REASSEMBLY_TIMEOUT = 60  # maximum time (in seconds) to receive all the fragments of a packet
+MAX_BUFFERS_PER_SOURCE = 2  # packets being reassembled per source
+MAX_REASSEMBLY_MEMORY = 16 * 1024  # total size (in bytes) of the reassembly buffers
+
+
+def is_fragment(data: bytes) -> bool:
+    """Return True if the data is a fragment."""
+    return len(data) > 0 and data[0] & FRAG_DISPATCH_MASK in (FRAG1_DISPATCH, FRAGN_DISPATCH)
+
+
+def fragment(packet: bytes, tag: int, max_payload: int = MAX_PAYLOAD_SIZE) -> List[bytes]:
+    """Split a packet in fragments.
+
+    Args:
+        packet (bytes): The packet to split.
+        tag (int): The datagram tag (16 bits) of the packet.
+        max_payload (int): The maximum size of a fragment (c.f. LoraMac.max_payload_of).
+
+    Raises:
+        ValueError: If the packet is larger than MAX_DATAGRAM_SIZE.
+
+    Returns:
+        list: The fragments (bytes), in order.
+    """
+    size = len(packet)
+    if size > MAX_DATAGRAM_SIZE:
+        raise ValueError(f"packet of {size} bytes too large (max {MAX_DATAGRAM_SIZE})")
+    tag &= 0xFFFF
+    # the fragment data is a multiple of OFFSET_UNIT (except in the last fragment)
+    first_size = (max_payload - FRAG1_HEADER.size) // OFFSET_UNIT * OFFSET_UNIT
+    next_size = (max_payload - FRAGN_HEADER.size) // OFFSET_UNIT * OFFSET_UNIT
+    fragments = [FRAG1_HEADER.pack(FRAG1_DISPATCH << 8 | size, tag) + packet[:first_size]]
+    for offset in range(first_size, size, next_size):
+        header = FRAGN_HEADER.pack(FRAGN_DISPATCH << 8 | size, tag, offset // OFFSET_UNIT)
+        fragments.append(header + packet[offset:offset + next_size])
+    return fragments
+
+
+def parse_fragment(data: bytes) -> tuple:
+    """Parse the header of a fragment.
+
+    Args:
+        data (bytes): The fragment.
+
+    Raises:
+        ValueError: If the fragment is malformed.
+
+    Returns:
+        tuple: The datagram size, the datagram tag, the offset (in bytes)
+               and the data of the fragment.
+    """
+    try:
+        if data[0] & FRAG_DISPATCH_MASK == FRAG1_DISPATCH:
+            dispatch_size, tag = FRAG1_HEADER.unpack_from(data)
+            offset = 0
+            header_size = FRAG1_HEADER.size
+        else:
+            dispatch_size, tag, offset = FRAGN_HEADER.unpack_from(data)
+            offset *= OFFSET_UNIT
+            header_size = FRAGN_HEADER.size
+    except (IndexError, struct.error):
+        raise ValueError("truncated fragment header") from None
+    size = dispatch_size & DATAGRAM_SIZE_MASK
+    chunk = data[header_size:]
+    if not chunk or offset + len(chunk) > size:
+        raise ValueError(f"fragment [{offset}, {offset + len(chunk)}) out of the datagram of {size} bytes")
+    return size, tag, offset, chunk
+
+
+@dataclass
+class ReassemblyBuffer:
+    """A packet being reassembled.
+
+    Attributes:
+        size: The size of the packet.
+        deadline: The time after which the packet is dropped.
+        data: The packet.
+        units: 1 for each unit of OFFSET_UNIT bytes received, else 0.
+        missing: The number of units not received.
+    """
+
+    size: int
+    deadline: float
+    data: bytearray = None
+    units: bytearray = None
+    missing: int = 0
+
+    def __post_init__(self):
+        self.data = bytearray(self.size)
+        self.missing = -(-self.size // OFFSET_UNIT)
+        self.units = bytearray(self.missing)
+
+    def add(self, offset: int, chunk: bytes) -> bool:
+        """Copy a fragment in the buffer.
+
+        Returns:
+            bool: True if the packet is complete.
+        """
+        self.data[offset:offset + len(chunk)] = chunk
+        first = offset // OFFSET_UNIT
+        last = -(-(offset + len(chunk)) // OFFSET_UNIT)
+        self.missing -= (last - first) - sum(self.units[first:last])  # a fragment can be received twice
+        self.units[first:last] = b"\x01" * (last - first)
+        return self.missing == 0
+
+
+class LoraFrag:
+    """Fragmentation layer between LoraIP and LoraMac.
+
+    It has the interface of LoraMac used by LoraIP. The packets that fit
+    in one frame are given to the MAC layer unchanged. The larger packets
+    are fragmented, if the destination has negotiated it at join (CAP_FRAG).
+
+    The fragments received are reassembled per source and datagram tag.
+    A packet not complete after reassembly_timeout is dropped, as the
+    fragments that would exceed max_buffers_per_source packets for one
+    source or max_memory bytes in total.
+
+    Attributes:
+        mac_layer: The MAC layer to use.
+        upper_layer: The Callable used to send the packets to the upper layer.
+        stats: Counters of the fragmented, reassembled and dropped packets.
+    """
+
+    def __init__(self, mac_layer: LoraMac, reassembly_timeout: float = REASSEMBLY_TIMEOUT,
+                 max_buffers_per_source: int = MAX_BUFFERS_PER_SOURCE, max_memory: int = MAX_REASSEMBLY_MEMORY,
+                 clock: Callable[[], float] = time.monotonic):
+        self.mac_layer = mac_layer
+        self.upper_layer = None
+        self.reassembly_timeout = reassembly_timeout
+        self.max_buffers_per_source = max_buffers_per_source
+        self.max_memory = max_memory
+        self.clock = clock
+        self.stats = {"fragmented": 0, "fragments_sent": 0, "reassembled": 0, "fragments_received": 0,
+                      "timeouts": 0, "dropped": 0, "invalid": 0}
+
+        self._tags = itertools.count()
+        # (src, tag) -> ReassemblyBuffer, the oldest first (i.e. by deadline)
+        self._buffers = collections.OrderedDict()
+        self._buffers_per_source = collections.Counter()
+        self._memory = 0  # size of the reassembly buffers
+        # the MAC layer can deliver the payloads of several sources in parallel (c.f. lora_delivery)
+        self._lock = threading.Lock()
+
+    @property
+    def addr(self) -> LoraAddr:
+        return self.mac_layer.addr
+
+    def init(self):
+        """Init the fragmentation layer.
+            - Init the MAC layer
+            - Register as listener to the MAC layer
+        """
+
+        log.info("Init fragmentation")
+        self.mac_layer.init()
+        self.mac_layer.register_listener(self._on_frame)
+
+    def register_listener(self, listener: Callable[[LoraAddr, bytes], None]):
+        """Register a listener that will be called with the received packets.
+
+        Args:
+            listener (Callable[[LoraAddr, bytes], None]): The listener.
+        """
+        self.upper_layer = listener
+
+    def capabilities_of(self, addr: LoraAddr) -> int:
+        return self.mac_layer.capabilities_of(addr)
+
+    def mac_send(self, dest: LoraAddr, payload: bytes, block: bool = True) -> bool:
+        """Send a packet to the destination dest, fragmented if needed.
+
+        Args:
+            dest (LoraAddr): The destination address.
+            payload (bytes): The packet to send.
+            block (bool): If False, raise queue.Full instead of blocking
+                          when the TX buffer can not hold all the fragments.
+
+        Returns:
+            bool: True if the packet has been queued, False if the
+                  destination is unreachable or can not receive the packet.
+        """
+        max_payload = self.mac_layer.max_payload_of(dest)
+        if len(payload) <= max_payload:
+            return self.mac_layer.mac_send(dest, payload, block)
+
+        if not self.capabilities_of(dest) & CAP_FRAG:
+            log.error(f"Packet of {len(payload)} bytes too large for {dest} that does not support fragmentation")
+            return False
+        try:
+            fragments = fragment(payload, next(self._tags), max_payload)
+        except ValueError as e:
+            log.error(f"Packet to {dest} not sent: {e}")
+            return False
+        log.info(f"Packet of {len(payload)} bytes to {dest} sent in {len(fragments)} fragments")
+        if not self.mac_layer.mac_send_all(dest, fragments, block):
+            return False
+        self.stats["fragmented"] += 1
+        self.stats["fragments_sent"] += len(fragments)
+        return True
+
+    def mac_submit(self, dest: LoraAddr, payload: bytes, lifetime: float = None,
+                   priority: Priority = Priority.NORMAL) -> Future:
+        """Send a packet to the destination dest, fragmented if needed, without blocking.
+
+        Args:
+            dest (LoraAddr): The destination address.
+            payload (bytes): The packet to send.
+            lifetime (float): If not None, the fragments not sent within
+                              lifetime seconds are dropped (c.f. LoraMac.mac_submit).
+            priority (Priority): The priority class of the fragments.
+
+        Returns:
+            Future: Resolved with the SendStatus of the packet (DELIVERED
+                    when all its fragments are acknowledged).
+        """
+        max_payload = self.mac_layer.max_payload_of(dest)
+        if len(payload) <= max_payload:
+            return self.mac_layer.mac_submit(dest, payload, lifetime, priority)
+
+        if not self.capabilities_of(dest) & CAP_FRAG:
+            log.error(f"Packet of {len(payload)} bytes too large for {dest} that does not support fragmentation")
+            return done_future(SendStatus.REJECTED)
+        try:
+            fragments = fragment(payload, next(self._tags), max_payload)
+        except ValueError as e:
+            log.error(f"Packet to {dest} not sent: {e}")
+            return done_future(SendStatus.REJECTED)
+        log.info(f"Packet of {len(payload)} bytes to {dest} sent in {len(fragments)} fragments")
+        future = self.mac_layer.mac_submit_all(dest, fragments, lifetime, priority)
+        if not future.done():
+            self.stats["fragmented"] += 1
+            self.stats["fragments_sent"] += len(fragments)
+        return future
+
+    def _on_frame(self, src: LoraAddr, payload: bytes):
+        """Process a payload from the MAC layer: deliver it or reassemble it."""
+        if not is_fragment(payload):
+            self._deliver(src, payload)
+            return
+
+        try:
+            size, tag, offset, chunk = parse_fragment(payload)
+        except ValueError as e:
+            with self._lock:
+                self.stats["fragments_received"] += 1
+                self.stats["invalid"] += 1
+            log.warning(f"Invalid fragment from {src}: {e}")
+            return
+
+        with self._lock:
+            self.stats["fragments_received"] += 1
+            packet = self._reassemble(src, size, tag, offset, chunk)
+        if packet is not None:
+            self._deliver(src, packet)
+
+    def _reassemble(self, src: LoraAddr, size: int, tag: int, offset: int, chunk: bytes):
+        """Add a fragment to its reassembly buffer, return the packet if complete."""
+        now = self.clock()
+        self._expire(now)
+        key = (src, tag)
+        buffer = self._buffers.get(key, None)
+        if buffer is not None and buffer.size != size:
+            log.warning(f"Fragment of {src} with tag {tag} for another datagram size -> restart")
+            self._drop(key)
+            buffer = None
+        if buffer is None:
+            buffer = self._new_buffer(key, size, now)
+            if buffer is None:
+                return None
+
+        if buffer.add(offset, chunk):
+            self._remove(key)
+            self.stats["reassembled"] += 1
+            return bytes(buffer.data)
+        return None
+
+    def _new_buffer(self, key: tuple, size: int, now: float):
+        """Create a reassembly buffer, None if the memory limit is reached."""
+        src = key[0]
+        if self._buffers_per_source[src] >= self.max_buffers_per_source:
+            # the source does not send the previous packets anymore
+            oldest = next(k for k in self._buffers if k[0] == src)
+            log.warning(f"Too many packets being reassembled for {src} -> drop the oldest")
+            self._drop(oldest)
+        if self._memory + size > self.max_memory:
+            self.stats["dropped"] += 1
+            log.warning(f"Reassembly memory full -> fragment of {src} dropped")
+            return None
+        buffer = ReassemblyBuffer(size, now + self.reassembly_timeout)
+        self._buffers[key] = buffer
+        self._buffers_per_source[src] += 1
+        self._memory += size
+        return buffer
+
+    def _expire(self, now: float):
+        """Drop the packets not complete before their deadline."""
+        while self._buffers:
+            key, buffer = next(iter(self._buffers.items()))
+            if buffer.deadline > now:
+                return
+            log.info(f"Reassembly timeout for the packet of {key[0]} with tag {key[1]}")
+            self.stats["timeouts"] += 1
+            self._remove(key)
+
+    def _drop(self, key: tuple):
+        self.stats["dropped"] += 1
+        self._remove(key)
+
+    def _remove(self, key: tuple):
+        buffer = self._buffers.pop(key)
+        self._memory -= buffer.size
+        self._buffers_per_source[key[0]] -= 1
+        if not self._buffers_per_source[key[0]]:
+            del self._buffers_per_source[key[0]]
+
+    def _deliver(self, src: LoraAddr, payload: bytes):
+        if self.upper_layer is None:
+            log.warning("Upper layer not defined. Please call `register_listener` before.")
+            return
+        self.upper_layer(src, payload)
@@ -1,16 +1,68 @@
 #from py_lora_mac.lora_mac import *
+from __future__ import annotations
+import functools
+import threading
 from pyloramac.lora_mac import *
+from pyloramac import lora_iphc
 from ipaddress import IPv6Address, AddressValueError
-from scapy.all import *
+from typing import TYPE_CHECKING, Optional
 
 from loguru import logger as log
 
+if TYPE_CHECKING:
+    # scapy is slow to import, it is only imported when a scapy packet is used
+    from scapy.layers.inet6 import IPv6
+
 
 # Unique Local IPv6 Unicast Addresses (FC00::/7) with to L bit to 1 (c.f. RFC 4193)
 IPv6_PREFIX = "FD00"
 
 COMMON_LINK_ADDR_PART = "0212:4B00:060D"
 
+IPV6_BASE_HEADER_SIZE = 8 # VER, TC, FL, LEN, NH and HL fields
+IPV6_HEADER_SIZE = 40
+IPV6_NH_OFFSET = 6
+IPV6_SRC_OFFSET = 8
+IPV6_DEST_OFFSET = 24
+UDP_DEST_PORT_OFFSET = 2
+
+# extension headers skipped to find the upper layer protocol (Hop-by-Hop, Routing, Destination Options),
+# their length is given in 8 bytes units, not counting the first 8 bytes
+EXTENSION_HEADERS = frozenset((0, 43, 60))
+
+ADDR_CACHE_SIZE = 1024  # number of addresses kept by the translation caches
+
+"""
+The 14 first bytes of the IPv6 address of each LoRaMAC prefix
+(IPv6 PREFIX, ZEROS, LORA PREFIX, COMMON_LINK_ADDR_PART), c.f. LoraIP.
+"""
+_PREFIX_TEMPLATES = tuple(
+    bytes.fromhex(IPv6_PREFIX) + bytes(5) + bytes((prefix,)) + bytes.fromhex(COMMON_LINK_ADDR_PART.replace(":", ""))
+    for prefix in range(256)
+)
+
+
+class Handler:
+    """A handler of the dispatch table of LoraIP and its counters.
+
+    Attributes:
+        callback: The Callable[[LoraAddr, bytes], None] called with the packets.
+        packets: The number of packets given to the handler.
+        bytes: The size of these packets.
+        errors: The number of packets for which the handler raised an exception.
+    """
+
+    __slots__ = ("callback", "packets", "bytes", "errors")
+
+    def __init__(self, callback: Callable[[LoraAddr, bytes], None]):
+        self.callback = callback
+        self.packets = 0
+        self.bytes = 0
+        self.errors = 0
+
+    def to_dict(self) -> dict:
+        return {"packets": self.packets, "bytes": self.bytes, "errors": self.errors}
+
 
 class LoraIP:
     """Network layer for the LoRaMac protocol.
@@ -22,15 +74,32 @@ class LoraIP:
     | IPv6 PREFIX | ZEROS | LORA PREFIX | COMMON_LINK_ADDR_PART | NODE_ID |
      0           0 1     6 7           7 8                    13 14     15
 
+    The received packets are given to the handler registered for their
+    next header (and UDP destination port), read from the raw bytes, or to
+    the default handler. The listeners (register_listener and
+    register_raw_listener) receive all the packets.
+
     Attributes:
-        mac_layer: The MAC layer to use
+        mac_layer: The MAC layer to use (or the fragmentation layer, c.f. LoraFrag)
         upper_layer: The Callable used to send incoming packet to the upper layer
+        raw_upper_layer: The Callable used to send incoming packet as bytes to
+                         the upper layer
+        handlers: The dispatch table, (next header, UDP destination port or
+                  None for all the ports) -> Handler.
+        default_handler: The Handler of the packets without handler, None to drop them.
+        unhandled: The number of packets without handler (dropped if there
+                   is no default handler).
 
     """
 
     def __init__(self, mac_layer: LoraMac):
         self.mac_layer = mac_layer
         self.upper_layer = None
+        self.raw_upper_layer = None
+        self.handlers = {}
+        self.default_handler = None
+        self.unhandled = 0
+        self._stats_lock = threading.Lock()  # the MAC layer delivers several sources at once
 
     def init(self):
         """Init the IP layer.
@@ -42,20 +111,33 @@ class LoraIP:
         self.mac_layer.init()
         self.mac_layer.register_listener(self._on_frame)
 
-    def _on_frame(self, src: LoraAddr, payload: str):
+    def _on_frame(self, src: LoraAddr, payload: bytes):
         """Process a frame from the MAC layer and deliver it to the upper layer.
 
         Args:
             src (LoraAddr): The source address of the frame.
-            payload (str): The data of the frame.
+            payload (bytes): The data of the frame.
         """
 
-        log.info("IP RX: {} from: {}", payload, str(src))
-        if self.upper_layer is None:
+        log.opt(lazy=True).debug("IP RX: {} from: {}", payload.hex, lambda: src)
+        if self.upper_layer is None and self.raw_upper_layer is None and \
+                not self.handlers and self.default_handler is None:
             log.warning("Upper layer not defined. Please call `register_listener` before.")
-        else:
-            ip_packet = self.build_ip_packet(payload, src, self.mac_layer.addr)
-            self.upper_layer(ip_packet)
+            return
+
+        try:
+            raw_packet = self.restore_addresses(payload, src, self.mac_layer.addr)
+        except ValueError as e:
+            log.warning(f"Invalid packet from {src}: {e}")
+            return
+        if self.handlers or self.default_handler is not None:
+            self._dispatch(src, raw_packet)
+        if self.raw_upper_layer is not None:
+            self.raw_upper_layer(src, raw_packet)
+        if self.upper_layer is not None:
+            # the scapy packet is only built if someone asks for it
+            from scapy.layers.inet6 import IPv6
+            self.upper_layer(IPv6(raw_packet))
 
     def register_listener(self, listener: Callable[[IPv6], None]):
         """Register the listener for the upper layer.
@@ -67,19 +149,188 @@ class LoraIP:
         log.debug("listener registered !")
         self.upper_layer = listener
 
-    def send(self, ip_packet: IPv6):
+    def register_raw_listener(self, listener: Callable[[LoraAddr, bytes], None]):
+        """Register the listener for the upper layer that receives the IPv6
+        packets as bytes, without scapy dissection.
+
+        Args:
+            listener (Callable[[LoraAddr, bytes], None]): The listener. It
+                receives the LoRaMAC source address and the IPv6 packet.
+        """
+
+        log.debug("raw listener registered !")
+        self.raw_upper_layer = listener
+
+    def register_handler(self, handler: Callable[[LoraAddr, bytes], None], next_header: int = lora_iphc.UDP,
+                         port: int = None):
+        """Register the handler of the packets of a protocol (and of a UDP port).
+
+        The handler of a UDP port takes precedence over the one of all
+        the UDP ports. A handler registered for the same key is replaced.
+
+        Args:
+            handler (Callable[[LoraAddr, bytes], None]): The handler. It receives
+                the LoRaMAC source address and the IPv6 packet.
+            next_header (int): The upper layer protocol (UDP by default).
+            port (int): The UDP destination port, None for all the ports.
+        """
+
+        if port is not None and next_header != lora_iphc.UDP:
+            raise ValueError("A port can only be given for UDP")
+        log.debug(f"handler registered for {next_header}:{port}")
+        self.handlers[(next_header, port)] = Handler(handler)
+
+    def unregister_handler(self, next_header: int = lora_iphc.UDP, port: int = None):
+        """Remove the handler of a protocol (and of a UDP port), if any."""
+
+        self.handlers.pop((next_header, port), None)
+
+    def register_default_handler(self, handler: Callable[[LoraAddr, bytes], None]):
+        """Register the handler of the packets that match no other handler.
+
+        Args:
+            handler (Callable[[LoraAddr, bytes], None]): The handler, None to drop these packets.
+        """
+
+        self.default_handler = Handler(handler) if handler is not None else None
+
+    def handler_stats(self) -> dict:
+        """Return the counters of the handlers.
+
+        Returns:
+            dict: (next header, port) or "default" -> dict (packets, bytes,
+                  errors), and "unhandled" -> int.
+        """
+
+        with self._stats_lock:
+            stats = {key: handler.to_dict() for key, handler in list(self.handlers.items())}
+            if self.default_handler is not None:
+                stats["default"] = self.default_handler.to_dict()
+            stats["unhandled"] = self.unhandled
+        return stats
+
+    def _dispatch(self, src: LoraAddr, raw_packet: bytes):
+        """Give a packet to the handler of its protocol and UDP port."""
+
+        next_header, port = self.demux_key(raw_packet)
+        handler = self.handlers.get((next_header, port), None)
+        if handler is None and port is not None:
+            handler = self.handlers.get((next_header, None), None)
+        if handler is None:
+            handler = self.default_handler
+        if handler is None:
+            with self._stats_lock:
+                self.unhandled += 1
+            log.debug(f"No handler for the packet of {src} ({next_header}:{port}) -> dropped")
+            return
+        with self._stats_lock:
+            if handler is self.default_handler:
+                self.unhandled += 1
+            handler.packets += 1
+            handler.bytes += len(raw_packet)
+        try:
+            handler.callback(src, raw_packet)
+        except Exception:
+            with self._stats_lock:
+                handler.errors += 1
+            log.exception(f"Error in the handler of {next_header}:{port}")
+
+    def send(self, ip_packet: IPv6, block: bool = True) -> bool:
         """Send the IPv6 packet.
                 - Prepare to IPv6 packet for the MAC layer.
                 - Send it to the MAC layer.
         Args:
             ip_packet (IPv6): The packet to send
+            block (bool): If False, raise queue.Full instead of blocking
+                          when the MAC TX buffer is full.
+
+        Returns:
+            bool: False if the destination is unreachable, True otherwise.
         """
 
         payload, _, dest_addr = self.serialize_ip_packet(ip_packet)
-        log.info(f"IP TX {ip_packet[UDP][Raw].load.decode()} to {dest_addr}")
-        self.mac_layer.mac_send(dest=dest_addr, payload=payload)
+        payload = self._compress(payload, dest_addr)
+        log.info("IP TX {} bytes to {}", len(payload), dest_addr)
+        return self.mac_layer.mac_send(dest=dest_addr, payload=payload, block=block)
+
+    def send_bytes(self, dest: LoraAddr, ipv6_packet: bytes, block: bool = True) -> bool:
+        """Send an IPv6 packet given as bytes.
+
+        Args:
+            dest (LoraAddr): The LoRaMAC destination address.
+            ipv6_packet (bytes): The IPv6 packet to send.
+            block (bool): If False, raise queue.Full instead of blocking
+                          when the MAC TX buffer is full.
+
+        Returns:
+            bool: False if the destination is unreachable, True otherwise.
+        """
+
+        payload = self._compress(self.elide_addresses(ipv6_packet), dest)
+        log.info("IP TX {} bytes to {}", len(ipv6_packet), dest)
+        return self.mac_layer.mac_send(dest=dest, payload=payload, block=block)
+
+    def submit(self, ip_packet: IPv6, lifetime: float = None, priority: Priority = Priority.NORMAL) -> Future:
+        """Send the IPv6 packet without blocking.
+
+        Args:
+            ip_packet (IPv6): The packet to send
+            lifetime (float): If not None, the packet is dropped if it is
+                              not sent within lifetime seconds.
+            priority (Priority): The priority class of the packet (c.f. lora_sched).
+
+        Returns:
+            Future: Resolved with the SendStatus of the packet (c.f. LoraMac.mac_submit).
+        """
+
+        payload, _, dest_addr = self.serialize_ip_packet(ip_packet)
+        payload = self._compress(payload, dest_addr)
+        log.info("IP TX {} bytes to {}", len(payload), dest_addr)
+        return self.mac_layer.mac_submit(dest_addr, payload, lifetime, priority)
+
+    def submit_bytes(self, dest: LoraAddr, ipv6_packet: bytes, lifetime: float = None,
+                     priority: Priority = Priority.NORMAL) -> Future:
+        """Send an IPv6 packet given as bytes, without blocking.
+
+        Args:
+            dest (LoraAddr): The LoRaMAC destination address.
+            ipv6_packet (bytes): The IPv6 packet to send.
+            lifetime (float): If not None, the packet is dropped if it is
+                              not sent within lifetime seconds.
+            priority (Priority): The priority class of the packet (c.f. lora_sched).
+
+        Returns:
+            Future: Resolved with the SendStatus of the packet (c.f. LoraMac.mac_submit).
+        """
+
+        payload = self._compress(self.elide_addresses(ipv6_packet), dest)
+        log.info("IP TX {} bytes to {}", len(ipv6_packet), dest)
+        return self.mac_layer.mac_submit(dest, payload, lifetime, priority)
+
+    def _compress(self, payload: bytes, dest: LoraAddr) -> bytes:
+        """Compress the headers of a packet without addresses if the
+        destination has negotiated it (c.f. lora_iphc).
+        """
+
+        if self.mac_layer.capabilities_of(dest) & CAP_IPHC:
+            return lora_iphc.compress(payload)
+        return payload
+
+    @staticmethod
+    def lora_to_packed(addr: LoraAddr) -> bytes:
+        """Convert a LoRaMAC address to a packed IPv6 address (16 bytes).
+
+        Args:
+            addr (LoraAddr): The address to convert.
+
+        Returns:
+            bytes: The converted address.
+        """
+
+        return _PREFIX_TEMPLATES[addr.prefix] + addr.node_id.to_bytes(2, "big")
 
     @staticmethod
+    @functools.lru_cache(maxsize=ADDR_CACHE_SIZE)
     def lora_to_ipv6(addr: LoraAddr) -> IPv6Address:
         """Convert a LoRaMAC address to an IPv6 address.
 
@@ -90,16 +341,7 @@ class LoraIP:
             IPv6Address: The converted address.
         """
 
-        result = IPv6Address(
-            IPv6_PREFIX
-            + "::"
-            + ("%02X:" % addr.prefix)
-            + COMMON_LINK_ADDR_PART
-            + ":"
-            + ("%04x" % addr.node_id)
-        )
-        log.debug("LoraAddr: " + str(addr) + " converted to IPv6: " + result.exploded)
-        return result
+        return IPv6Address(LoraIP.lora_to_packed(addr))
 
     @staticmethod
     def ipv6_to_lora(addr: IPv6Address) -> LoraAddr:
@@ -112,49 +354,108 @@ class LoraIP:
             LoraAddr: The converted address.
         """
 
-        addr_binary = addr.packed
-        prefix = addr_binary[7]
-        node_id = (addr_binary[14] << 8) + addr_binary[15]
-        result = LoraAddr(prefix, node_id)
-        log.debug(f"Ipv6 addr: {addr.exploded} converted to LoraAddr: {result}")
-        return result
+        return LoraIP.packed_to_lora(addr.packed)
 
     @staticmethod
-    def serialize_ip_packet(ip_packet: IPv6)->Tuple[str, LoraAddr, LoraAddr]:
+    @functools.lru_cache(maxsize=ADDR_CACHE_SIZE)
+    def packed_to_lora(packed: bytes) -> LoraAddr:
+        """Convert a packed IPv6 address (16 bytes) to a LoRaMAC address.
+
+        Args:
+            packed (bytes): The address to convert.
+
+        Returns:
+            LoraAddr: The converted address.
+        """
+
+        return LoraAddr(packed[7], (packed[14] << 8) | packed[15])
+
+    @staticmethod
+    def elide_addresses(ipv6_packet: bytes) -> bytes:
+        """Remove the source and destination addresses from an IPv6 packet.
+
+        Args:
+            ipv6_packet (bytes): The IPv6 packet.
+
+        Returns:
+            bytes: The packet without the 32 address bytes.
+        """
+
+        return ipv6_packet[:IPV6_BASE_HEADER_SIZE] + ipv6_packet[IPV6_HEADER_SIZE:]
+
+    @staticmethod
+    def restore_addresses(data: bytes, src_addr: LoraAddr, dest_addr: LoraAddr) -> bytes:
+        """Insert the source and destination addresses in a packet
+        without addresses, decompressing its headers if they are compressed.
+
+        Args:
+            data (bytes): The payload of the LoRaMAC frame.
+            src_addr (LoraAddr): The LoRaMAC source address.
+            dest_addr (LoraAddr): The LoRaMAC destination address.
+
+        Raises:
+            ValueError: If the compressed headers are malformed.
+
+        Returns:
+            bytes: The IPv6 packet.
+        """
+
+        if lora_iphc.is_compressed(data):
+            return lora_iphc.decompress(data, LoraIP.lora_to_packed(src_addr), LoraIP.lora_to_packed(dest_addr))
+        return b"".join((
+            data[:IPV6_BASE_HEADER_SIZE],
+            LoraIP.lora_to_packed(src_addr),
+            LoraIP.lora_to_packed(dest_addr),
+            data[IPV6_BASE_HEADER_SIZE:],
+        ))
+
+    @staticmethod
+    def demux_key(ipv6_packet: bytes) -> Tuple[int, Optional[int]]:
+        """Read the upper layer protocol and the UDP destination port of a
+        packet, without dissecting it.
+
+        Args:
+            ipv6_packet (bytes): The IPv6 packet.
+
+        Returns:
+            tuple: The next header (after the extension headers) and the UDP
+                   destination port (None if not UDP or truncated).
+        """
+
+        next_header = ipv6_packet[IPV6_NH_OFFSET]
+        offset = IPV6_HEADER_SIZE
+        while next_header in EXTENSION_HEADERS and offset + 2 <= len(ipv6_packet):
+            next_header, offset = ipv6_packet[offset], offset + (ipv6_packet[offset + 1] + 1) * 8
+        if next_header != lora_iphc.UDP or offset + UDP_DEST_PORT_OFFSET + 2 > len(ipv6_packet):
+            return next_header, None
+        return next_header, int.from_bytes(ipv6_packet[offset + UDP_DEST_PORT_OFFSET:offset + UDP_DEST_PORT_OFFSET + 2],
+                                           "big")
+
+    @staticmethod
+    def serialize_ip_packet(ip_packet: IPv6)->Tuple[bytes, LoraAddr, LoraAddr]:
         """Serialize an IPv6 packet that will be sent to the LoRaMAC layer.
 
         Args:
             ip_packet (IPv6): The IPv6 packet to serialize
 
         Returns:
-            tuple: A tuple containing the payload (str) and the source and
+            tuple: A tuple containing the payload (bytes) and the source and
                    destination LoraAddr.
 
         """
 
-        hex_packet = (
-            chexdump(ip_packet, dump=True)
-            .replace("0x", "")
-            .replace(",", "")
-            .replace(" ", "")
-            .upper()
-        )
-
-        """remove adresses from the packet"""
-        f1 = hex_packet[0:16]
-        f2 = hex_packet[80:]
-        payload = f1 + f2
-
-        src_addr = LoraIP.ipv6_to_lora(IPv6Address(ip_packet.src))
-        dest_addr = LoraIP.ipv6_to_lora(IPv6Address(ip_packet.dst))
+        raw_packet = bytes(ip_packet)
+        payload = LoraIP.elide_addresses(raw_packet)
+        src_addr = LoraIP.packed_to_lora(raw_packet[IPV6_SRC_OFFSET:IPV6_DEST_OFFSET])
+        dest_addr = LoraIP.packed_to_lora(raw_packet[IPV6_DEST_OFFSET:IPV6_HEADER_SIZE])
         return (payload, src_addr, dest_addr)
 
     @staticmethod
-    def build_ip_packet(hex_data: str, src_addr: LoraAddr, dest_addr: LoraAddr)->IPv6:
+    def build_ip_packet(data: bytes, src_addr: LoraAddr, dest_addr: LoraAddr)->IPv6:
         """Build an IPv6 packet from data extracted from a LoRaMAC frame.
 
         Args:
-            hex_data (str): The payload of the LoRaMAC frame.
+            data (bytes): The payload of the LoRaMAC frame.
             src_addr (LoraAddr): The LoRaMAC source address.
             dest_addr (LoraAddr): The LoRaMAC destination address.
 
@@ -162,19 +463,5 @@ class LoraIP:
             IPv6: The IPv6 packet built.
         """
 
-        """
-        Split the data in two parts:
-            - first_part: The first part of 8 bytes from the IPv6 header that contains the VER, TC, FL, LEN, NH and HL fields.
-            - second_part: The rest of the IPv6 packet after the src and dest address (that are not carried in a loramac frame).
-        """
-        first_part = hex_data[0:16]
-        second_part = hex_data[16:]
-
-        """Create src and dest IPv6 addr from the LoRaMAC addresses"""
-        ip_src_addr = LoraIP.lora_to_ipv6(src_addr).packed.hex().upper()
-        ip_dest_addr = LoraIP.lora_to_ipv6(dest_addr).packed.hex().upper()
-
-        """Construct and return the IPv6 packet built from all the previous data"""
-        raw_data = bytes.fromhex(first_part + ip_src_addr + ip_dest_addr + second_part)
-        result = IPv6(raw_data)
-        return result
+        from scapy.layers.inet6 import IPv6
+        return IPv6(LoraIP.restore_addresses(data, src_addr, dest_addr))
@@ -0,0 +1,219 @@
+"""Compression of the UDP/IPv6 headers, inspired by RFC 6282 (IPHC and UDP NHC).
+
+The addresses are already elided by LoraIP (they are derived from the
+LoRaMAC addresses), the other fields are compressed as follows
+(size in bits):
+
+    |<-4->|<-1->|<-1->|<---2--->|
+    | 0111 | TF  | NH  |  HLIM   |  IPHC byte, followed by the inline fields:
+
+    - TF=1: traffic class and flow label are zero, else the first 4 bytes
+      of the IPv6 header are inline.
+    - NH=1: the next header is UDP and its header is compressed (UDP NHC),
+      else the next header (1 byte) is inline.
+    - HLIM: 01, 10 and 11 for the hop limits 1, 64 and 255, else (00) the
+      hop limit (1 byte) is inline.
+    - The payload length is always elided (derived from the frame length).
+
+    UDP NHC byte: | 11110 | C | PP |
+    - C=1: the checksum is elided and computed again by the receiver.
+    - PP=11: both ports are in WELL_KNOWN_PORTS, one nibble each (1 byte).
+      PP=01: the destination port is 0xF0xx (8 bits) and the source port is inline.
+      PP=10: the source port is 0xF0xx (8 bits) and the destination port is inline.
+      PP=00: both ports are inline (4 bytes).
+    - The length is always elided.
+
+The first byte of a compressed packet (0111xxxx) can not be the first
+byte of an IPv6 packet (version 6), so both formats can be received.
+"""
+import array
+import struct
+import sys
+
+IPHC_DISPATCH = 0x70
+IPHC_DISPATCH_MASK = 0xF0
+IPHC_TF = 0x08
+IPHC_NH = 0x04
+IPHC_HLIM_MASK = 0x03
+HOP_LIMITS = (None, 1, 64, 255)  # HLIM -> hop limit
+
+UDP_NHC = 0xF0
+UDP_NHC_MASK = 0xF8
+UDP_NHC_CHECKSUM = 0x04
+UDP_NHC_PORTS_MASK = 0x03
+PORTS_INLINE = 0b00
+PORTS_DEST_8 = 0b01
+PORTS_SRC_8 = 0b10
+PORTS_WELL_KNOWN = 0b11
+SHORT_PORT_PREFIX = 0xF000
+
+UDP = 17
+IPV6_BASE_HEADER_SIZE = 8  # VER, TC, FL, LEN, NH and HL fields
+UDP_HEADER_SIZE = 8
+
+"""
+The ports compressed to a nibble (index in the tuple), at most 16.
+UDP_SERVER_PORT and UDP_CLIENT_PORT of the examples.
+"""
+WELL_KNOWN_PORTS = (5678, 8765)
+_PORT_INDEX = {port: index for index, port in enumerate(WELL_KNOWN_PORTS)}
+
+IPV6_BASE_HEADER = struct.Struct(">IHBB")
+UDP_HEADER = struct.Struct(">HHHH")
+
+
+def is_compressed(data: bytes) -> bool:
+    """Return True if the data is a compressed packet."""
+    return len(data) > 0 and data[0] & IPHC_DISPATCH_MASK == IPHC_DISPATCH
+
+
+def compress(packet: bytes) -> bytes:
+    """Compress an IPv6 packet without addresses (c.f. LoraIP.elide_addresses).
+
+    Args:
+        packet (bytes): The IPv6 base header without the addresses, followed by the payload.
+
+    Returns:
+        bytes: The compressed packet or the packet unchanged if it can not
+               be compressed (e.g. wrong payload length).
+    """
+    if len(packet) < IPV6_BASE_HEADER_SIZE:
+        return packet
+    first_word, length, next_header, hop_limit = IPV6_BASE_HEADER.unpack_from(packet)
+    payload = packet[IPV6_BASE_HEADER_SIZE:]
+    if first_word >> 28 != 6 or length != len(payload):
+        return packet
+
+    iphc = IPHC_DISPATCH
+    inline = []
+    if first_word & 0x0FFFFFFF == 0:
+        iphc |= IPHC_TF
+    else:
+        inline.append(packet[:4])
+
+    udp = next_header == UDP and len(payload) >= UDP_HEADER_SIZE
+    if udp:
+        src_port, dest_port, udp_length, _ = UDP_HEADER.unpack_from(payload)
+        udp = udp_length == len(payload)
+    if udp:
+        iphc |= IPHC_NH
+    else:
+        inline.append(bytes((next_header,)))
+
+    if hop_limit in HOP_LIMITS:
+        iphc |= HOP_LIMITS.index(hop_limit)
+    else:
+        inline.append(bytes((hop_limit,)))
+
+    if udp:
+        inline.append(_compress_udp(src_port, dest_port))
+        payload = payload[UDP_HEADER_SIZE:]
+    return bytes((iphc,)) + b"".join(inline) + payload
+
+
+def _compress_udp(src_port: int, dest_port: int) -> bytes:
+    nhc = UDP_NHC | UDP_NHC_CHECKSUM
+    if src_port in _PORT_INDEX and dest_port in _PORT_INDEX:
+        return bytes((nhc | PORTS_WELL_KNOWN, _PORT_INDEX[src_port] << 4 | _PORT_INDEX[dest_port]))
+    if dest_port & 0xFF00 == SHORT_PORT_PREFIX:
+        return bytes((nhc | PORTS_DEST_8,)) + struct.pack(">HB", src_port, dest_port & 0xFF)
+    if src_port & 0xFF00 == SHORT_PORT_PREFIX:
+        return bytes((nhc | PORTS_SRC_8,)) + struct.pack(">BH", src_port & 0xFF, dest_port)
+    return bytes((nhc | PORTS_INLINE,)) + struct.pack(">HH", src_port, dest_port)
+
+
+def decompress(data: bytes, src: bytes, dest: bytes) -> bytes:
+    """Decompress a packet and insert the addresses.
+
+    Args:
+        data (bytes): The compressed packet.
+        src (bytes): The packed source IPv6 address.
+        dest (bytes): The packed destination IPv6 address.
+
+    Raises:
+        ValueError: If the packet is truncated or malformed.
+
+    Returns:
+        bytes: The IPv6 packet.
+    """
+    try:
+        iphc = data[0]
+        if iphc & IPHC_DISPATCH_MASK != IPHC_DISPATCH:
+            raise ValueError("not a compressed packet")
+        offset = 1
+        if iphc & IPHC_TF:
+            first_word = 6 << 28
+        else:
+            first_word, = struct.unpack_from(">I", data, offset)
+            offset += 4
+        if iphc & IPHC_NH:
+            next_header = UDP
+        else:
+            next_header = data[offset]
+            offset += 1
+        hop_limit = HOP_LIMITS[iphc & IPHC_HLIM_MASK]
+        if hop_limit is None:
+            hop_limit = data[offset]
+            offset += 1
+
+        if iphc & IPHC_NH:
+            nhc = data[offset]
+            offset += 1
+            if nhc & UDP_NHC_MASK != UDP_NHC:
+                raise ValueError(f"unknown next header compression {nhc:#04x}")
+            ports = nhc & UDP_NHC_PORTS_MASK
+            if ports == PORTS_WELL_KNOWN:
+                src_port = WELL_KNOWN_PORTS[data[offset] >> 4]
+                dest_port = WELL_KNOWN_PORTS[data[offset] & 0x0F]
+                offset += 1
+            elif ports == PORTS_DEST_8:
+                src_port, dest_port = struct.unpack_from(">HB", data, offset)
+                dest_port |= SHORT_PORT_PREFIX
+                offset += 3
+            elif ports == PORTS_SRC_8:
+                src_port, dest_port = struct.unpack_from(">BH", data, offset)
+                src_port |= SHORT_PORT_PREFIX
+                offset += 3
+            else:
+                src_port, dest_port = struct.unpack_from(">HH", data, offset)
+                offset += 4
+            if nhc & UDP_NHC_CHECKSUM:
+                checksum = None
+            else:
+                checksum, = struct.unpack_from(">H", data, offset)
+                offset += 2
+            body = data[offset:]
+            udp_length = UDP_HEADER_SIZE + len(body)
+            if checksum is None:
+                checksum = udp_checksum(src, dest, UDP_HEADER.pack(src_port, dest_port, udp_length, 0) + body)
+            payload = UDP_HEADER.pack(src_port, dest_port, udp_length, checksum) + body
+        else:
+            payload = data[offset:]
+    except (IndexError, struct.error) as e:
+        raise ValueError(f"truncated compressed packet: {e}") from None
+
+    header = IPV6_BASE_HEADER.pack(first_word, len(payload), next_header, hop_limit)
+    return b"".join((header, src, dest, payload))
+
+
+def udp_checksum(src: bytes, dest: bytes, udp: bytes) -> int:
+    """Compute the UDP checksum over the IPv6 pseudo-header (RFC 8200).
+
+    Args:
+        src (bytes): The packed source IPv6 address.
+        dest (bytes): The packed destination IPv6 address.
+        udp (bytes): The UDP header, with a zero checksum, and the payload.
+
+    Returns:
+        int: The checksum (0xFFFF instead of 0).
+    """
+    data = b"".join((src, dest, struct.pack(">IxxxB", len(udp), UDP), udp))
+    if len(data) & 1:
+        data += b"\0"
+    # the one's complement sum does not depend on the byte order, except for the result
+    total = sum(array.array("H", data))
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    if sys.byteorder == "little":
+        total = ((total & 0xFF) << 8) | (total >> 8)
+    return (~total & 0xFFFF) or 0xFFFF
@@ -1,10 +1,22 @@
 from pyloramac.lora_phy import *
-from threading import Timer, Event, Thread, Lock
+from threading import Timer, Event, Thread, Lock, RLock
 from typing import Union, Callable, Type, Tuple
 from operator import add, sub
 import sys
 import time
+import heapq
+import itertools
+import math
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import field
 from loguru import logger as log
+from pyloramac.lora_arq import SendWindow, ReceiveWindow, WINDOW_SIZE, SN_MODULO, HALF_SN_SPACE
+from pyloramac.lora_timer import TimerWheel, RttEstimator
+from pyloramac.lora_state import MacStateLog, SYNC_INTERVAL
+from pyloramac.lora_dutycycle import TokenBucket
+from pyloramac.lora_sched import Priority, TxBuffer, DeficitRoundRobin
+from pyloramac.lora_delivery import DeliveryQueue, DELIVERY_WORKERS, DELIVERY_QUEUE_SIZE
 
 
 #prefix bounds
@@ -19,10 +31,175 @@ ROOT_ID = 0
 MAX_RETRANSMIT = 3 # maximum number of retransmissions
 CHILD_TX_BUF_SIZE = 5 # size of the tx child's buffer
 MIN_WAIT_TIME = 1  # sec
+# a child not heard for CHILD_TIMEOUT seconds (i.e. 60 QUERY periods) is removed and its prefix reused
+CHILD_TIMEOUT = 30 * 60
+# a child drops a duplicate frame and stops listening until its own retransmit timeout:
+# the next retransmissions on timeout are useful only if the previous one was lost too
+MAX_TIMER_RETRANSMIT = 1
+
+#join admission: the JOIN_RESPONSEs are paced by a token bucket of time on air
+JOIN_AIRTIME_RATE = 0.1  # s of time on air per second: the JOINs and QUERYs of the childs get the rest
+JOIN_AIRTIME_BURST = 1.0  # s of time on air that can be spent at once (e.g. after an outage)
+# a child listens LORAMAC_RETRANSMIT_TIMEOUT (12 s) after its JOIN, minus the margin of the response
+JOIN_RESPONSE_WINDOW = 10
+# a child retransmits its JOIN every 12 s, then sleeps up to LORAMAC_MAX_JOIN_SLEEP_TIME (180 s):
+# a pending JOIN keeps its place in the queue until the child is not heard for this time
+PENDING_JOIN_TIMEOUT = 5 * 60
+MAX_PENDING_JOINS = MAX_PREFIX - MIN_PREFIX + 1
+
+#capabilities negotiated at join (bit flags)
+CAP_IPHC = 0x01  # compressed IPv6/UDP headers (c.f. lora_iphc)
+CAP_FRAG = 0x02  # fragmented packets (c.f. lora_frag)
+CAP_AGGREGATE = 0x04  # AGGREGATE frames
+CAP_WINDOW = 0x08  # sliding window ARQ (c.f. lora_arq)
+ROOT_CAPABILITIES = CAP_IPHC | CAP_FRAG | CAP_AGGREGATE | CAP_WINDOW  # capabilities offered by the root
+
+AGGREGATE_LENGTH_SIZE = 1  # bytes before each payload of an AGGREGATE frame
+
+
+@unique
+class SendStatus(Enum):
+    """The outcome of a payload given to LoraMac.mac_submit (the result of its future)."""
+
+    DELIVERED = auto()  # acknowledged by the child
+    FAILED = auto()  # not acknowledged after MAX_RETRANSMIT retransmissions
+    EXPIRED = auto()  # not sent before the end of its lifetime
+    DROPPED = auto()  # dropped from the TX buffer (drop policy, child removed)
+    REJECTED = auto()  # not queued (TX buffer full with DropPolicy.REJECT, payload too large)
+    UNREACHABLE = auto()  # unknown destination
+
+
+@unique
+class DropPolicy(Enum):
+    """What LoraMac.mac_submit does when the TX buffer of the child is full."""
+
+    DROP_OLDEST = auto()  # the oldest queued payloads are dropped to make room
+    DROP_NEWEST = auto()  # the new payload is dropped (drop tail)
+    REJECT = auto()  # the new payload is refused, the caller can submit it again later
+
+
+def done_future(status: SendStatus) -> Future:
+    """Return a future already resolved with status."""
+    future = Future()
+    future.set_result(status)
+    return future
+
+
+def aggregate(payloads: list) -> bytes:
+    """Build the payload of an AGGREGATE frame.
+
+    Each payload is preceded by its length (1 byte):
+
+    |<--1--->|<--len1-->|<--1--->|<--len2-->|
+    |  len1  | payload1 |  len2  | payload2 | ...
+
+    Args:
+        payloads (list): The payloads (bytes) to aggregate.
+
+    Returns:
+        bytes: The payload of the AGGREGATE frame.
+    """
+    return b"".join(bytes((len(payload),)) + payload for payload in payloads)
+
+
+def deaggregate(data: bytes) -> list:
+    """Split the payload of an AGGREGATE frame.
+
+    Args:
+        data (bytes): The payload of the AGGREGATE frame.
+
+    Raises:
+        ValueError: If a payload is truncated.
+
+    Returns:
+        list: The payloads (bytes).
+    """
+    payloads = []
+    offset = 0
+    while offset < len(data):
+        end = offset + AGGREGATE_LENGTH_SIZE + data[offset]
+        if end > len(data):
+            raise ValueError(f"truncated payload in AGGREGATE frame ({end - len(data)} bytes missing)")
+        payloads.append(data[offset + AGGREGATE_LENGTH_SIZE:end])
+        offset = end
+    return payloads
+
+
+@dataclass
+class PendingResponse:
+    """A frame sent to a child that answers it at once (e.g. with has_next).
+
+    Attributes:
+        frame: The frame.
+        sent_at: The estimated end of the last transmission of the frame.
+        transmissions: The number of times the frame has been sent.
+        timer: The retransmission timer.
+    """
+
+    frame: LoraFrame
+    sent_at: float
+    transmissions: int = 1
+    timer: object = None
+
+
+@dataclass
+class PendingJoin:
+    """A JOIN waiting for its admission.
+
+    Attributes:
+        frame: The last JOIN frame received.
+        heard_at: The time of reception of the frame.
+    """
+
+    frame: LoraFrame
+    heard_at: float
+
+
+class Submission:
+    """The frames of one call to mac_submit or mac_submit_all.
+
+    Attributes:
+        future: Resolved with DELIVERED when all the frames are
+                acknowledged, else with the status of the first frame lost.
+        remaining: The number of frames not acknowledged yet.
+    """
+
+    __slots__ = ("future", "remaining")
+
+    def __init__(self, frames: int):
+        self.future = Future()
+        self.remaining = frames
+
+    def resolve(self, status: SendStatus):
+        if status == SendStatus.DELIVERED:
+            self.remaining -= 1
+            if self.remaining > 0:
+                return
+        # a future cancelled by the caller is left as is
+        if not self.future.done() and self.future.set_running_or_notify_cancel():
+            self.future.set_result(status)
+
+
+@dataclass
+class QueuedFrame(LoraFrame):
+    """A DATA (or AGGREGATE) frame of the TX buffer of a child.
+
+    Attributes:
+        submissions: The submissions of the payloads carried by the frame.
+        expiry: The timer that drops the frame at the end of its lifetime.
+        priority: The priority class of the frame in the TX buffer (c.f. lora_sched).
+        follows: True if the frame follows the previous one of the same
+                 packet (fragments): it is not deferred by the round robin.
+    """
+
+    submissions: tuple = field(default=(), repr=False, compare=False)
+    expiry: object = field(default=None, repr=False, compare=False)
+    priority: int = field(default=Priority.NORMAL, repr=False, compare=False)
+    follows: bool = field(default=False, repr=False, compare=False)
 
 
 class LoraChild:
-    def __init__(self, addr: LoraAddr):
+    def __init__(self, addr: LoraAddr, tx_buf_size: int = CHILD_TX_BUF_SIZE):
         self.addr = addr  # child's address
 
         #begin at 1. the sn expected after join
@@ -30,11 +207,30 @@ class LoraChild:
         self._next_sn = 0  # SN for next sent frame
 
         self.last_send_frame: LoraFrame = None  # last sent frame
-        self.tx_buf = queue.Queue(CHILD_TX_BUF_SIZE)  # tx buffer
+        self.tx_buf = TxBuffer(tx_buf_size)  # tx buffer, a FIFO per priority class
+        self.drop_policy = DropPolicy.REJECT  # when mac_submit finds the tx buffer full
 
         self.transmit_count = 0 # number of retransmit
         self.not_send_count = 0 # for stat
 
+        self.capabilities = 0  # capabilities negotiated at join (CAP_* flags)
+
+        # sliding windows, if CAP_WINDOW is negotiated (else stop and wait)
+        self.tx_window: SendWindow = None
+        self.rx_window: ReceiveWindow = None
+
+        self.last_seen = 0.0  # time of the last frame received from the child
+        self.rtt = RttEstimator()  # RTT and retransmission timeout
+        self.pending_response: PendingResponse = None  # frame waiting for the answer of the child
+        self.retransmissions = 0  # for stat: frames sent again
+        self.join_addr: LoraAddr = None  # source address of the JOIN (initial prefix)
+
+    @property
+    def max_payload(self) -> int:
+        """The maximum size of a payload for the child, room is kept for the
+        ACK field if the frames carry it (CAP_WINDOW)."""
+        return MAX_PAYLOAD_SIZE if self.rx_window is None else MAX_ACK_PAYLOAD_SIZE
+
     def clear_transmit_count(self):
         self.transmit_count = 0
 
@@ -66,12 +262,46 @@ class LoraChild:
 
 
 class LoraMac:
-    def __init__(self, phy_layer: LoraPhy):
+    def __init__(self, phy_layer: LoraPhy, threaded: bool = True, window_size: int = WINDOW_SIZE,
+                 child_timeout: float = CHILD_TIMEOUT, state_path: str = None,
+                 join_rate: float = JOIN_AIRTIME_RATE, tx_buf_size: int = CHILD_TX_BUF_SIZE,
+                 drop_policy: DropPolicy = DropPolicy.REJECT, delivery_workers: int = None,
+                 delivery_queue_size: int = DELIVERY_QUEUE_SIZE, delivery_executor: ThreadPoolExecutor = None,
+                 clock: Callable[[], float] = time.monotonic):
         self.phy_layer = phy_layer  # PHY layer
+        # if False, no RX thread is started and the frames are pushed by the PHY layer,
+        # the owner must then call poll_timers() (c.f. TimerWheel.on_start)
+        self.threaded = threaded
+        self.clock = clock
+        self.timers = TimerWheel(clock=clock)  # retransmission timers
+        self._lock = RLock()  # for the frames processing and the timers
+        self._timer_event = Event()
+        self._tx_end = 0.0  # estimated end of the transmission of the last frame sent
+        self.window_size = window_size  # frames in flight with the childs that negotiate CAP_WINDOW
+        # TX buffer of the new childs (c.f. set_tx_policy)
+        self.tx_buf_size = tx_buf_size
+        self.drop_policy = drop_policy
+        # share of the time on air between the childs, a quantum of one frame of the largest size per round
+        self.scheduler = DeficitRoundRobin(phy_layer.scheduler.airtime(MAX_FRAME_SIZE), clock=clock)
 
-        # Contains all childs that didn't finish de join procedure(prefix:child)
+        # Contains all childs that didn't finish de join procedure(JOIN source address:child)
         self.not_joined_childs = {}
         self.childs = {}  # Contains all childs (prefix:child)
+        self._by_node_id = {}  # the same childs (node_id:child), to find the child of a node that joins again
+        self.child_timeout = child_timeout
+        # (deadline, n, child): the childs by time of eviction if they stay silent,
+        # the deadline is pushed back lazily when it expires
+        self._idle = []
+        self._idle_order = itertools.count()
+        self._free_prefixes = []  # heap of the prefixes released by evicted childs
+        # the JOINs not answered yet (source address:PendingJoin), in their order of arrival
+        self.pending_joins = OrderedDict()
+        self.join_bucket = TokenBucket(join_rate, JOIN_AIRTIME_BURST, clock)
+        self._join_timer = None
+        self.stats = {"evicted": 0, "refused": 0, "join_duplicates": 0, "joins_expired": 0, "rebooted": 0}
+        # the child table is saved in this log and restored at init (c.f. lora_state), None to disable
+        self.state = MacStateLog(state_path, clock=clock) if state_path else None
+        self._sync_timer = None  # syncs the state log SYNC_INTERVAL after an unsynced record
 
         self.addr = LoraAddr(ROOT_PREFIX, ROOT_ID)  # node address
         self.action_matcher = {
@@ -79,48 +309,349 @@ class LoraMac:
             MacCommand.JOIN: self._on_join,
             MacCommand.QUERY: self._on_query,
             MacCommand.DATA: self._on_data,
+            MacCommand.AGGREGATE: self._on_data,
         }
         self.next_prefix = MIN_PREFIX  # next prefix to use for new child
+        self.capabilities = ROOT_CAPABILITIES  # capabilities offered to the new childs
 
         self.listen_lock = Lock()  # lock for can_listen and listen
         self.upper_layer = None
+        # the payloads are delivered to the upper layer by a pool of workers, so that the radio
+        # listens again without waiting for the application (in the calling thread if not threaded)
+        if delivery_workers is None:
+            delivery_workers = DELIVERY_WORKERS if threaded else 0
+        self.delivery = DeliveryQueue(delivery_workers, delivery_queue_size, delivery_executor, clock)
 
     def init(self):
         """Init the MAC layer.
         
+        - Restore the childs saved in the state log, if any
         - Init the PHY layer
         - Listen
         """
         log.info("Init MAC")
+        if self.state is not None:
+            self._restore()
+        if not self.threaded:
+            self.phy_layer.register_listener(self.process_frame)
         self.phy_layer.init()
+        # no radio watchdog: the radio listens until a frame is received, the reception
+        # is stopped (radio rxstop) when a frame must be sent (c.f. LoraPhy.phy_send)
         self.phy_layer.phy_timeout(0)
         self._listen()
 
-        tx_thread = Thread(target=self._rx_process)
-        tx_thread.start()
+        if self.threaded:
+            self.timers.on_start = self._timer_event.set
+            rx_thread = Thread(target=self._rx_process)
+            rx_thread.start()
+            timer_thread = Thread(target=self._timer_process, daemon=True)
+            timer_thread.start()
+
+    def poll_timers(self):
+        """Run the expired retransmission timers.
 
-    def mac_send(self, dest:LoraAddr, payload:str):
+        Returns:
+            Optional[float]: The delay (in seconds) before the next call,
+                             None if no timer is pending.
+        """
+        with self._lock:
+            return self.timers.advance()
+
+    def rtt_stats(self) -> dict:
+        """Return the RTT estimation and the retransmissions of each child.
+
+        Returns:
+            dict: LoraAddr -> dict (srtt, rttvar, rto, samples, retransmissions).
+        """
+        return {child.addr: {**child.rtt.to_dict(), "retransmissions": child.retransmissions}
+                for child in list(self.childs.values())}
+
+    def mac_send(self, dest:LoraAddr, payload:bytes, block:bool=True) -> bool:
         """Send a payload to the destination dest.
         If The TX buffer is full, block until a slot becomes available.
 
         Args:
             dest (LoraAddr): The destination address.
-            payload (str): The data to be sent.
+            payload (bytes): The data to be sent.
+            block (bool): If False, raise queue.Full instead of blocking
+                          when the TX buffer is full.
+
+        Returns:
+            bool: True if the payload has been queued, False if the
+                  destination is unreachable.
         """
         try:
             child = self.childs[dest.prefix]
-            child.tx_buf.put(LoraFrame(self.addr, dest, MacCommand.DATA, payload))
         except KeyError:
             log.error(f"Destination {dest} unreachable")
+            return False
+        if len(payload) > child.max_payload:
+            log.error(f"Payload of {len(payload)} bytes too large for a frame to {child} (max {child.max_payload})")
+            return False
+        child.tx_buf.put(QueuedFrame(self.addr, dest, MacCommand.DATA, payload), block=block)
+        with self._lock:  # the RX thread changes the child
+            self._save(child)
+        return True
+
+    def mac_send_all(self, dest: LoraAddr, payloads: list, block: bool = True) -> bool:
+        """Send several payloads to the destination dest, one frame each.
 
-    def register_listener(self, listener: Callable[[LoraAddr, str], None]):
+        The frames are queued in order, so that they are sent back to back
+        (with the has_next flag) when the child polls. If block is False,
+        either all the frames are queued or none.
+
+        Args:
+            dest (LoraAddr): The destination address.
+            payloads (list): The payloads (bytes) to send.
+            block (bool): If False, raise queue.Full instead of blocking
+                          when the TX buffer can not hold all the frames.
+
+        Returns:
+            bool: True if the payloads have been queued, False if the
+                  destination is unreachable or if the TX buffer is too
+                  small for the frames and block is False.
+        """
+        try:
+            child = self.childs[dest.prefix]
+        except KeyError:
+            log.error(f"Destination {dest} unreachable")
+            return False
+        too_large = [len(payload) for payload in payloads if len(payload) > child.max_payload]
+        if too_large:
+            log.error(f"Payload of {too_large[0]} bytes too large for a frame to {child} (max {child.max_payload})")
+            return False
+        frames = [QueuedFrame(self.addr, dest, MacCommand.DATA, payload, follows=i > 0)
+                  for i, payload in enumerate(payloads)]
+        if block:
+            for frame in frames:
+                child.tx_buf.put(frame)
+            with self._lock:
+                self._save(child)
+            return True
+
+        tx_buf = child.tx_buf
+        if len(frames) > tx_buf.maxsize > 0:
+            log.error(f"{len(frames)} frames can not fit in the TX buffer of {child}")
+            return False
+        with tx_buf.not_full:
+            if 0 < tx_buf.maxsize < len(tx_buf) + len(frames):
+                raise queue.Full
+            tx_buf.extend(frames)
+        with self._lock:
+            self._save(child)
+        return True
+
+    def mac_submit(self, dest: LoraAddr, payload: bytes, lifetime: float = None,
+                   priority: Priority = Priority.NORMAL) -> Future:
+        """Send a payload to the destination dest, without blocking.
+
+        If the TX buffer of the child is full, its drop policy applies (c.f.
+        set_tx_policy). The future is resolved with a SendStatus. The
+        callbacks of the future are called by the MAC layer (with its lock
+        held): they must not block.
+
+        A frame is acknowledged by the next frame of the child (stop and
+        wait) or by its ACK field (CAP_WINDOW). The payloads in the TX
+        buffer are not saved with their future: after a restart of the root
+        they are sent without one.
+
+        Args:
+            dest (LoraAddr): The destination address.
+            payload (bytes): The data to be sent.
+            lifetime (float): If not None, the payload is dropped (EXPIRED)
+                              if it is not sent within lifetime seconds.
+            priority (Priority): The priority class of the payload in the
+                                 TX buffer (c.f. lora_sched).
+
+        Returns:
+            Future: Resolved with the SendStatus of the payload.
+        """
+        return self.mac_submit_all(dest, [payload], lifetime, priority)
+
+    def mac_submit_all(self, dest: LoraAddr, payloads: list, lifetime: float = None,
+                       priority: Priority = Priority.NORMAL) -> Future:
+        """Send several payloads to the destination dest, one frame each, without blocking.
+
+        Either all the frames are queued or none (c.f. mac_send_all). The
+        future is resolved with DELIVERED when all the frames are
+        acknowledged, else with the status of the first frame lost.
+
+        Args:
+            dest (LoraAddr): The destination address.
+            payloads (list): The payloads (bytes) to send.
+            lifetime (float): If not None, the frames not sent within
+                              lifetime seconds are dropped (EXPIRED).
+            priority (Priority): The priority class of the frames.
+
+        Returns:
+            Future: Resolved with the SendStatus of the payloads.
+        """
+        with self._lock:
+            child = self.childs.get(dest.prefix, None)
+            if child is None:
+                log.error(f"Destination {dest} unreachable")
+                return done_future(SendStatus.UNREACHABLE)
+            too_large = [len(payload) for payload in payloads if len(payload) > child.max_payload]
+            if too_large:
+                log.error(f"Payload of {too_large[0]} bytes too large for a frame to {child} (max {child.max_payload})")
+                return done_future(SendStatus.REJECTED)
+            submission = Submission(len(payloads))
+            frames = [QueuedFrame(self.addr, dest, MacCommand.DATA, payload, submissions=(submission,),
+                                  priority=priority, follows=i > 0) for i, payload in enumerate(payloads)]
+            if not self._make_room(child, frames):
+                return submission.future
+            with child.tx_buf.mutex:
+                child.tx_buf.extend(frames)
+            if lifetime is not None:
+                for frame in frames:
+                    frame.expiry = self.timers.schedule(lifetime, lambda frame=frame: self._on_expiry(child, frame))
+            self._save(child)
+            return submission.future
+
+    def _make_room(self, child: LoraChild, frames: list) -> bool:
+        """Apply the drop policy of a child to queue new frames.
+
+        Returns:
+            bool: True if the frames can be queued, False if they are
+                  dropped or rejected (their submission is resolved).
+        """
+        tx_buf = child.tx_buf
+        with tx_buf.mutex:
+            excess = len(tx_buf) + len(frames) - tx_buf.maxsize
+            if excess <= 0:
+                return True
+            if len(frames) > tx_buf.maxsize or child.drop_policy == DropPolicy.REJECT:
+                dropped, status = [], SendStatus.REJECTED
+            elif child.drop_policy == DropPolicy.DROP_NEWEST:
+                dropped, status = [], SendStatus.DROPPED
+            else:
+                # never a frame of a higher class than the new ones
+                dropped = tx_buf.drop_oldest(excess, frames[0].priority)
+                status = None if dropped else SendStatus.DROPPED
+        for frame in dropped:
+            log.info(f"TX buffer of {child} full -> oldest frame dropped")
+            self._resolve(frame, SendStatus.DROPPED)
+        if status is None:
+            return True
+        log.info(f"TX buffer of {child} full -> {len(frames)} frames {status.name.lower()}")
+        for frame in frames:
+            self._resolve(frame, status)
+        return False
+
+    def set_tx_policy(self, addr: LoraAddr, size: int = None, policy: DropPolicy = None) -> bool:
+        """Set the size of the TX buffer of a child and what mac_submit does when it is full.
+
+        Args:
+            addr (LoraAddr): The address of the child.
+            size (int): The maximum number of frames in the TX buffer, None to keep it.
+            policy (DropPolicy): The drop policy, None to keep it.
+
+        Returns:
+            bool: False if the child is unknown.
+        """
+        if size is not None and size < 1:
+            raise ValueError(f"invalid TX buffer size {size}: must be at least 1")
+        with self._lock:
+            child = self.childs.get(addr.prefix, None)
+            if child is None:
+                return False
+            if size is not None:
+                with child.tx_buf.mutex:
+                    child.tx_buf.maxsize = size
+                    child.tx_buf.not_full.notify_all()
+            if policy is not None:
+                child.drop_policy = policy
+            return True
+
+    def _resolve(self, frame: LoraFrame, status: SendStatus):
+        """Resolve the submissions of the payloads carried by a frame."""
+        if not isinstance(frame, QueuedFrame):
+            return  # ACK, JOIN_RESPONSE
+        if frame.expiry is not None:
+            frame.expiry.cancel()
+            frame.expiry = None
+        submissions, frame.submissions = frame.submissions, ()
+        for submission in submissions:
+            submission.resolve(status)
+
+    def _on_expiry(self, child: LoraChild, frame: QueuedFrame):
+        """Drop a frame not sent at the end of its lifetime."""
+        frame.expiry = None
+        with child.tx_buf.mutex:
+            if not child.tx_buf.remove(frame):
+                return  # sent
+        log.info(f"Frame for {child} expired")
+        if child.tx_buf.empty():
+            self.scheduler.idle(child)
+        self._resolve(frame, SendStatus.EXPIRED)
+        self._save(child)
+
+    def _dequeue(self, child: LoraChild, count: int):
+        """Remove the first count frames of the TX buffer of a child, to send them."""
+        for _ in range(count):
+            frame = child.tx_buf.get_nowait()
+            if frame.expiry is not None:
+                frame.expiry.cancel()
+                frame.expiry = None
+        if child.tx_buf.empty():
+            self.scheduler.idle(child)
+
+    def _schedule(self, child: LoraChild, frame: QueuedFrame) -> bool:
+        """Ask the round robin if a frame can be sent to a child that polls (c.f. lora_sched)."""
+        airtime = self.phy_layer.airtime(frame)
+        if frame.priority == Priority.CONTROL or frame.follows:
+            # not deferred, the child pays in the next rounds
+            self.scheduler.charge(child, airtime)
+            return True
+        return self.scheduler.visit(child, airtime)
+
+    def _has_next(self, child: LoraChild) -> bool:
+        """Return True if the child can poll again at once: it has a frame that can be sent."""
+        next_frame, _ = self._next_data_frame(child)
+        if next_frame is None:
+            return False
+        return next_frame.priority == Priority.CONTROL or next_frame.follows or \
+            self.scheduler.would_allow(child, self.phy_layer.airtime(next_frame))
+
+    def capabilities_of(self, addr: LoraAddr) -> int:
+        """Return the capabilities negotiated with a child.
+
+        Args:
+            addr (LoraAddr): The address of the child.
+
+        Returns:
+            int: The CAP_* flags, 0 if the child is unknown.
+        """
+        child = self.childs.get(addr.prefix, None)
+        return child.capabilities if child is not None else 0
+
+    def max_payload_of(self, addr: LoraAddr) -> int:
+        """Return the maximum size of a payload for a child (c.f. LoraChild.max_payload).
+
+        Args:
+            addr (LoraAddr): The address of the child.
+
+        Returns:
+            int: The size in bytes, MAX_PAYLOAD_SIZE if the child is unknown.
+        """
+        child = self.childs.get(addr.prefix, None)
+        return child.max_payload if child is not None else MAX_PAYLOAD_SIZE
+
+    def register_listener(self, listener: Callable[[LoraAddr, bytes], None]):
         """Register a listener that will be called when data is available
         for upper layer.
 
         Args:
-            listener (Callable[[LoraAddr, str], None]): The listener.
+            listener (Callable[[LoraAddr, bytes], None]): The listener.
         """
         self.upper_layer = listener
+        self.delivery.listener = listener
+
+    def delivery_stats(self) -> dict:
+        """Return the depth of the delivery queue, its counters and the
+        latencies of the delivery (c.f. DeliveryQueue.metrics).
+        """
+        return self.delivery.metrics()
 
     def _on_query(self, frame: LoraFrame, child: LoraChild):
         """Process a query frame.
@@ -129,11 +660,14 @@ class LoraMac:
             frame (LoraFrame): The LoRa frame to process.
             child (LoraChild): The child that send the frame.
         """
-        log.info(f"RECEIVE QUERY frame {frame}")
+        log.debug("RECEIVE QUERY frame {}", frame)
         if child is None:
             log.warning("UNKNOWN CHILD")
             self._listen()
             return
+        if child.rx_window is not None:
+            self._on_window_frame(frame, child)
+            return
 
         r = child.compare_update_expected_sn(frame.seq)
         if r < 0:
@@ -143,29 +677,249 @@ class LoraMac:
             return
         if r > 0:
             log.info(f"received sn: {frame.seq} expected sn: {child.expected_sn}")
+        # a new frame of the child acknowledges the last frame sent to it
+        self._resolve(child.last_send_frame, SendStatus.DELIVERED)
         
-        if frame.payload is not None and frame.payload != "":
+        if frame.payload:
             # The frame can contain data
-            self.upper_layer(frame.src_addr, frame.payload) #deliver data to upper layer
+            self.delivery.put(frame.src_addr, frame.payload) #deliver data to upper layer
+
+        self._respond(child, frame)
+        self._listen()
 
-        if child.tx_buf.empty():  # no data for this child -> send an ack
+    def remaining_budget(self) -> float:
+        """Return the remaining time on air (in seconds) allowed by the duty-cycle limit."""
+        return self.phy_layer.remaining_budget()
+
+    def _respond(self, child: LoraChild, frame: LoraFrame):
+        """Respond to a frame that needs a response.
+
+        If data is available for the child and the duty-cycle budget allows
+        it, the next data frame is sent: it also acknowledges the received
+        frame. Otherwise an ACK is sent and the data is deferred.
+        If the child has negotiated CAP_AGGREGATE, the next data frames that
+        fit in one frame are sent together in an AGGREGATE frame.
+
+        Args:
+            child (LoraChild): The child that send the frame.
+            frame (LoraFrame): The received frame.
+        """
+        if child.tx_window is not None:
+            self._send_burst(child, frame)
+            return
+
+        next_frame, count = self._next_data_frame(child)
+        if next_frame is None:  # no data for this child -> send an ack
             log.debug("child buffer empty -> SEND ack")
-            self._send_ack(child, frame.src_addr, frame.seq)
-            self._listen()
-        else: # data available for this child
-            try:
-                next_frame = child.tx_buf.get_nowait()
-            except queue.Empty:
-                self._send_ack(child, frame.src_addr, frame.seq)
-                self._listen()
-            
+        elif not self.phy_layer.can_send(next_frame):
+            log.info(f"Duty-cycle budget exhausted -> data for {child} deferred")
+        elif not self._schedule(child, next_frame):
+            log.info(f"Share of time on air used -> data for {child} deferred to the next round")
+        else:  # data available for this child
+            self._dequeue(child, count)
             next_frame.seq = child.get_sn()
-            next_frame.has_next = not child.tx_buf.empty()
-            log.info(f"MAC TX: {next_frame}")
-            self.phy_layer.phy_send(next_frame)  # send the frame
+            next_frame.has_next = self._has_next(child)
             child.last_send_frame = next_frame  # set the frame as last frame
-            self._listen()
-            
+            self._phy_send(next_frame)
+            return
+
+        self._send_ack(child, frame.src_addr, frame.seq)
+
+    def _next_data_frame(self, child: LoraChild) -> tuple:
+        """Return the next frame to send to a child, without removing it from the TX buffer.
+
+        If the child has negotiated CAP_AGGREGATE, the queued frames that
+        fit in one frame are aggregated.
+
+        Returns:
+            tuple: The frame (None if the TX buffer is empty) and the number
+                   of queued frames that it contains.
+        """
+        with child.tx_buf.mutex:
+            if child.capabilities & CAP_AGGREGATE:
+                frames = self._aggregated_frames(child.tx_buf.frames(), child.max_payload)
+            else:
+                frames = [next(child.tx_buf.frames())] if len(child.tx_buf) else []
+
+        if len(frames) > 1:
+            return QueuedFrame(self.addr, child.addr, MacCommand.AGGREGATE, aggregate([f.payload for f in frames]),
+                               submissions=tuple(s for f in frames for s in f.submissions),
+                               priority=frames[0].priority, follows=frames[0].follows), len(frames)
+        return (frames[0], 1) if frames else (None, 0)
+
+    def _send_burst(self, child: LoraChild, frame: LoraFrame):
+        """Respond to a frame of a child that has negotiated CAP_WINDOW.
+
+        The frames not acknowledged are sent again, followed by new frames
+        while the window has room, back to back (with the burst flag). Each
+        frame carries the ACK field of the frames received from the child.
+        If there is nothing to send, an ACK is sent.
+
+        Args:
+            child (LoraChild): The child that send the frame.
+            frame (LoraFrame): The received frame, None for a retransmission timeout.
+        """
+        window = child.tx_window
+        given_up = []
+        burst = window.to_retransmit(given_up)
+        for lost in given_up:
+            self._resolve(lost, SendStatus.FAILED)
+        for next_frame in burst:
+            self.scheduler.charge(child, self.phy_layer.airtime(next_frame))
+        while window.has_room():
+            next_frame, count = self._next_data_frame(child)
+            if next_frame is None:
+                break
+            if not self.phy_layer.can_send(next_frame):
+                log.info(f"Duty-cycle budget exhausted -> data for {child} deferred")
+                break
+            if not self._schedule(child, next_frame):
+                log.info(f"Share of time on air used -> data for {child} deferred to the next round")
+                break
+            self._dequeue(child, count)
+            next_frame.seq = child.get_sn()
+            window.add(next_frame)
+            burst.append(next_frame)
+
+        if not burst:
+            if frame is not None:
+                self._send_ack(child, frame.src_addr, frame.seq)
+            return
+        ack = child.rx_window.ack()
+        has_next = self._has_next(child)
+        for i, next_frame in enumerate(burst):
+            next_frame.ack = ack
+            next_frame.burst = i < len(burst) - 1
+            next_frame.has_next = has_next
+            if not self._phy_send(next_frame):
+                break  # the child stops listening after its burst timeout
+            window.sent(next_frame)
+            child.last_send_frame = next_frame
+
+    def _on_window_frame(self, frame: LoraFrame, child: LoraChild):
+        """Process a QUERY or data frame of a child that has negotiated CAP_WINDOW.
+
+        The frames are delivered once, in the order of reception. The QUERY
+        frames and the frames with the k flag are answered by a burst.
+
+        Args:
+            frame (LoraFrame): The LoRa frame to process
+            child (LoraChild): The child that send the frame
+        """
+        new = child.rx_window.accept(frame.seq)
+        if not new:
+            log.info(f"Duplicate frame {frame.seq} from {child}")
+        if frame.command == MacCommand.QUERY or frame.k:
+            self._respond(child, frame)
+        if new and (frame.payload or frame.command != MacCommand.QUERY):
+            self._deliver(frame)
+        self._listen()
+
+    def _deliver(self, frame: LoraFrame):
+        """Deliver the payload(s) of a frame to the upper layer."""
+        if frame.command == MacCommand.AGGREGATE:
+            try:
+                payloads = deaggregate(frame.payload)
+            except ValueError as e:
+                log.warning(f"Invalid AGGREGATE frame from {frame.src_addr}: {e}")
+                payloads = []
+            for payload in payloads:
+                self.delivery.put(frame.src_addr, payload)
+        else:
+            self.delivery.put(frame.src_addr, frame.payload) #deliver data to upper layer
+
+    @staticmethod
+    def _aggregated_frames(frames, max_payload: int) -> list:
+        """Return the first frames whose payloads fit in one AGGREGATE frame.
+
+        Args:
+            frames (Iterable[LoraFrame]): The queued frames.
+            max_payload (int): The maximum size of the AGGREGATE payload.
+
+        Returns:
+            list: The frames, at least the first one (if any).
+        """
+        selected = []
+        size = 0
+        for frame in frames:
+            size += AGGREGATE_LENGTH_SIZE + len(frame.payload)
+            if selected and size > max_payload:
+                break
+            selected.append(frame)
+        return selected
+
+    def _phy_send(self, frame: LoraFrame) -> bool:
+        """Send a frame to the PHY layer if the duty-cycle budget allows it.
+
+        Args:
+            frame (LoraFrame): The frame to send.
+
+        Returns:
+            bool: True if the frame has been queued by the PHY layer, False
+                  if the budget is exhausted or if the PHY layer dropped it.
+        """
+        if not self.phy_layer.can_send(frame):
+            log.warning(f"Duty-cycle budget exhausted -> {frame.command.name} not sent")
+            return False
+        log.debug("MAC TX: {}", frame)
+        if not self.phy_layer.phy_send(frame):
+            log.warning(f"{frame.command.name} dropped by the PHY layer")
+            return False
+        # the frame is sent after the turnaround gap and the frames already queued
+        now = self.clock()
+        self._tx_end = max(now + self.phy_layer.scheduler.delay(), self._tx_end) + self.phy_layer.airtime(frame)
+        if frame.has_next and not frame.burst:
+            # the child answers at once with a QUERY
+            child = self.childs.get(frame.dest_addr.prefix, None)
+            if child is not None:
+                self._wait_response(child, frame)
+        return True
+
+    def _wait_response(self, child: LoraChild, frame: LoraFrame):
+        """Start the retransmission timer of a frame that the child answers at once."""
+        pending = child.pending_response
+        if pending is not None and pending.frame is frame:
+            pending.transmissions += 1
+            child.retransmissions += 1
+        else:
+            pending = child.pending_response = PendingResponse(frame, 0.0)
+        if pending.timer is not None:
+            pending.timer.cancel()
+        pending.sent_at = self._tx_end
+        delay = self._tx_end - self.clock() + child.rtt.rto
+        pending.timer = self.timers.schedule(delay, lambda: self._on_response_timeout(child, frame))
+
+    def _on_response(self, child: LoraChild):
+        """Stop the retransmission timer when a frame of the child is received."""
+        pending = child.pending_response
+        if pending is None:
+            return
+        child.pending_response = None
+        pending.timer.cancel()
+        if pending.transmissions == 1:  # Karn's rule
+            child.rtt.sample(self.clock() - pending.sent_at)
+
+    def _on_response_timeout(self, child: LoraChild, frame: LoraFrame):
+        """Send again a frame not answered by the child before the timeout."""
+        pending = child.pending_response
+        if pending is None or pending.frame is not frame:
+            return
+        pending.timer = None
+        if pending.transmissions > MAX_TIMER_RETRANSMIT:
+            log.info(f"No response of {child} after the retransmission -> wait for the child")
+            child.pending_response = None
+            return
+        child.rtt.backoff()
+        log.info(f"Retransmission timeout for {child} (RTO {child.rtt.rto:.1f} s)")
+        if child.tx_window is not None:
+            child.pending_response = None
+            child.retransmissions += 1
+            self._send_burst(child, None)
+            self._save(child)
+        elif not self._phy_send(frame):
+            child.pending_response = None
+        self._listen()
+
     def _listen(self):
         self.listen_lock.acquire()
         if not self.phy_layer.listen():
@@ -178,21 +932,22 @@ class LoraMac:
             log.info("No frame to retransmit")
             return
         if child.transmit_count < MAX_RETRANSMIT:
-            log.info(f"MAC TX: {child.last_send_frame}")
-            self.phy_layer.phy_send(child.last_send_frame)
-            child.transmit_count += 1
+            if self._phy_send(child.last_send_frame):
+                child.transmit_count += 1
         else:
             child.clear_transmit_count()
             child.not_send_count += 1
+            self._resolve(child.last_send_frame, SendStatus.FAILED)
 
     def _send_ack(self, child:LoraChild, dest_addr:LoraAddr, sn:int):
-        ack = LoraFrame(self.addr, child.addr, MacCommand.ACK, "", sn)
-        log.info(f"MAC TX: {ack})")
-        self.phy_layer.phy_send(ack)
+        ack = LoraFrame(self.addr, child.addr, MacCommand.ACK, b"", sn)
+        if child.rx_window is not None:
+            ack.ack = child.rx_window.ack()
         child.last_send_frame = ack
+        self._phy_send(ack)
 
     def _on_data(self, frame: LoraFrame, child: LoraChild):
-        """Process a data frame.
+        """Process a data frame (DATA or AGGREGATE).
 
         Args:
             frame (LoraFrame): The LoRa frame to process
@@ -202,7 +957,10 @@ class LoraMac:
         if child is None:
             self._listen()
             return 
-        log.info(f"RECEIVE DATA frame {frame}")
+        log.debug("RECEIVE {} frame {}", frame.command.name, frame)
+        if child.rx_window is not None:
+            self._on_window_frame(frame, child)
+            return
 
         r = child.compare_update_expected_sn(frame.seq)
         if r < 0:
@@ -212,13 +970,16 @@ class LoraMac:
             return
         if r > 0:
             log.info(f"received sn: {frame.seq} expected sn: {child.expected_sn}")
+        # a new frame of the child acknowledges the last frame sent to it
+        self._resolve(child.last_send_frame, SendStatus.DELIVERED)
         
         if frame.k:
-            self._send_ack(child, frame.src_addr, frame.seq)
+            # the ACK is coalesced with the pending data for this child if any
+            self._respond(child, frame)
         else:
             child.last_send_frame = None
 
-        self.upper_layer(frame.src_addr, frame.payload) #deliver data to upper layer
+        self._deliver(frame)
         self._listen()
     
     def _on_join(self, frame: LoraFrame, child: LoraChild):
@@ -229,99 +990,342 @@ class LoraMac:
             | -----------------JOIN[(prefix=node_id[0:8], node_id)]----------------> |
             | <-- JOIN_RESPONSE[(prefix=node_id[0:8], node_id), data=new_prefix] --> |
 
+        A child can give its capabilities (CAP_* flags) in the data of the
+        JOIN frame. The root then adds the capabilities that it accepts
+        after the new prefix. The childs that give no capabilities (e.g. the
+        C implementation) receive only the new prefix.
+
+        The new JOINs are queued and answered by _admit_joins, at the rate of
+        the join bucket: after an outage, the childs join one after the other
+        instead of all at once (in the order of their first JOIN, the
+        retransmitted JOINs keep their place).
+
         Args:
             frame (LoraFrame): The LoRa frame to process
             child (LoraChild): The child that send the frame
 
         """
-        log.info(f"RECEIVE JOIN frame {frame}")
+        log.info("RECEIVE JOIN frame {}", frame)
         if frame.seq != 0:
             log.warning(f"Incorrect JOIN SN. Actual: {frame.seq} Expected: {0}")
             self._listen()
             return
 
-        if child is not None:
-            # it's a node that have already fully joined the network
-            # i.e. has send a frame after the joining sequence
-            # -> nothing to do
-            log.warning("Known child -> listen")
-            self._listen()
-            return
-
+        # a JOIN comes from the initial address of the node (prefix=node_id[0:8]): the
+        # prefix can be the one of an unrelated child, the node is known by its full address
+        now = self.clock()
         # perhaps that it's a node that retransmits the JOIN frame
-        child = self.not_joined_childs.get(frame.src_addr.prefix, None)
+        child = self.not_joined_childs.get(frame.src_addr, None)
 
         if child is not None:  # it is a retransmission
             log.info(f"RETRANSMISSION requested by the child {child}")
 
+            child.last_seen = now
             if child.transmit_count < MAX_RETRANSMIT:
-                log.info(f"MAC TX: {child.last_send_frame}")
-                self.phy_layer.phy_send(child.last_send_frame)
-                child.transmit_count += 1
+                if self._phy_send(child.last_send_frame):
+                    child.transmit_count += 1
+                    # the child has a prefix: it goes before the new JOINs, which wait for the airtime
+                    self.join_bucket.charge(self.phy_layer.airtime(child.last_send_frame))
             else:  # we can no longer retransmit
                 log.info("MAX RETRANSMIT for JOIN reached -> remove child.")
                 child.clear_transmit_count()
-                r1 = self.not_joined_childs.pop(child.addr.node_id & 255, None)
-                if r1 is None:
-                    log.warning("child not in not_joined childs lits")
-                r2 = self.childs.pop(child.addr.prefix, None)
-                if r2 is None:
-                    log.warning("child not in childs list")
+                self._remove_child(child)
             self._listen()
             return
 
-        if self.next_prefix > MAX_PREFIX:
+        pending = self.pending_joins.get(frame.src_addr, None)
+        if pending is not None:
+            # the child has not been answered yet: it keeps its place in the queue
+            pending.frame = frame
+            pending.heard_at = now
+            self.stats["join_duplicates"] += 1
+        elif len(self.pending_joins) < MAX_PENDING_JOINS:
+            self.pending_joins[frame.src_addr] = PendingJoin(frame, now)
+        else:
+            log.warning("Too many pending JOINs -> JOIN dropped")
+            self.stats["refused"] += 1
+        self._admit_joins()
+        self._listen()
+
+    def _admit_joins(self):
+        """Answer the pending JOINs, in their order of arrival, as fast as the join bucket allows.
+
+        Only the childs that listen (i.e. that have sent their JOIN less than
+        JOIN_RESPONSE_WINDOW seconds ago) are answered, the others keep their
+        place until their next JOIN. If the bucket is empty, a timer calls
+        this method again when the next response can be sent.
+        """
+        if self._join_timer is not None:
+            self._join_timer.cancel()
+            self._join_timer = None
+        now = self.clock()
+        for src_addr, pending in list(self.pending_joins.items()):
+            if now - pending.heard_at > PENDING_JOIN_TIMEOUT:
+                log.info(f"JOIN of {src_addr} expired")
+                del self.pending_joins[src_addr]
+                self.stats["joins_expired"] += 1
+                continue
+            if now - pending.heard_at > JOIN_RESPONSE_WINDOW:
+                continue
+            # a JOIN_RESPONSE with the capabilities and the window size
+            response = LoraFrame(self.addr, src_addr, MacCommand.JOIN_RESPONSE, bytes(3))
+            cost = self.phy_layer.airtime(response)
+            # a prefix is given only if the response can be sent
+            wait = max(self.join_bucket.wait_time(cost), self.phy_layer.wait_time(response))
+            if wait > 0:
+                if wait != float("inf"):
+                    self._join_timer = self.timers.schedule(wait, self._on_join_timer)
+                return
+            del self.pending_joins[src_addr]
+            # the tokens are spent only by a response on air, not by a refused JOIN
+            if self._admit(pending.frame):
+                self.join_bucket.consume(cost)
+
+    def _on_join_timer(self):
+        self._join_timer = None
+        self._admit_joins()
+        self._listen()
+
+    def _admit(self, frame: LoraFrame) -> bool:
+        """Create the child of a JOIN and send the JOIN response.
+
+        Returns:
+            bool: True if the JOIN response has been sent, False if there is
+                  no free prefix or if the response could not be sent.
+        """
+        # a joined child that sends a JOIN has rebooted: its prefix is released
+        old_child = self._by_node_id.get(frame.src_addr.node_id, None)
+        if old_child is not None:
+            log.info(f"{old_child} joins again -> the previous child is removed")
+            self.stats["rebooted"] += 1
+            self._remove_child(old_child)
+
+        new_prefix = self._allocate_prefix()
+        if new_prefix is None:
             log.warning("Can't accept new child")
-            self._listen()
-            return
-        
-        new_prefix = self.next_prefix
-        self.next_prefix += 1
+            self.stats["refused"] += 1
+            return False
 
         # create the child
-        new_child = LoraChild(LoraAddr(new_prefix, frame.src_addr.node_id))
+        new_child = LoraChild(LoraAddr(new_prefix, frame.src_addr.node_id), self.tx_buf_size)
+        new_child.drop_policy = self.drop_policy
+        new_child.join_addr = frame.src_addr
+        new_child.last_seen = self.clock()
+        heapq.heappush(self._idle, (new_child.last_seen + self.child_timeout, next(self._idle_order), new_child))
+        requested = frame.payload[0] if frame.payload else None
+        if requested is not None:
+            new_child.capabilities = requested & self.capabilities
+        if new_child.capabilities & CAP_WINDOW:
+            new_child.tx_window = SendWindow(self.window_size, MAX_RETRANSMIT)
+            new_child.rx_window = ReceiveWindow(self.window_size)
         self.childs[new_prefix] = new_child
-        self.not_joined_childs[frame.src_addr.prefix] = new_child
+        self._by_node_id[new_child.addr.node_id] = new_child
+        self.not_joined_childs[frame.src_addr] = new_child
         log.info("new child {} created", str(new_child))
+        self._save(new_child)
 
         # send the join response
-        response = LoraFrame(self.addr, frame.src_addr, MacCommand.JOIN_RESPONSE, "%02X" % new_prefix, new_child.get_sn(), False)
+        data = bytes((new_prefix,)) if requested is None else bytes((new_prefix, new_child.capabilities))
+        if new_child.capabilities & CAP_WINDOW:
+            data += bytes((self.window_size,))
+        response = LoraFrame(self.addr, frame.src_addr, MacCommand.JOIN_RESPONSE, data, new_child.get_sn(), False)
         new_child.last_send_frame = response
-        log.info(f"MAC TX: {response}")
-        self.phy_layer.phy_send(response)
-        
-        self._listen()
+        return self._phy_send(response)
 
-    def _rx_process(self):
-        """Thread that fetches the frames received by the PHY layer.
-            - Fetch a frame from the PHY layer
+    def _allocate_prefix(self):
+        """Return a free prefix, the lowest released one first, None if there is none."""
+        if self._free_prefixes:
+            return heapq.heappop(self._free_prefixes)
+        if self.next_prefix > MAX_PREFIX:
+            return None
+        self.next_prefix += 1
+        return self.next_prefix - 1
+
+    def _remove_child(self, child: LoraChild):
+        """Remove a child and release its prefix. The frames queued for it are dropped."""
+        if self.childs.get(child.addr.prefix, None) is not child:
+            return
+        del self.childs[child.addr.prefix]
+        if self._by_node_id.get(child.addr.node_id, None) is child:
+            del self._by_node_id[child.addr.node_id]
+        if self.not_joined_childs.get(child.join_addr, None) is child:
+            del self.not_joined_childs[child.join_addr]
+        if child.pending_response is not None:
+            child.pending_response.timer.cancel()
+            child.pending_response = None
+        with child.tx_buf.mutex:
+            dropped = list(child.tx_buf.frames())
+        if dropped:
+            log.info(f"{len(dropped)} frames for {child} dropped")
+        if child.tx_window is not None:
+            dropped += child.tx_window.clear()
+        self.scheduler.idle(child)
+        for frame in [child.last_send_frame, *dropped]:
+            self._resolve(frame, SendStatus.DROPPED)
+        heapq.heappush(self._free_prefixes, child.addr.prefix)
+        if self.state is not None:
+            self.state.remove(child.addr.prefix)
+            self._sync_later()
+
+    def _save(self, child: LoraChild):
+        """Record the changes of a child in the state log."""
+        if self.state is None or self.childs.get(child.addr.prefix, None) is not child:
+            return
+        prefix = child.addr.prefix
+        self.state.save(prefix, "child", {
+            "node_id": child.addr.node_id,
+            "capabilities": child.capabilities,
+            "window": child.tx_window.size if child.tx_window is not None else 0,
+            "joined": self.not_joined_childs.get(child.join_addr, None) is not child,
+        })
+        expected_sn = child.rx_window.next_sn if child.rx_window is not None else child.expected_sn
+        self.state.save(prefix, "sn", [expected_sn, child._next_sn])
+        with child.tx_buf.mutex:
+            frames = [(int(frame.priority), frame.payload.hex()) for frame in child.tx_buf.frames()]
+        self.state.save(prefix, "tx", [payload if priority == Priority.NORMAL else [priority, payload]
+                                       for priority, payload in frames])
+        self._sync_later()
+
+    def _sync_later(self):
+        """Sync the state log SYNC_INTERVAL seconds after a record not synced yet."""
+        if self.state.dirty and self._sync_timer is None:
+            self._sync_timer = self.timers.schedule(SYNC_INTERVAL, self._sync_state)
+
+    def _sync_state(self):
+        self._sync_timer = None
+        self.state.sync()
+
+    def _restored_sn(self, next_sn: int, window: bool) -> int:
+        """Return the next SN of a restored child.
+
+        The saved SN can be late by the frames sent during the last
+        SYNC_INTERVAL before a power loss, that the child has received:
+        it would drop the next frames. The SN is moved ahead of all of
+        them (at most one frame per time on air of a header). A stop and
+        wait child (loramac.c) drops the frames with a SN lower than the
+        expected one, without wrap around: the SN stops at 255, which it
+        accepts whatever the SN it expects.
+        """
+        margin = math.ceil(SYNC_INTERVAL / self.phy_layer.scheduler.airtime(HEADER_SIZE)) + 1
+        if window:
+            # the receive window of the child slides to the SN, if less than half the SN space ahead
+            return (next_sn + min(margin, HALF_SN_SPACE - 1)) % SN_MODULO
+        return min(next_sn + margin, SN_MODULO - 1)
+
+    def _restore(self):
+        """Restore the childs saved in the state log.
+
+        The childs that had not finished their join are not restored:
+        they send a JOIN again. The frame in flight at the restart is lost.
+        The next SN of each child is moved ahead (c.f. _restored_sn).
+        """
+        now = self.clock()
+        for prefix, values in self.state.load().items():
+            info = values.get("child", None)
+            if info is None or not info.get("joined", False) or not MIN_PREFIX <= prefix <= MAX_PREFIX:
+                self.state.remove(prefix)
+                continue
+            try:
+                child = LoraChild(LoraAddr(prefix, info["node_id"]), self.tx_buf_size)
+                child.drop_policy = self.drop_policy
+                child.capabilities = info["capabilities"]
+                child.expected_sn, next_sn = values.get("sn", (1, 1))
+                child._next_sn = self._restored_sn(next_sn, child.capabilities & CAP_WINDOW)
+                if child.capabilities & CAP_WINDOW:
+                    child.tx_window = SendWindow(info["window"], MAX_RETRANSMIT)
+                    child.rx_window = ReceiveWindow(info["window"], child.expected_sn)
+                for payload in values.get("tx", [])[:self.tx_buf_size]:
+                    # [priority, payload] for the frames not in the NORMAL class
+                    priority, payload = payload if isinstance(payload, list) else (Priority.NORMAL, payload)
+                    child.tx_buf.put_nowait(QueuedFrame(self.addr, child.addr, MacCommand.DATA, bytes.fromhex(payload),
+                                                        priority=Priority(priority)))
+            except (KeyError, TypeError, ValueError) as e:
+                log.warning(f"Invalid state of the child with prefix {prefix} ignored: {e}")
+                self.state.remove(prefix)
+                continue
+            child.last_seen = now
+            heapq.heappush(self._idle, (now + self.child_timeout, next(self._idle_order), child))
+            self.childs[prefix] = child
+            self._by_node_id[child.addr.node_id] = child
+        self.next_prefix = max(self.childs, default=MIN_PREFIX - 1) + 1
+        self._free_prefixes = [prefix for prefix in range(MIN_PREFIX, self.next_prefix) if prefix not in self.childs]
+        log.info(f"{len(self.childs)} childs restored from {self.state.path}")
+
+    def _evict_idle(self, now: float):
+        """Remove the childs not heard for child_timeout seconds."""
+        while self._idle and self._idle[0][0] <= now:
+            _, _, child = heapq.heappop(self._idle)
+            if self.childs.get(child.addr.prefix, None) is not child:
+                continue  # already removed
+            deadline = child.last_seen + self.child_timeout
+            if deadline > now:  # heard since the entry was pushed
+                heapq.heappush(self._idle, (deadline, next(self._idle_order), child))
+                continue
+            log.info(f"{child} not heard for {self.child_timeout:.0f} s -> removed")
+            self.stats["evicted"] += 1
+            self._remove_child(child)
+
+    def process_frame(self, frame: LoraFrame):
+        """Process a frame received by the PHY layer.
             - checks that the destination address is correct
             - retrieves the child if exist
             - if seq = 1, mark de child as completly joined
-            - if wait ack and frame is not ack: retransmit last packet if frame wait a response
             - calls the appropriate function to process the frame
+
+        Args:
+            frame (LoraFrame): The received frame.
         """
-        while True:
-            # the frame received by the PHY layer
-            # this call block until a frame is available
-            frame = self.phy_layer.getFrame()
+        with self._lock:
+            self._process_frame(frame)
 
-            if frame.dest_addr != self.addr:
-                log.info(f"Frame dest addr {frame.dest_addr} is not this node")
-                return
+    def _process_frame(self, frame: LoraFrame):
+        now = self.clock()
+        self._evict_idle(now)
+        if frame.dest_addr != self.addr:
+            log.info(f"Frame dest addr {frame.dest_addr} is not this node")
+            self._listen()
+            return
 
-            child = self.childs.get(frame.src_addr.prefix, None)
-            log.debug(" src child is: {}", str(child))
-            if frame.seq == 1 and child is not None:
-                # receive the first frame from this child
-                # i.e. the join procedure is completed
-                self.not_joined_childs.pop(child.addr.node_id & 255, None)
+        child = self.childs.get(frame.src_addr.prefix, None)
+        log.debug(" src child is: {}", str(child))
+        if child is not None and frame.command != MacCommand.JOIN:
+            # a JOIN comes from a node without prefix (c.f. _on_join)
+            child.last_seen = now
+            self._on_response(child)
+        if frame.seq == 1 and child is not None:
+            # receive the first frame from this child
+            # i.e. the join procedure is completed
+            if self.not_joined_childs.get(child.join_addr, None) is child:
+                del self.not_joined_childs[child.join_addr]
 
-                # resets retransmit_count if there have been retransmissions
-                child.clear_transmit_count()
+            # resets retransmit_count if there have been retransmissions
+            child.clear_transmit_count()
 
-            fun = self.action_matcher.get(frame.command, None)
-            if fun is not None:
-                fun(frame, child)
-            else:
-                log.warning(f"Unknown MAC command {frame.command}.")
+        if frame.ack is not None and child is not None and child.tx_window is not None:
+            for acked in child.tx_window.on_ack(frame.ack):
+                self._resolve(acked, SendStatus.DELIVERED)
+
+        fun = self.action_matcher.get(frame.command, None)
+        if fun is not None:
+            fun(frame, child)
+        else:
+            log.warning(f"Unknown MAC command {frame.command}.")
+            self._listen()
+        if child is not None and frame.command != MacCommand.JOIN:
+            self._save(child)
+
+    def _rx_process(self):
+        """Thread that fetches the frames received by the PHY layer
+        and processes them.
+        """
+        while True:
+            # the frame received by the PHY layer
+            # this call block until a frame is available
+            self.process_frame(self.phy_layer.getFrame())
+
+    def _timer_process(self):
+        """Thread that runs the retransmission timers."""
+        while True:
+            # wait for the next tick or, if no timer is pending, for TimerWheel.on_start
+            self._timer_event.wait(self.poll_timers())
+            self._timer_event.clear()
@@ -1,18 +1,44 @@
 import serial
 import queue
+import struct
+import binascii
 import threading
 from enum import Enum, auto, unique
+import dataclasses
 from dataclasses import dataclass
 import time
 import csv
 import random
+import collections
+from typing import Callable, Optional
 from loguru import logger as log
+from pyloramac.lora_airtime import TxScheduler, DEFAULT_TURNAROUND, MAX_FRAME_SIZE
+from pyloramac.lora_dutycycle import DutyCycleLedger
+from pyloramac.lora_config import RadioConfig, RadioConfigCache, RADIO_PARAMS, RN2483_DEFAULT_CONFIG
 
 
-HEADER_SIZE = 16 #Number of hexadecimal character in the header
+HEADER_SIZE = 8 #Number of bytes in the header
+ACK_FIELD_SIZE = 2  # cumulative SN and selective ACK bitmap (c.f. LoraFrame)
+MAX_PAYLOAD_SIZE = MAX_FRAME_SIZE - HEADER_SIZE  # maximum number of bytes in the payload
+# maximum number of bytes in the payload of a frame that carries the ACK field
+MAX_ACK_PAYLOAD_SIZE = MAX_PAYLOAD_SIZE - ACK_FIELD_SIZE
+
+# UART command deadlines (in seconds)
+COMMAND_TIMEOUT = 1.0  # radio set, mac pause, ...
+TX_TIMEOUT_MARGIN = 1.0  # added to the time on air for radio tx
+RX_TIMEOUT_MARGIN = 1.0  # added to the watchdog timer for radio rx
+RESET_TIMEOUT = 3.0  # sys reset
+BUSY_BACKOFF = 0.1  # delay before resending a command answered by busy
+MAX_COMMAND_RETRIES = 2  # number of times a command is resent before a reset
+
+# src prefix, src node id, dest prefix, dest node id, flags and command, seq
+HEADER_STRUCT = struct.Struct(">BHBHBB")
+ACK_STRUCT = struct.Struct(">BB")  # cumulative SN, selective ACK bitmap
 
 K_FLAG_SHIFT = 7
 NEXT_FLAG_SHIFT = 6
+ACK_FLAG_SHIFT = 5
+BURST_FLAG_SHIFT = 4
 
 
 @unique
@@ -24,6 +50,7 @@ class MacCommand(Enum):
     DATA = 2
     ACK = 3
     QUERY = 4
+    AGGREGATE = 5  # several payloads in one frame (c.f. lora_mac.aggregate)
 
 
 @unique
@@ -32,8 +59,11 @@ class UartCommand(Enum):
 
     MAC_PAUSE = "mac pause"  # pause mac layer
     RX = "radio rx "  # receive mode
+    RXSTOP = "radio rxstop"  # end the receive mode
     TX = "radio tx "  # transmit data
     SLEEP = "sys sleep "  # system sleep
+    RESET = "sys reset"  # reboot the RN2483
+    GET = "radio get "  # read a radio parameter
 
     """
     The modulation method.
@@ -99,6 +129,81 @@ class UartResponse(Enum):
     NONE = "none"
 
 
+class UartParser:
+    """Incremental parser for the RN2483 UART responses.
+
+    The received bytes are accumulated in a bytearray and each complete
+    line is classified by its first token (the text before the first space).
+    The rest of the line (e.g. the data of `radio_rx`) is returned as a
+    memoryview on the line, without copy. For the other lines (NONE, U_INT)
+    the memoryview covers the whole line.
+    """
+
+    TOKENS = {
+        b"ok": UartResponse.OK,
+        b"invalid_param": UartResponse.INVALID_PARAM,
+        b"radio_err": UartResponse.RADIO_ERR,
+        b"radio_rx": UartResponse.RADIO_RX,
+        b"busy": UartResponse.BUSY,
+        b"radio_tx_ok": UartResponse.RADIO_TX_OK,
+    }
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data: bytes) -> list:
+        """Add received bytes and return the complete responses.
+
+        Args:
+            data (bytes): The received bytes.
+
+        Returns:
+            list: A list of (UartResponse, memoryview) tuples, one for each
+                  complete line.
+        """
+        buffer = self._buffer
+        buffer += data
+        responses = []
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end < 0:
+                break
+            line = bytes(buffer[start:end])
+            start = end + 1
+            if line.endswith(b"\r"):
+                line = line[:-1]
+            if line:
+                responses.append(self.classify(line))
+        del buffer[:start]
+        return responses
+
+    @classmethod
+    def classify(cls, line: bytes) -> tuple:
+        """Classify a line sent by the RN2483.
+
+        Args:
+            line (bytes): The line without the line terminator.
+
+        Returns:
+            tuple: The UartResponse and a memoryview on the rest of the line.
+        """
+        space = line.find(b" ")
+        if space < 0:
+            space = len(line)
+        token = line[:space]
+        response = cls.TOKENS.get(token, None)
+        if response is None:
+            # not a status: the data is the whole line (e.g. a `radio get` value)
+            response = UartResponse.U_INT if token.isdigit() else UartResponse.NONE
+            return response, memoryview(line)
+
+        # skip the spaces between the token and the data
+        while space < len(line) and line[space] == 0x20:
+            space += 1
+        return response, memoryview(line)[space:]
+
+
 @dataclass(frozen=True)
 class LoraAddr:
     """A LoRaMAC address
@@ -133,103 +238,126 @@ class LoraFrame:
 
         The format of a LoRaMAC frame is the following (size in bits):
 
-    |<---24---->|<----24--->|<-1->|<-1-->|<---2--->|<--4--->|<--8--->|<(2040-64=1976)>|
-    | dest addr |  src addr |  k  | next | reserved|command |  seq   |     payload    |
+    |<---24---->|<----24--->|<-1->|<-1-->|<-1->|<--1-->|<--4--->|<--8--->|<(2040-64=1976)>|
+    |  src addr | dest addr |  k  | next | ack | burst |command |  seq   |     payload    |
+
+        If the ack flag is set, the payload begins with an ACK field of the
+        sliding window (c.f. lora_arq):
+
+    |<-----8----->|<---8--->|
+    | cumulative  | bitmap  |
 
         Attributes:
             src_addr: The source address
             dest_addr: The Destination address
             command: The MAC command (c.f. MacCommand)
-            payload: The payload. Must be a string in hexadecimal
+            payload: The payload (bytes)
             seq: The sequence number
             k: True if the frame need an ack, False otherwise
             has_next: True true if another frame follows it, False otherwise. Only used for downward traffic
+            burst: True if another frame of the same burst follows it at once (sliding window)
+            ack: The ACK field (cumulative SN, bitmap) or None
     """
 
     src_addr: LoraAddr
     dest_addr: LoraAddr
     command: MacCommand
-    payload: str
+    payload: bytes
     seq: int = 0
     k: bool = False
     has_next: bool = False
+    burst: bool = False
+    ack: Optional[tuple] = None
 
-    def toHex(self) -> str:
-        """Serialize the frame.
+    @property
+    def size(self) -> int:
+        """The size of the serialized frame in bytes."""
+        return HEADER_SIZE + (ACK_FIELD_SIZE if self.ack is not None else 0) + len(self.payload)
+
+    def pack(self) -> bytes:
+        """Serialize the frame to bytes.
 
         Returns:
-            str: The serialized frame
+            bytes: The serialized frame
         """
 
         # create flags and MAC command
-        f_c = 0
-        f_c |= self.k << K_FLAG_SHIFT
-        f_c |= self.has_next << NEXT_FLAG_SHIFT
-        f_c |= self.command.value
-
-        # check that the size of the payload is even
-        if len(self.payload) % 2 != 0:
-            # The size must be even because one character is 4 bits and we
-            # can't send a half a byte
-            # if not even add a zero
-            self.payload = "0" + self.payload
-
-        return (
-            self.src_addr.toHex()
-            + self.dest_addr.toHex()
-            + ("%02X" % f_c)
-            + ("%02X" % self.seq)
-            + (self.payload if self.payload else "")
+        f_c = ((self.k << K_FLAG_SHIFT) | (self.has_next << NEXT_FLAG_SHIFT) | (self.burst << BURST_FLAG_SHIFT)
+               | self.command.value)
+        if self.ack is not None:
+            f_c |= 1 << ACK_FLAG_SHIFT
+
+        header = HEADER_STRUCT.pack(
+            self.src_addr.prefix,
+            self.src_addr.node_id,
+            self.dest_addr.prefix,
+            self.dest_addr.node_id,
+            f_c,
+            self.seq,
         )
+        if self.ack is not None:
+            header += ACK_STRUCT.pack(*self.ack)
+        return header + self.payload if self.payload else header
 
-    @staticmethod
-    def build(data: str):
-        """Deserialize (or build) a LoRaFrame.
+    def toHex(self) -> str:
+        """Serialize the frame to a string in hexadecimal.
 
-        Returns:
-            LoraFrame: The frame built from the data.
+        Only used for the final write to the RN2483.
 
+        Returns:
+            str: The serialized frame
         """
+        return self.pack().hex().upper()
 
-        if len(data) < HEADER_SIZE:
-            return None
-
-        """ extract src addr: most significant 24 bits"""
-        prefix_src = int(data[0:2], 16)
-        node_id_src = int(data[2:6], 16)
-
-        """ extract dest addr: next 24 bits """
-        prefix_dest = int(data[6:8], 16)
-        node_id_dest = int(data[8:12], 16)
-
-        """ extract flags an MAC command: 8 bits """
-        f_c = int(data[12:14], 16)
-
-        flag_filter = 0x01  # 1 bit
-        cmd_filter = 0x0F  # 4 bits
+    @staticmethod
+    def unpack(data):
+        """Deserialize (or build) a LoRaFrame from bytes.
 
-        k = bool((f_c >> K_FLAG_SHIFT) & flag_filter)
-        has_next = bool((f_c >> NEXT_FLAG_SHIFT) & flag_filter)
+        Args:
+            data (bytes | memoryview): The serialized frame.
 
-        cmd = MacCommand(f_c & cmd_filter)
+        Returns:
+            LoraFrame: The frame built from the data or None if the data is
+                       too short.
+        """
 
-        """ extract sequence number: 8 bits """
-        seq = int(data[14:16], 16)
+        if len(data) < HEADER_SIZE:
+            return None
 
-        """ extract payload """
-        payload = data[16:]
+        prefix_src, node_id_src, prefix_dest, node_id_dest, f_c, seq = HEADER_STRUCT.unpack_from(data)
+        ack = None
+        payload_offset = HEADER_SIZE
+        if (f_c >> ACK_FLAG_SHIFT) & 0x01:
+            if len(data) < HEADER_SIZE + ACK_FIELD_SIZE:
+                return None
+            ack = ACK_STRUCT.unpack_from(data, HEADER_SIZE)
+            payload_offset += ACK_FIELD_SIZE
 
-        """ create LoraFrame with computed values"""
         return LoraFrame(
             LoraAddr(prefix_src, node_id_src),
             LoraAddr(prefix_dest, node_id_dest),
-            cmd,
-            payload,
+            MacCommand(f_c & 0x0F),
+            bytes(data[payload_offset:]),
             seq,
-            k,
-            has_next,
+            bool((f_c >> K_FLAG_SHIFT) & 0x01),
+            bool((f_c >> NEXT_FLAG_SHIFT) & 0x01),
+            bool((f_c >> BURST_FLAG_SHIFT) & 0x01),
+            ack,
         )
 
+    @staticmethod
+    def build(data: str):
+        """Deserialize (or build) a LoRaFrame from a string in hexadecimal.
+
+        Returns:
+            LoraFrame: The frame built from the data.
+
+        """
+        try:
+            return LoraFrame.unpack(bytes.fromhex(data))
+        except ValueError:
+            return None
+
 
 @dataclass
 class UartFrame:
@@ -239,12 +367,255 @@ class UartFrame:
         expected_response: The expected UART response to this paquet
         data: The sent data
         cmd: The UART command (c.f. UartCommand)
+        airtime: The time on air (in seconds) of the LoRa frame sent with this paquet
+        timeout: The time (in seconds) to wait for the expected response,
+                 None to wait forever
+        callback: Called with the response and its data when the expected
+                  response is received, before the next paquet is written
     """
 
     expected_response: list
     data: str
     cmd: UartCommand
     stat_id: int = -1
+    airtime: float = 0.0
+    timeout: Optional[float] = COMMAND_TIMEOUT
+    callback: Optional[Callable[[UartResponse, memoryview], None]] = None
+
+
+@dataclass
+class CommandStats:
+    """Statistics for an UART command type.
+
+    Attributes:
+        count: The number of completed commands.
+        retries: The number of times a command has been resent.
+        timeouts: The number of expired deadlines.
+        failures: The number of commands given up.
+        total_latency: The sum of the latencies (in seconds) of the completed commands.
+        max_latency: The highest latency (in seconds).
+    """
+
+    count: int = 0
+    retries: int = 0
+    timeouts: int = 0
+    failures: int = 0
+    total_latency: float = 0.0
+    max_latency: float = 0.0
+
+    @property
+    def mean_latency(self) -> float:
+        return self.total_latency / self.count if self.count else 0.0
+
+
+class UartCommandEngine:
+    """Queue of UART commands with per-command deadlines.
+
+    The RN2483 processes one command at a time, so there is at most one
+    command in flight, the others wait in the queue and the next one is
+    written as soon as the response of the previous one arrives.
+    A command without response before its deadline or answered by `busy`
+    is resent, up to MAX_COMMAND_RETRIES times. Then it is given up and
+    on_failure is called. A command answered by `invalid_param` is
+    given up immediately.
+
+    The engine does not do any I/O: the driver writes the commands
+    returned by pop(), calls started() once written, on_response() for
+    each response and expire() to check the deadline. on_started is
+    called with each written command and its attempt number.
+    """
+
+    def __init__(self, size: int = 10, max_retries: int = MAX_COMMAND_RETRIES,
+                 on_failure: Callable[[UartFrame, UartResponse], None] = None,
+                 on_started: Callable[[UartFrame, int], None] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.size = size
+        self.max_retries = max_retries
+        self.on_failure = on_failure
+        self.on_started = on_started
+        self.stats = collections.defaultdict(CommandStats)  # UartCommand -> CommandStats
+        self._clock = clock
+        self._lock = threading.RLock()
+        self._queue = collections.deque()
+        self._in_flight = None  # the command waiting for its response
+        self._written = False  # True if the command in flight has been written
+        self._sent_at = 0.0
+        self._deadline = None
+        self._attempts = 0
+        self._not_before = 0.0  # backoff after busy
+
+    @property
+    def in_flight(self) -> Optional[UartFrame]:
+        return self._in_flight
+
+    def submit(self, frame: UartFrame) -> bool:
+        """Append a command to the queue.
+
+        Returns:
+            bool: False if the queue is full.
+        """
+        with self._lock:
+            if len(self._queue) >= self.size:
+                return False
+            self._queue.append(frame)
+            return True
+
+    def submit_front(self, frames: list):
+        """Put commands at the head of the queue, in order, even if the queue is full.
+
+        Used by the callbacks to send commands before the queued ones.
+        """
+        with self._lock:
+            self._queue.extendleft(reversed(frames))
+
+    def stop_rx(self, rxstop: UartFrame):
+        """End the reception so that the next commands can be written.
+
+        The radio rx commands are removed from the queue. A radio rx
+        already written is ended by rxstop, written before the queued
+        commands.
+
+        Args:
+            rxstop (UartFrame): The radio rxstop command.
+        """
+        with self._lock:
+            for frame in [frame for frame in self._queue if frame.cmd == UartCommand.RX]:
+                self._queue.remove(frame)
+            if self._in_flight is None or self._in_flight.cmd != UartCommand.RX:
+                return
+            written = self._written
+            self._in_flight = None
+            self._deadline = None
+            if written:
+                self._queue.appendleft(rxstop)
+
+    def clear(self):
+        """Drop the queued commands and the command in flight."""
+        with self._lock:
+            self._queue.clear()
+            self._in_flight = None
+            self._deadline = None
+            self._attempts = 0
+
+    def pop(self) -> Optional[UartFrame]:
+        """Return the next command to write, or None if a command is in
+        flight, the queue is empty or a backoff is running."""
+        with self._lock:
+            if self._in_flight is not None and self._written:
+                return None
+            if self._in_flight is None:
+                if not self._queue or self._clock() < self._not_before:
+                    return None
+                self._in_flight = self._queue.popleft()
+                self._attempts = 0
+            elif self._clock() < self._not_before:
+                return None  # command to resend after the backoff
+            self._written = True
+            self._deadline = None
+            return self._in_flight
+
+    def started(self, frame: UartFrame):
+        """Notify that the command has been written."""
+        with self._lock:
+            if frame is not self._in_flight:
+                return
+            self._attempts += 1
+            self._sent_at = self._clock()
+            self._deadline = None if frame.timeout is None else self._sent_at + frame.timeout
+            if self.on_started is not None:
+                self.on_started(frame, self._attempts)
+
+    def on_response(self, response: UartResponse, data: memoryview = None) -> Optional[bool]:
+        """Process a response of the RN2483.
+
+        The callback of the command is called, with the engine lock held,
+        when the expected response is received.
+
+        Args:
+            response (UartResponse): The received response.
+            data (memoryview): The data of the response.
+
+        Returns:
+            Optional[bool]: True if it is an expected response of the
+                command in flight, False if the command has been ended by an
+                error response (busy, invalid_param), None if the response
+                is not for the command in flight.
+        """
+        with self._lock:
+            frame = self._in_flight
+            if frame is None or not self._written:
+                return None
+            if response in frame.expected_response:
+                stats = self.stats[frame.cmd]
+                latency = self._clock() - self._sent_at
+                stats.count += 1
+                stats.total_latency += latency
+                stats.max_latency = max(stats.max_latency, latency)
+                self._in_flight = None
+                self._deadline = None
+                if frame.callback is not None:
+                    frame.callback(response, data)
+                return True
+            if response == UartResponse.BUSY:
+                self._retry(frame, BUSY_BACKOFF)
+                return False
+            if response == UartResponse.INVALID_PARAM:
+                self._fail(frame, response)
+                return False
+            return None
+
+    def expire(self) -> Optional[float]:
+        """Check the deadline of the command in flight.
+
+        Returns:
+            Optional[float]: The time (in seconds) until the next deadline
+                             or backoff, None if there is nothing to wait for.
+        """
+        with self._lock:
+            now = self._clock()
+            if self._deadline is not None and now >= self._deadline:
+                frame = self._in_flight
+                self.stats[frame.cmd].timeouts += 1
+                log.warning(f"UART timeout for {frame.cmd.name} (attempt {self._attempts})")
+                self._retry(frame, 0.0)
+            if self._not_before > now:
+                return self._not_before - now
+            if self._deadline is not None:
+                return self._deadline - now
+            return None
+
+    def _retry(self, frame: UartFrame, backoff: float):
+        self._deadline = None
+        if self._attempts > self.max_retries:
+            self._fail(frame, UartResponse.NONE)
+            return
+        self.stats[frame.cmd].retries += 1
+        self._written = False  # resend the command in flight
+        self._not_before = self._clock() + backoff
+
+    def _fail(self, frame: UartFrame, response: UartResponse):
+        self.stats[frame.cmd].failures += 1
+        self._in_flight = None
+        self._deadline = None
+        if self.on_failure is not None:
+            self.on_failure(frame, response)
+
+
+# the command used to set each radio parameter
+SET_COMMANDS = {
+    'mode': UartCommand.SET_MOD,
+    'frequence': UartCommand.SET_FREQ,
+    'bandwidth': UartCommand.SET_BW,
+    'cr': UartCommand.SET_CR,
+    'pwr': UartCommand.SET_PWR,
+    'sf': UartCommand.SET_SF,
+    'wdt': UartCommand.SET_WDT,
+}
+
+SET_PARAMS = {cmd: name for name, cmd in SET_COMMANDS.items()}
+
+# the configuration of a radio in an unknown state: every parameter is set
+UNKNOWN_CONFIG = RadioConfig(**{name: None for name in RADIO_PARAMS})
 
 
 class LoraPhy:
@@ -252,20 +623,54 @@ class LoraPhy:
 
     The PHY layer is the driver for the RN2483.
 
+    The radio parameters are validated when the layer is created (ValueError).
+    The last configuration applied to the radio can be cached in a file
+    (config_cache parameter: the path of the file, e.g. lora_config.DEFAULT_CACHE_PATH;
+    None, the default, disables the cache).
+    The clock is used for the deadlines, the turnaround gap and the
+    duty-cycle accounting (e.g. a simulated clock).
     """
 
-    def __init__(self, listen_on_error=False, **params):
+    def __init__(self, listen_on_error=False, clock: Callable[[], float] = time.monotonic, **params):
         self._con = None  # The serial conenction
         self._params = params
-        self._buffer = queue.Queue(self._params.get('txBufSize', 10))  # The TX buffer
+        self.radio_config = RadioConfig.from_params(params)  # the wanted radio configuration
+        cache = self._params.get('config_cache', None)
+        self._config_cache = RadioConfigCache(cache) if cache else None
+        self._config_lock = threading.Lock()
+        self._applied = UNKNOWN_CONFIG  # the configuration of the radio, as far as we know
+        self._queued = UNKNOWN_CONFIG  # the configuration once the queued commands are applied
+        self._configuring = False  # True while the configuration of the radio is read
+        # The TX buffer
+        self._engine = UartCommandEngine(
+            self._params.get('txBufSize', 10), on_failure=self._on_command_failure,
+            on_started=self._on_command_started, clock=clock
+        )
         self._rx_buffer = queue.Queue(self._params.get('rxBufSize', 10))  # the RX buffer
-        self._can_send = True  # True if the tx process can send, False otherwise
-        self._can_send_cond = threading.Condition()  # condition used by the tx_process
-        self._last_sended = None  # the last sended frame
+        self._can_send = threading.Event()  # wakes up the tx_process
+        self._parser = UartParser()
+        self._wdt = None  # radio watchdog timer (ms)
         self._tx_lock = threading.Lock()  # lock used for phy_tx()
         self.listen_lock = threading.Lock()
         self._is_listen = False
         self.listen_on_error = listen_on_error
+        self.upper_layer = None  # if set, received frames are pushed to it instead of the RX buffer
+        self.scheduler = TxScheduler(
+            self.radio_config.sf,
+            self.radio_config.bandwidth,
+            self.radio_config.cr,
+            self._params.get('turnaround') or DEFAULT_TURNAROUND,
+            clock=clock,
+        )
+        self.last_airtime = 0.0  # time on air of the last sent frame
+        self._queued_airtime = 0.0  # time on air of the TX commands not written yet
+        self._airtime_lock = threading.Lock()
+        self.frequency = int(self.radio_config.frequence)
+        # duty-cycle accounting, can be disabled for tests with duty_cycle=False
+        if self._params.get('duty_cycle', True):
+            self.duty_cycle = DutyCycleLedger(clock=clock)
+        else:
+            self.duty_cycle = DutyCycleLedger(sub_bands=(), clock=clock)
 
     def init(self):
         """Init the PHY layer.
@@ -283,42 +688,233 @@ class LoraPhy:
         tx_thread = threading.Thread(target=self._uart_tx)
         rx_thread = threading.Thread(target=self._uart_rx)
 
-        log.info(f"Radio configuration: {self._params}")
-
-        # Radio configuration
-        self._send_phy(UartFrame([UartResponse.U_INT], "", UartCommand.MAC_PAUSE))
-        self._send_phy(UartFrame([UartResponse.OK], self._params.get('mode',"lora"), UartCommand.SET_MOD))
-        self._send_phy(UartFrame([UartResponse.OK], self._params.get('frequence',"868100000"), UartCommand.SET_FREQ))
-        self._send_phy(UartFrame([UartResponse.OK], self._params.get('bandwidth',"125"), UartCommand.SET_BW))
-        self._send_phy(UartFrame([UartResponse.OK], self._params.get('cr',"4/5"), UartCommand.SET_CR))
-        self._send_phy(UartFrame([UartResponse.OK], self._params.get('pwr',"1"), UartCommand.SET_PWR))
-        self._send_phy(UartFrame([UartResponse.OK], self._params.get('sf',"sf2"), UartCommand.SET_SF))
-        
+        self._configure()
+
         rx_thread.start()
         tx_thread.start()
 
-        with self._can_send_cond:
-            self._can_send_cond.notify_all()
+    def command_stats(self) -> dict:
+        """Return the latency statistics per UART command type.
+
+        Returns:
+            dict: A dict UartCommand name -> CommandStats.
+        """
+        with self._engine._lock:
+            return {cmd.name: dataclasses.replace(stats) for cmd, stats in self._engine.stats.items()}
+
+    def _configure(self, after_reset: bool = False):
+        """Append the radio configuration commands to the TX buffer.
+
+        Only the parameters that differ from the configuration of the radio
+        are set. When a configuration is cached for the port, one parameter
+        that a reset would have changed is read with `radio get`:
+        - same value: the radio kept the cached configuration, only the
+          differences are set (usually nothing).
+        - other value: the radio has been reset, the mac is paused and the
+          differences with the default configuration are set.
+
+        Args:
+            after_reset (bool): True if the RN2483 has just been reset.
+        """
+
+        log.info(f"Radio configuration: {self.radio_config}")
+
+        with self._config_lock:
+            self._configuring = False
+            if after_reset:
+                self._applied = self._queued = RN2483_DEFAULT_CONFIG
+                frames = self._config_frames(pause=True)
+            else:
+                cached = self._config_cache.load(self._port) if self._config_cache else None
+                probe = self._probe_param(cached)
+                if probe is None:
+                    # unknown state or same state after a reset: full configuration
+                    self._applied = self._queued = cached or UNKNOWN_CONFIG
+                    frames = self._config_frames(pause=True)
+                else:
+                    self._configuring = True
+                    frames = [UartFrame(
+                        [UartResponse.NONE, UartResponse.U_INT],
+                        RADIO_PARAMS[probe],
+                        UartCommand.GET,
+                        callback=lambda response, data: self._on_probe(cached, probe, data),
+                    )]
+        for frame in frames:
+            self._send_phy(frame)
+
+    @property
+    def _port(self) -> str:
+        return self._params.get('port', "/dev/ttyUSB0")
+
+    @staticmethod
+    def _probe_param(cached: Optional[RadioConfig]) -> Optional[str]:
+        """Return a parameter whose cached value differs from the value after a reset."""
+        if cached is None:
+            return None
+        for name in RADIO_PARAMS:
+            value = getattr(cached, name)
+            if value is not None and value != getattr(RN2483_DEFAULT_CONFIG, name):
+                return name
+        return None
+
+    def _on_probe(self, cached: RadioConfig, probe: str, data: memoryview):
+        """Called with the value of the parameter read to know the state of the radio."""
+        value = bytes(data).decode(errors="replace").strip().lower()
+        with self._config_lock:
+            self._configuring = False
+            if value == getattr(cached, probe):
+                log.info("The RN2483 kept its configuration")
+                self._applied = self._queued = cached
+                frames = self._config_frames(pause=False)
+            else:
+                log.info(f"The RN2483 has been reset ({RADIO_PARAMS[probe]} = {value})")
+                self._applied = self._queued = RN2483_DEFAULT_CONFIG
+                frames = self._config_frames(pause=True)
+            # before the commands already queued (e.g. radio rx)
+            self._engine.submit_front(frames)
+
+    def _config_frames(self, pause: bool) -> list:
+        """Build the commands to go from the configuration of the radio to the wanted one.
+
+        Must be called with the config lock held.
+
+        Args:
+            pause (bool): True to pause the mac first.
+
+        Returns:
+            list: The UART paquets.
+        """
+        changes = self.radio_config.diff(self._queued)
+        self._queued = dataclasses.replace(self._queued, **changes)
+        frames = [UartFrame([UartResponse.U_INT], "", UartCommand.MAC_PAUSE)] if pause else []
+        for name, value in changes.items():
+            frames.append(UartFrame(
+                [UartResponse.OK],
+                value,
+                SET_COMMANDS[name],
+                callback=lambda response, data, name=name, value=value: self._on_param_set(name, value),
+            ))
+        if self._config_cache is not None:
+            if changes:
+                # the cached configuration is not valid until the changes are applied
+                self._config_cache.invalidate(self._port)
+            else:
+                self._config_cache.store(self._port, self._applied)
+        return frames
+
+    def _on_param_set(self, name: str, value: str):
+        """Called when a radio parameter has been set."""
+        with self._config_lock:
+            self._applied = dataclasses.replace(self._applied, **{name: value})
+            if self._config_cache is not None and not self.radio_config.diff(self._applied):
+                self._config_cache.store(self._port, self._applied)
+
+    def register_listener(self, listener: Callable[[LoraFrame], None]):
+        """Register a listener that will be called for each received frame.
+
+        When a listener is registered, the frames are no longer put in the
+        RX buffer and getFrame() must not be used.
 
-    def phy_send(self, loraFrame: LoraFrame):
+        Args:
+            listener (Callable[[LoraFrame], None]): The listener.
+        """
+        self.upper_layer = listener
+
+    def airtime(self, loraFrame: LoraFrame) -> float:
+        """Compute the time on air of a LoRa frame with the radio configuration.
+
+        Args:
+            loraFrame (LoraFrame): The frame.
+
+        Returns:
+            float: The time on air in seconds.
+        """
+        return self.scheduler.airtime(loraFrame.size)
+
+    def can_send(self, loraFrame: LoraFrame) -> bool:
+        """Check the duty-cycle budget for a LoRa frame.
+
+        Args:
+            loraFrame (LoraFrame): The frame.
+
+        Returns:
+            bool: True if the frame can be sent without exceeding the duty-cycle limit.
+        """
+        return self.duty_cycle.can_send(self.frequency, self.airtime(loraFrame) + self._queued_airtime)
+
+    def wait_time(self, loraFrame: LoraFrame) -> float:
+        """Return the time to wait (in seconds) before the duty-cycle budget allows a LoRa frame."""
+        return self.duty_cycle.wait_time(self.frequency, self.airtime(loraFrame) + self._queued_airtime)
+
+    def remaining_budget(self) -> float:
+        """Return the remaining time on air (in seconds) allowed by the duty-cycle limit."""
+        return max(0.0, self.duty_cycle.remaining(self.frequency) - self._queued_airtime)
+
+    def phy_send(self, loraFrame: LoraFrame) -> bool:
         """Method to use to send LoraFrame.
 
-        Prepare the UART paquet from the LoRa frame.
+        Prepare the UART paquet from the LoRa frame. The turnaround gap
+        needed by the peer is enforced by the TX thread just before
+        the frame is written to the radio. If the radio listens, the
+        reception is stopped first: the caller must listen again.
+
+        The time on air is charged to the duty-cycle ledger when the
+        frame is written to the radio. Until then it is counted as queued
+        by the duty-cycle checks.
 
         Args:
             loraFrame (LoraFrame): The frame to sent.
+
+        Returns:
+            bool: True if the frame has been added to the TX buffer, False
+                  if it is dropped (TX buffer full).
         """
-        time.sleep(0.30648)
-        self._tx_lock.acquire()
         if loraFrame is None:
+            return False
+        with self._tx_lock:
+            airtime = self.airtime(loraFrame)
+            f = UartFrame(
+                [UartResponse.RADIO_TX_OK, UartResponse.RADIO_ERR],
+                loraFrame.toHex(),
+                UartCommand.TX,
+                airtime=airtime,
+                timeout=airtime + TX_TIMEOUT_MARGIN,
+            )
+            log.debug("time on air: {:.1f} ms", f.airtime * 1000)
+            self._stop_rx()
+            # counted before the submission: the TX thread can write the frame at once
+            with self._airtime_lock:
+                self._queued_airtime += airtime
+            if not self._send_phy(f):
+                with self._airtime_lock:
+                    self._queued_airtime -= airtime
+                return False
+            self.last_airtime = f.airtime
+            return True
+
+    def _on_command_started(self, data: UartFrame, attempt: int):
+        """Called (with the engine lock held) when an UART command is written.
+
+        The time on air of a TX command is charged when it is written, at
+        each attempt: a resent frame may have been on air.
+        """
+        if data.cmd != UartCommand.TX:
             return
-        f = UartFrame(
-            [UartResponse.RADIO_TX_OK, UartResponse.RADIO_ERR],
-            loraFrame.toHex(),
-            UartCommand.TX,
-        )
-        self._send_phy(f)
-        self._tx_lock.release()
+        if attempt == 1:
+            with self._airtime_lock:
+                self._queued_airtime = max(0.0, self._queued_airtime - data.airtime)
+        self.duty_cycle.record(self.frequency, data.airtime)
+
+    def _stop_rx(self):
+        """Stop the reception, if any (without watchdog timer, the radio
+        listens until a frame is received)."""
+        self.listen_lock.acquire()
+        listening = self._is_listen
+        self._is_listen = False
+        self.listen_lock.release()
+        if listening:
+            # not expected by the RN2483 if the radio does not listen anymore
+            self._engine.stop_rx(UartFrame([UartResponse.OK, UartResponse.INVALID_PARAM], "", UartCommand.RXSTOP))
 
     def phy_timeout(self, timeout: int):
         """Set the RN2483 radio watchdog timer.
@@ -327,8 +923,14 @@ class LoraPhy:
             timeout (int): The timeout (in milliseconds)
         """
 
-        f = UartFrame([UartResponse.OK], str(timeout), UartCommand.SET_WDT)
-        self._send_phy(f)
+        self._wdt = timeout
+        with self._config_lock:
+            self.radio_config = dataclasses.replace(self.radio_config, wdt=str(timeout))
+            self.radio_config.validate()
+            # while the state of the radio is read, the watchdog is set with the configuration
+            frames = [] if self._configuring else self._config_frames(pause=False)
+        for frame in frames:
+            self._send_phy(frame)
 
     def phy_rx(self):
         """Set the radio the reception mode"""
@@ -336,8 +938,10 @@ class LoraPhy:
         self.listen_lock.acquire()
         self._is_listen = True
         self.listen_lock.release()
+        # without watchdog timer, the radio listens until a frame is received
+        timeout = self._wdt / 1000 + RX_TIMEOUT_MARGIN if self._wdt else None
         f = UartFrame(
-            [UartResponse.RADIO_ERR, UartResponse.RADIO_RX], "0", UartCommand.RX
+            [UartResponse.RADIO_ERR, UartResponse.RADIO_RX], "0", UartCommand.RX, timeout=timeout
         )
         self._send_phy(f)
 
@@ -375,68 +979,160 @@ class LoraPhy:
         if type(data) != UartFrame:
             raise TypeError("Data must be UartFrame. actual type: ", type(data))
 
-        try:
-            self._buffer.put(data, block=False)
-        except queue.Full:
+        if not self._engine.submit(data):
             log.warning("TX buffer full")
             return False
 
+        self._can_send.set()
         return True
 
-    def _process_response(self, decode_data: str) -> bool:
+    def _process_response(self, response: UartResponse, data: memoryview) -> bool:
         """Process an UART response.
 
         Args:
-            data (str): The UART response.
+            response (UartResponse): The UART response.
+            data (memoryview): The data following the response (e.g. the
+                               received frame in hexadecimal for radio_rx).
 
         Returns:
             bool: True if the answer is the one expected, False otherwise.
         """
-        for resp in self._last_sended.expected_response:
-            if resp is None:
-                continue
-            if resp.value in decode_data:  # the response is the one expected
-                log.debug("EXPECTED UART RESPONSE")
-                if resp == UartResponse.RADIO_ERR and self.listen_on_error:
-                    self.phy_rx()
-                if resp == UartResponse.RADIO_RX:  # the response is DATA
-                    try:
-                        self._rx_buffer.put(
-                            LoraFrame.build(decode_data[10:].strip()), block=False
-                        )
-                    except queue.Full:
-                        log.warning("RX buffer full")
+        result = self._engine.on_response(response, data)
+        if result is None:
+            if response == UartResponse.RADIO_RX:
+                # received before the end of a stopped reception (c.f. _stop_rx)
+                self._on_radio_rx(data)
+            log.info("UNEXPECTED UART RESPONSE")
+            return False
+        if not result:
+            # the command has been ended by an error, the next one can be sent
+            return True
+
+        log.debug("EXPECTED UART RESPONSE")
+        if response == UartResponse.RADIO_ERR and self.listen_on_error:
+            self.phy_rx()
+        if response == UartResponse.RADIO_RX:  # the response is DATA
+            self._on_radio_rx(data)
+        return True
 
-                return True
-        log.info("UNEXPECTED UART RESPONSE")
-        return False
+    def _on_radio_rx(self, data: memoryview):
+        """Decode a received frame and deliver it."""
+        try:
+            frame = LoraFrame.unpack(binascii.unhexlify(data))
+        except (binascii.Error, ValueError):
+            frame = None
+        if frame is None:
+            log.warning("Invalid frame received")
+        else:
+            self._deliver(frame)
+
+    def _on_command_failure(self, data: UartFrame, response: UartResponse):
+        """Called when an UART command is given up.
+
+        A rejected parameter is only logged. Otherwise the RN2483 does not
+        answer anymore: it is reset, configured again and put back in
+        reception mode.
+
+        Args:
+            data (UartFrame): The given up command.
+            response (UartResponse): The last response (NONE for a timeout).
+        """
+        log.error(f"UART command {data.cmd.value}{data.data} failed ({response.name})")
+        if response == UartResponse.INVALID_PARAM:
+            with self._config_lock:
+                if data.cmd == UartCommand.GET:
+                    # the state of the radio is unknown: full configuration
+                    self._configuring = False
+                    self._applied = self._queued = UNKNOWN_CONFIG
+                    self._engine.submit_front(self._config_frames(pause=True))
+                elif data.cmd in SET_PARAMS:
+                    # the parameter keeps its value
+                    name = SET_PARAMS[data.cmd]
+                    self._queued = dataclasses.replace(self._queued, **{name: getattr(self._applied, name)})
+            return
+        self._reset()
+
+    def _reset(self):
+        """Reset and configure the RN2483."""
+        log.warning("Reset the RN2483")
+        self._engine.clear()
+        with self._airtime_lock:
+            self._queued_airtime = 0.0  # the queued TX commands are dropped
+        self.listen_lock.acquire()
+        self._is_listen = False
+        self.listen_lock.release()
+        # the RN2483 answers to sys reset with its version
+        self._send_phy(UartFrame([UartResponse.NONE], "", UartCommand.RESET, timeout=RESET_TIMEOUT))
+        self._configure(after_reset=True)
+        if self.listen_on_error:
+            self.phy_rx()
+
+    def _deliver(self, frame: LoraFrame):
+        """Deliver a received frame to the listener or to the RX buffer.
+
+        Args:
+            frame (LoraFrame): The received frame.
+        """
+        if self.upper_layer is not None:
+            self.upper_layer(frame)
+            return
+        try:
+            self._rx_buffer.put(frame, block=False)
+        except queue.Full:
+            log.warning("RX buffer full")
+
+    def _on_uart_response(self, response: UartResponse, data: memoryview) -> bool:
+        """Process a response received from the serial connection.
+
+        Args:
+            response (UartResponse): The UART response.
+            data (memoryview): The data following the response.
+
+        Returns:
+            bool: True if it is the response expected by the last sent command.
+        """
+        if response == UartResponse.RADIO_RX:
+            self.scheduler.notify_rx()
+        if response == UartResponse.RADIO_RX or response == UartResponse.RADIO_ERR:
+            self.listen_lock.acquire()
+            self._is_listen = False
+            self.listen_lock.release()
+
+        log.opt(lazy=True).info("PHY RX: {{{} {}}}", lambda: response.value, lambda: bytes(data).decode(errors="replace"))
+        return self._process_response(response, data)
 
     def _uart_rx(self):
         """Method used as Thread to read data from the serial connection."""
         while True:
-            data = self._con.readline().strip().decode()
-            if ("radio_rx" in data) or ("radio_err" in data):
-                self.listen_lock.acquire()
-                self._is_listen = False
-                self.listen_lock.release()
-
-            log.info(f"PHY RX: {{{data}}}")
-            if self._process_response(data):
-                # It is the expected response
-                # Notify threads waiting for the response
-                with self._can_send_cond:
-                    self._can_send = True
-                    self._can_send_cond.notify_all()
+            # block until one byte is available then read all the available bytes
+            data = self._con.read(self._con.in_waiting or 1)
+            for response, payload in self._parser.feed(data):
+                if self._on_uart_response(response, payload):
+                    # It is the expected response
+                    # Notify the thread waiting for the response
+                    self._can_send.set()
 
     def _uart_tx(self):
         """Method used as Thread to send data to the serial connection."""
         while True:
-            while self._con is None or not self._can_send:
-                with self._can_send_cond:
-                    self._can_send_cond.wait()
-            self._last_sended = self._buffer.get(block=True)
-            log.info("PHY TX:" + self._last_sended.cmd.value + self._last_sended.data)
-            self._con.write(
-                (self._last_sended.cmd.value + self._last_sended.data + "\r\n").encode()
-            )
-            self._can_send = False
+            # cleared before the checks so that no notification is lost
+            self._can_send.clear()
+            wait = self._engine.expire()
+            data = self._engine.pop()
+            if data is None:
+                # wait for a response, a new command or the deadline
+                self._can_send.wait(wait)
+                continue
+            if data.cmd == UartCommand.TX:
+                self.scheduler.wait()
+            self._engine.started(data)
+            self._write(data)
+
+    def _write(self, data: UartFrame):
+        """Write an UART paquet to the serial connection.
+
+        Args:
+            data (UartFrame): The UART paquet.
+        """
+        log.info("PHY TX:" + data.cmd.value + data.data)
+        self._con.write((data.cmd.value + data.data + "\r\n").encode())
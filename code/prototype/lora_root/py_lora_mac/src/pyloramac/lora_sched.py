@@ -0,0 +1,197 @@
+"""Scheduling of the downlink frames: priority classes in the TX buffer of
+each child and deficit round robin (DRR) of the time on air between the
+childs.
+
+The root can only send to a child right after a frame of this child (the
+child listens only then), so the round robin does not visit the childs:
+each QUERY is the visit of its child. At its first visit in a round, a
+child with queued frames receives a quantum of time on air. It is served
+while its deficit covers the time on air of its next frame. When all the
+childs with queued frames have used their quantum (or after round_timeout
+seconds, the childs poll every 30 s), a new round begins. A child alone
+to have frames is served at once: the scheduler is work conserving.
+
+The CONTROL frames and the fragments that follow the first one of their
+packet are not limited by the round robin: they are charged to the
+deficit of their child (that can become negative) but never wait, so that
+a packet is not split between two rounds.
+"""
+import collections
+import time
+from enum import IntEnum, unique
+from queue import Queue
+from typing import Callable, Hashable, Iterator, List
+
+ROUND_TIMEOUT = 30  # s, the QUERY period of the childs
+
+
+@unique
+class Priority(IntEnum):
+    """The priority classes of the downlink frames (the lowest value first)."""
+
+    CONTROL = 0  # time synchronisation, configuration...
+    NORMAL = 1
+    BULK = 2
+
+
+class TxBuffer(Queue):
+    """The TX buffer of a child: a FIFO per priority class.
+
+    The frames (with a priority attribute) are taken from the highest
+    class first. As for queue.Queue, the methods without lock must be
+    called with the mutex held.
+    """
+
+    def _init(self, maxsize: int):
+        self.queues = [collections.deque() for _ in Priority]
+
+    def _qsize(self) -> int:
+        return sum(len(q) for q in self.queues)
+
+    def __len__(self) -> int:
+        """The number of frames, without lock (qsize() takes the mutex)."""
+        return self._qsize()
+
+    def _put(self, frame):
+        self.queues[frame.priority].append(frame)
+
+    def _get(self):
+        for q in self.queues:
+            if q:
+                return q.popleft()
+
+    def frames(self) -> Iterator:
+        """Iterate over the frames in the order in which they are sent."""
+        for q in self.queues:
+            yield from q
+
+    def extend(self, frames: list):
+        """Add frames without checking the size (c.f. LoraMac._make_room)."""
+        for frame in frames:
+            self._put(frame)
+        self.unfinished_tasks += len(frames)
+        self.not_empty.notify(len(frames))
+
+    def remove(self, frame) -> bool:
+        """Remove a frame (the frame itself, not an equal one).
+
+        Returns:
+            bool: False if the frame is not in the buffer.
+        """
+        q = self.queues[frame.priority]
+        for i, queued in enumerate(q):
+            if queued is frame:
+                del q[i]
+                self.unfinished_tasks -= 1
+                self.not_full.notify()
+                return True
+        return False
+
+    def drop_oldest(self, count: int, priority: int) -> List:
+        """Remove the oldest frames of the classes up to priority, the lowest class first.
+
+        Returns:
+            list: The frames removed, none if there are less than count.
+        """
+        candidates = [frame for q in reversed(self.queues[priority:]) for frame in q][:count]
+        if len(candidates) < count:
+            return []
+        for frame in candidates:
+            self.queues[frame.priority].popleft()
+        self.unfinished_tasks -= count
+        self.not_full.notify(count)
+        return candidates
+
+
+class Flow:
+    """The state of a child in the round robin.
+
+    Attributes:
+        deficit: The time on air (in seconds) that the child can still use.
+        round: The last round in which the child has received its quantum.
+        exhausted: The last round in which the child has used its quantum.
+    """
+
+    __slots__ = ("deficit", "round", "exhausted")
+
+    def __init__(self):
+        self.deficit = 0.0
+        self.round = -1
+        self.exhausted = -1
+
+
+class DeficitRoundRobin:
+    """Deficit round robin of the time on air between the childs.
+
+    Attributes:
+        quantum: The time on air (in seconds) given to each child per round,
+                 at least the time on air of the largest frame.
+        round: The current round.
+        deferred: The number of frames deferred to a later round.
+    """
+
+    def __init__(self, quantum: float, round_timeout: float = ROUND_TIMEOUT,
+                 clock: Callable[[], float] = time.monotonic):
+        self.quantum = quantum
+        self.round_timeout = round_timeout
+        self.clock = clock
+        self.round = 0
+        self.deferred = 0
+        self._round_start = clock()
+        self._flows = {}  # key -> Flow, the childs with queued frames
+
+    def __len__(self) -> int:
+        return len(self._flows)
+
+    def visit(self, key: Hashable, airtime: float) -> bool:
+        """Ask to send a frame to a child that polls.
+
+        Returns:
+            bool: True if the frame can be sent now (its time on air is
+                  then charged), False if it waits for the next round.
+        """
+        flow = self._flows.get(key, None)
+        if flow is None:
+            flow = self._flows[key] = Flow()
+        while True:
+            if flow.round < self.round:
+                flow.round = self.round
+                flow.deficit += self.quantum
+            if flow.deficit >= airtime:
+                flow.deficit -= airtime
+                return True
+            flow.exhausted = self.round
+            if not self._advance():
+                self.deferred += 1
+                return False
+
+    def would_allow(self, key: Hashable, airtime: float) -> bool:
+        """Return True if the next visit of a child could send a frame (without charging it)."""
+        flow = self._flows.get(key, None)
+        if flow is None:
+            return True
+        deficit = flow.deficit + (self.quantum if flow.round < self.round else 0)
+        return deficit >= airtime or self._all_exhausted(flow)
+
+    def charge(self, key: Hashable, airtime: float):
+        """Charge a frame sent without visit (CONTROL frame, retransmission)."""
+        flow = self._flows.get(key, None)
+        if flow is None:
+            flow = self._flows[key] = Flow()
+        flow.deficit -= airtime
+
+    def idle(self, key: Hashable):
+        """Remove a child whose TX buffer is empty: its deficit is reset."""
+        self._flows.pop(key, None)
+
+    def _all_exhausted(self, ignored: Flow = None) -> bool:
+        return all(flow.exhausted == self.round for flow in self._flows.values() if flow is not ignored)
+
+    def _advance(self) -> bool:
+        """Begin a new round if all the childs have used their quantum or if the round is over."""
+        now = self.clock()
+        if not self._all_exhausted() and now - self._round_start < self.round_timeout:
+            return False
+        self.round += 1
+        self._round_start = now
+        return True
@@ -0,0 +1,814 @@
+"""Discrete-event simulator of a LoRaMAC network.
+
+The real LoraPhy, LoraMac and LoraIP classes of the root run on a
+simulated clock and a simulated RN2483 (SimPhy). The children are models
+of the C implementation of the RPL roots (rpl_root/loramacv2/loramac.c):
+join with retransmissions and backoff, QUERY polling, confirmed DATA
+with retransmissions and the has_next flag. With iphc=True,
+aggregate=True or window=True, the children also negotiate the header
+compression (c.f. lora_iphc), the AGGREGATE frames or the sliding window
+for the downlink frames (c.f. lora_arq) at join.
+
+All the radios share one channel: two overlapping transmissions are both
+lost, a radio only receives a frame if it listens when the frame begins
+and, as the RN2483 with `radio rx`, a radio stops listening after the
+first received frame.
+
+Usage:
+    python -m pyloramac.lora_sim [--children N] [--hours H] [--seed S] ...
+"""
+import argparse
+import heapq
+import itertools
+import math
+import queue
+import random
+import struct
+import time
+from dataclasses import dataclass, field
+from enum import Enum, auto
+from typing import Callable, Optional
+
+from pyloramac.lora_airtime import DEFAULT_TURNAROUND
+from pyloramac import lora_iphc
+from pyloramac.lora_frag import LoraFrag
+from pyloramac.lora_ip import LoraIP, IPV6_HEADER_SIZE
+from pyloramac.lora_mac import LoraMac, MAX_PREFIX, MIN_PREFIX, ROOT_PREFIX, ROOT_ID, CAP_IPHC, CAP_AGGREGATE, CAP_WINDOW, deaggregate
+from pyloramac.lora_arq import ReceiveWindow
+from pyloramac.lora_airtime import MAX_FRAME_SIZE
+from pyloramac.lora_phy import LoraPhy, LoraAddr, LoraFrame, MacCommand, UartFrame, UartCommand, UartResponse
+
+# configuration of the C implementation (loramac.h)
+QUERY_TIMEOUT = 30  # LORAMAC_QUERY_TIMEOUT (s)
+RETRANSMIT_TIMEOUT = 12  # LORAMAC_RETRANSMIT_TIMEOUT (s)
+MAX_RETRANSMIT = 3  # LORAMAC_MAX_RETRANSMIT
+JOIN_SLEEP_TIME = 60  # LORAMAC_JOIN_SLEEP_TIME (s)
+MAX_JOIN_SLEEP_TIME = 180  # LORAMAC_MAX_JOIN_SLEEP_TIME (s)
+
+UART_DELAY = 0.005  # time (in seconds) of an UART command and its response at 57600 bauds
+CHILD_TX_DELAY = 2 * UART_DELAY  # time for a child to start a transmission
+BURST_MARGIN = 1.0  # time (in seconds) added to the time on air to wait for the next frame of a burst
+JOIN_SPREAD = 60  # the children boot in the first JOIN_SPREAD seconds (s)
+UPLINK_INTERVAL = 300  # mean time between two uplink packets of a child (s)
+DOWNLINK_INTERVAL = 600  # mean time between two downlink packets for a child (s)
+APP_PAYLOAD = struct.Struct(">HI")  # node id, packet number
+UDP_PORT = 5678
+HOUR = 3600
+
+
+class Simulator:
+    """The event queue and the simulated clock."""
+
+    def __init__(self):
+        self.now = 0.0
+        self._events = []  # heap of [time, id, callback]
+        self._ids = itertools.count()
+
+    def clock(self) -> float:
+        return self.now
+
+    def schedule(self, delay: float, callback: Callable[[], None]) -> list:
+        """Call the callback after delay (in seconds) of simulated time.
+
+        Returns:
+            list: The event, that can be given to cancel().
+        """
+        event = [self.now + delay, next(self._ids), callback]
+        heapq.heappush(self._events, event)
+        return event
+
+    @staticmethod
+    def cancel(event: Optional[list]):
+        if event is not None:
+            event[2] = None  # lazy deletion
+
+    def run(self, until: float):
+        """Process the events until the simulated time `until`."""
+        events = self._events
+        while events and events[0][0] <= until:
+            when, _, callback = heapq.heappop(events)
+            if callback is not None:
+                self.now = when
+                callback()
+        self.now = until
+
+
+class CpuMeter:
+    """Accumulates the CPU time spent in the code of the root."""
+
+    def __init__(self):
+        self.total = 0.0
+        self._depth = 0
+        self._start = 0.0
+
+    def __enter__(self):
+        if self._depth == 0:
+            self._start = time.process_time()
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0:
+            self.total += time.process_time() - self._start
+
+
+@dataclass
+class Transmission:
+    sender: "SimRadio"
+    data: bytes
+    start: float
+    end: float
+    collided: bool = False
+
+
+class Channel:
+    """The shared radio channel.
+
+    Attributes:
+        loss: The probability that a frame is not received (noise, fading).
+        stats: Counters of the transmissions.
+    """
+
+    def __init__(self, sim: Simulator, rng: random.Random, loss: float = 0.0):
+        self.sim = sim
+        self.rng = rng
+        self.loss = loss
+        self.radios = []
+        self.stats = {"transmissions": 0, "collisions": 0, "losses": 0, "wdt_aborts": 0}
+        self._ongoing = []
+
+    def transmit(self, sender: "SimRadio", data: bytes, airtime: float):
+        now = self.sim.now
+        tx = Transmission(sender, data, now, now + airtime)
+        for other in self._ongoing:
+            other.collided = True
+            tx.collided = True
+        self._ongoing.append(tx)
+        self.stats["transmissions"] += 1
+        for radio in self.radios:
+            if radio is not sender:
+                radio.on_begin(tx)
+        self.sim.schedule(airtime, lambda: self._end(tx))
+
+    def _end(self, tx: Transmission):
+        self._ongoing.remove(tx)
+        if tx.collided:
+            self.stats["collisions"] += 1
+        for radio in self.radios:
+            if radio.receiving is tx:
+                if tx.collided:
+                    radio.on_lost(tx)
+                elif self.rng.random() < self.loss:
+                    self.stats["losses"] += 1
+                    radio.on_lost(tx)
+                else:
+                    radio.on_end(tx)
+        tx.sender.on_sent(tx)
+
+
+class SimRadio:
+    """A half duplex radio on the shared channel.
+
+    As on the RN2483, the watchdog timer ends the listening even if a frame
+    is being received: the frame is lost.
+
+    Attributes:
+        on_receive: Called with the data of each received frame.
+        on_timeout: Called when the watchdog timer expires.
+        on_sent: Called at the end of each transmission.
+    """
+
+    def __init__(self, sim: Simulator, channel: Channel):
+        self.sim = sim
+        self.channel = channel
+        self.on_receive = None
+        self.on_timeout = None
+        self.on_sent_callback = None
+        self.listening = False
+        self.transmitting = False
+        self.receiving = None  # the transmission being received
+        self._wdt = None
+        channel.radios.append(self)
+
+    def listen(self, wdt: Optional[float] = None):
+        """Listen until a frame is received or the watchdog timer expires."""
+        self.listening = True
+        self.receiving = None
+        self.sim.cancel(self._wdt)
+        self._wdt = None if not wdt else self.sim.schedule(wdt, self._on_wdt)
+
+    def stop(self):
+        self.listening = False
+        self.receiving = None
+        self.sim.cancel(self._wdt)
+        self._wdt = None
+
+    def transmit(self, data: bytes, airtime: float):
+        self.stop()
+        self.transmitting = True
+        self.channel.transmit(self, data, airtime)
+
+    def _on_wdt(self):
+        self._wdt = None
+        if self.receiving is not None:
+            # the reception is cut off
+            self.channel.stats["wdt_aborts"] += 1
+            self.receiving = None
+        self.listening = False
+        if self.on_timeout is not None:
+            self.on_timeout()
+
+    def on_begin(self, tx: Transmission):
+        if self.listening and self.receiving is None:
+            self.receiving = tx
+
+    def on_lost(self, tx: Transmission):
+        self.receiving = None
+
+    def on_end(self, tx: Transmission):
+        self.stop()
+        if self.on_receive is not None:
+            self.on_receive(tx.data)
+
+    def on_sent(self, tx: Transmission):
+        self.transmitting = False
+        if self.on_sent_callback is not None:
+            self.on_sent_callback()
+
+
+class SimPhy(LoraPhy):
+    """The PHY layer of the root with a simulated RN2483.
+
+    The UART commands go through the command engine of LoraPhy and are
+    executed by a simulated radio after UART_DELAY.
+    """
+
+    def __init__(self, sim: Simulator, channel: Channel, cpu: CpuMeter, **params):
+        super().__init__(listen_on_error=True, clock=sim.clock, **params)
+        self.sim = sim
+        self.cpu = cpu
+        self.radio = SimRadio(sim, channel)
+        self.radio.on_receive = lambda data: self._respond(UartResponse.RADIO_RX, data.hex().upper().encode())
+        self.radio.on_timeout = lambda: self._respond(UartResponse.RADIO_ERR)
+        self.radio.on_sent_callback = lambda: self._respond(UartResponse.RADIO_TX_OK)
+        self._timer = None
+        self._writing = False
+
+    def init(self):
+        """Configure the simulated radio as after a reset (no serial connection)."""
+        self._configure(after_reset=True)
+
+    def _send_phy(self, data: UartFrame) -> bool:
+        result = super()._send_phy(data)
+        self._pump()
+        return result
+
+    def _pump(self):
+        if self._writing:
+            return
+        wait = self._engine.expire()
+        data = self._engine.pop()
+        if data is None:
+            self.sim.cancel(self._timer)
+            self._timer = None if wait is None else self.sim.schedule(wait, self._on_timer)
+            return
+        delay = UART_DELAY
+        if data.cmd == UartCommand.TX:
+            delay += self.scheduler.delay()
+        self._writing = True
+        self.sim.schedule(delay, lambda: self._execute(data))
+
+    def _on_timer(self):
+        self._timer = None
+        with self.cpu:
+            self._pump()
+
+    def _execute(self, data: UartFrame):
+        """Execute an UART command on the simulated radio."""
+        self._writing = False
+        with self.cpu:
+            self._engine.started(data)
+        if data.cmd == UartCommand.TX:
+            self.radio.transmit(bytes.fromhex(data.data), data.airtime)
+        elif data.cmd == UartCommand.RX:
+            self.radio.listen(self._wdt / 1000 if self._wdt else None)
+        elif data.cmd == UartCommand.RXSTOP:
+            self.radio.stop()
+            self.sim.schedule(UART_DELAY, lambda: self._respond(UartResponse.OK))
+        elif data.cmd == UartCommand.MAC_PAUSE:
+            self.sim.schedule(UART_DELAY, lambda: self._respond(UartResponse.U_INT))
+        elif data.cmd == UartCommand.RESET:
+            self.sim.schedule(UART_DELAY, lambda: self._respond(UartResponse.NONE))
+        else:
+            self.sim.schedule(UART_DELAY, lambda: self._respond(UartResponse.OK))
+        with self.cpu:
+            self._pump()
+
+    def _respond(self, response: UartResponse, data: bytes = b""):
+        with self.cpu:
+            if self._on_uart_response(response, memoryview(data)):
+                self._pump()
+
+
+class ChildState(Enum):
+    ALONE = auto()
+    READY = auto()
+    WAIT_RESPONSE = auto()
+
+
+class SimChild:
+    """Model of the LoRaMAC layer of a RPL root (loramac.c).
+
+    Attributes:
+        node_id: The node id of the child.
+        addr: The LoRaMAC address of the child.
+        joined_at: The simulated time of the join, None if not joined.
+        capabilities: The capabilities negotiated at join.
+    """
+
+    def __init__(self, net: "NetworkSimulation", node_id: int):
+        self.net = net
+        self.sim = net.sim
+        self.node_id = node_id
+        self.addr = LoraAddr(node_id & 0xFF, node_id)  # initial address
+        self.radio = SimRadio(net.sim, net.channel)
+        self.radio.on_receive = self._on_receive
+        self.radio.on_sent_callback = self._on_sent
+        self.state = ChildState.ALONE
+        self.joined_at = None
+        self.capabilities = 0
+        self.rx_window = None  # ReceiveWindow if CAP_WINDOW is negotiated
+        self._burst_timer = None
+        self.next_seq = 0
+        self.expected_seq = 0
+        self.retransmit_attempt = 0
+        self.pending_query = False
+        self.last_sent = None  # last sent LoraFrame
+        self.packet_number = 0
+        self._retransmit_timer = None
+        self._query_timer = None
+
+    def start(self, delay: float):
+        join_payload = bytes((self.net.capabilities,)) if self.net.capabilities else b""
+        self.sim.schedule(delay, lambda: self._send(MacCommand.JOIN, join_payload))
+        self.sim.schedule(delay + self.net.rng.expovariate(1 / self.net.uplink_interval), self._on_uplink)
+
+    # frames
+
+    def _send(self, command: MacCommand, payload: bytes, retransmission: bool = False):
+        """Prepare and send a frame (send_frame + prepare_last_sent_frame)."""
+        if not retransmission:
+            k = command == MacCommand.DATA  # LORA_MAC_CONFIRMED
+            self.last_sent = LoraFrame(self.addr, LoraAddr(ROOT_PREFIX, ROOT_ID), command, payload,
+                                       self.next_seq, k)
+            self.next_seq = (self.next_seq + 1) % 256
+        if self.rx_window is not None:
+            self.last_sent.ack = self.rx_window.ack()
+        if self.last_sent.command != MacCommand.JOIN:
+            self.state = ChildState.WAIT_RESPONSE
+        data = self.last_sent.pack()
+        # the MCU reads the radio_rx report of the previous frame and writes the radio tx command
+        self.sim.schedule(CHILD_TX_DELAY, lambda: self.radio.transmit(data, self.net.airtime(len(data))))
+
+    def _on_sent(self):
+        frame = self.last_sent
+        if frame.k or frame.command in (MacCommand.QUERY, MacCommand.JOIN):
+            # radio set wdt, then radio rx
+            self._set_retransmit_timer(RETRANSMIT_TIMEOUT)
+            self.sim.schedule(DEFAULT_TURNAROUND, lambda: self.radio.listen(RETRANSMIT_TIMEOUT))
+        else:
+            self._set_state(ChildState.READY)
+
+    def _send_query(self):
+        self._send(MacCommand.QUERY, b"")
+
+    def _set_state(self, state: ChildState):
+        if self.state == ChildState.WAIT_RESPONSE and state == ChildState.READY and self.pending_query:
+            self.pending_query = False
+            self._send_query()
+        else:
+            self.state = state
+
+    # timers
+
+    def _set_retransmit_timer(self, delay: float):
+        self.sim.cancel(self._retransmit_timer)
+        self._retransmit_timer = self.sim.schedule(delay, self._on_retransmit_timeout)
+
+    def _stop_retransmit_timer(self):
+        self.sim.cancel(self._retransmit_timer)
+        self._retransmit_timer = None
+
+    def _restart_query_timer(self):
+        self.sim.cancel(self._query_timer)
+        self._query_timer = self.sim.schedule(QUERY_TIMEOUT, self._on_query_timeout)
+
+    def _on_query_timeout(self):
+        self._query_timer = None
+        if self.state == ChildState.READY:
+            self._send_query()
+        else:
+            self.pending_query = True
+
+    def _on_retransmit_timeout(self):
+        self._retransmit_timer = None
+        self.radio.stop()
+        if self.retransmit_attempt < MAX_RETRANSMIT:
+            self.retransmit_attempt += 1
+            self.net.stats["child_retransmissions"] += 1
+            self._send(self.last_sent.command, self.last_sent.payload, retransmission=True)
+            return
+        self.retransmit_attempt = 0
+        if self.last_sent.command == MacCommand.JOIN:
+            interval = (JOIN_SLEEP_TIME + self.net.rng.uniform(0, MAX_JOIN_SLEEP_TIME)) % MAX_JOIN_SLEEP_TIME
+            self._set_retransmit_timer(interval)
+            return
+        if self.last_sent.command == MacCommand.DATA:
+            self.net.stats["uplink_failed"] += 1
+        if self.last_sent.command == MacCommand.QUERY:
+            self._restart_query_timer()
+        self._set_state(ChildState.READY)
+
+    # reception
+
+    def _on_receive(self, data: bytes):
+        frame = LoraFrame.unpack(data)
+        if frame is None or frame.dest_addr.prefix != self.addr.prefix:
+            return  # not for this DAG, the radio does not listen anymore
+        if frame.command == MacCommand.JOIN_RESPONSE and self.state == ChildState.ALONE:
+            self._on_join_response(frame)
+        elif frame.command in (MacCommand.DATA, MacCommand.AGGREGATE) and self.state != ChildState.ALONE:
+            self._on_data(frame)
+        elif frame.command == MacCommand.ACK and self.state != ChildState.ALONE:
+            self._on_ack(frame)
+
+    def _on_join_response(self, frame: LoraFrame):
+        # a child that gives its capabilities also accepts them in the response
+        if frame.dest_addr != self.addr or frame.seq != 0:
+            return
+        if not self.net.capabilities and len(frame.payload) != 1:
+            return
+        if self.net.capabilities:
+            if len(frame.payload) < 2:
+                return
+            self.capabilities = frame.payload[1]
+            if self.capabilities & CAP_WINDOW:
+                if len(frame.payload) != 3:
+                    return
+                self.rx_window = ReceiveWindow(frame.payload[2])
+        self._stop_retransmit_timer()
+        self.retransmit_attempt = 0
+        self.addr = LoraAddr(frame.payload[0], self.node_id)
+        self._restart_query_timer()
+        self.expected_seq += 1
+        self.joined_at = self.sim.now
+        self._set_state(ChildState.READY)
+        self.net.on_joined(self)
+
+    def _on_data(self, frame: LoraFrame):
+        if self.rx_window is not None:
+            self._on_window_data(frame)
+            return
+        if frame.seq < self.expected_seq:
+            return
+        self._stop_retransmit_timer()
+        self.sim.cancel(self._query_timer)
+        self._query_timer = None
+        self.retransmit_attempt = 0
+        self.expected_seq = (frame.seq + 1) % 256
+        self._deliver(frame)
+        if frame.has_next:
+            self._send_query()
+        else:
+            self._restart_query_timer()
+            self._set_state(ChildState.READY)
+
+    def _on_window_data(self, frame: LoraFrame):
+        """Receive a frame of a burst: listen for the next one, or acknowledge the burst."""
+        self._stop_retransmit_timer()
+        self.sim.cancel(self._query_timer)
+        self._query_timer = None
+        self.sim.cancel(self._burst_timer)
+        self._burst_timer = None
+        self.retransmit_attempt = 0
+        if self.rx_window.accept(frame.seq):
+            self._deliver(frame)
+        if frame.burst:
+            timeout = self.net.airtime(MAX_FRAME_SIZE) + BURST_MARGIN
+            self.radio.listen(timeout)
+            self._burst_timer = self.sim.schedule(timeout, lambda: self._end_burst(True))
+        else:
+            self._end_burst(frame.has_next)
+
+    def _end_burst(self, has_next: bool):
+        self._burst_timer = None
+        if has_next or not self.rx_window.complete:
+            self._send_query()  # acknowledges the burst
+        else:
+            self._restart_query_timer()
+            self._set_state(ChildState.READY)
+
+    def _deliver(self, frame: LoraFrame):
+        if frame.command == MacCommand.AGGREGATE:
+            for payload in deaggregate(frame.payload):
+                self.net.on_downlink(self, payload)
+        else:
+            self.net.on_downlink(self, frame.payload)
+
+    def _on_ack(self, frame: LoraFrame):
+        if frame.dest_addr != self.addr or frame.seq != self.last_sent.seq:
+            return
+        self._stop_retransmit_timer()
+        self.retransmit_attempt = 0
+        if self.last_sent.command == MacCommand.QUERY:
+            self._restart_query_timer()
+        self._set_state(ChildState.READY)
+
+    # application
+
+    def _on_uplink(self):
+        self.sim.schedule(self.net.rng.expovariate(1 / self.net.uplink_interval), self._on_uplink)
+        self.net.stats["uplink_generated"] += 1
+        hour = self.net._hour()
+        hour.uplink_generated += 1
+        if self.state != ChildState.READY:
+            self.net.stats["uplink_rejected"] += 1  # loramac_send() returns -1
+            return
+        number = self.packet_number
+        self.packet_number += 1
+        self.net.uplink_sent[(self.node_id, number)] = self.sim.now
+        hour.uplink_sent += 1
+        packet = elided_packet(APP_PAYLOAD.pack(self.node_id, number))
+        if self.capabilities & CAP_IPHC:
+            packet = lora_iphc.compress(packet)
+        self._send(MacCommand.DATA, packet)
+
+
+def elided_packet(payload: bytes) -> bytes:
+    """Build an UDP/IPv6 packet without its addresses (as sent by the children)."""
+    length = 8 + len(payload)
+    header = struct.pack(">IHBB", 6 << 28, length, 17, 64)
+    udp = struct.pack(">HHHH", UDP_PORT, UDP_PORT, length, 0)
+    return header + udp + payload
+
+
+def parse_app_payload(packet: bytes, offset: int) -> tuple:
+    """Return the (node id, packet number) carried by a packet."""
+    return APP_PAYLOAD.unpack_from(packet, offset + 8)
+
+
+def percentiles(values: list) -> dict:
+    """Return the p50, p90, p99 and max of a list of values."""
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, math.ceil(q * len(values)) - 1)]
+    return {"count": len(values), "p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "max": values[-1]}
+
+
+@dataclass
+class HourReport:
+    """The results for one simulated hour.
+
+    The uplink packets generated while the child is not ready (not joined or
+    waiting for a response) are rejected by the MAC layer, as by loramac_send().
+    The PDR is computed for the packets accepted by the MAC layers.
+    """
+
+    hour: int
+    uplink_generated: int = 0
+    uplink_sent: int = 0
+    uplink_delivered: int = 0
+    downlink_offered: int = 0
+    downlink_delivered: int = 0
+    root_cpu: float = 0.0  # seconds of CPU
+
+    @property
+    def uplink_pdr(self) -> float:
+        return self.uplink_delivered / self.uplink_sent if self.uplink_sent else 0.0
+
+    @property
+    def downlink_pdr(self) -> float:
+        return self.downlink_delivered / self.downlink_offered if self.downlink_offered else 0.0
+
+
+@dataclass
+class SimReport:
+    """The results of a simulation.
+
+    Attributes:
+        children: The number of simulated children.
+        joined: The number of children that joined.
+        hours: The per-hour results.
+        uplink_latency: The percentiles of the uplink latency (s).
+        downlink_latency: The percentiles of the downlink latency (s).
+        join_time: The percentiles of the join time (s).
+        stats: The counters of the simulation.
+        wall_time: The wall-clock time of the simulation (s).
+    """
+
+    children: int
+    joined: int
+    hours: list
+    uplink_latency: dict
+    downlink_latency: dict
+    join_time: dict
+    stats: dict = field(default_factory=dict)
+    wall_time: float = 0.0
+
+    def format(self) -> str:
+        lines = [f"children: {self.children}, joined: {self.joined}, wall time: {self.wall_time:.1f} s", ""]
+        lines.append("hour  up gen  up sent  up PDR  down off  down PDR  root CPU (ms)")
+        for h in self.hours:
+            lines.append(f"{h.hour:>4}  {h.uplink_generated:>6}  {h.uplink_sent:>7}  {h.uplink_pdr:6.1%}"
+                         f"  {h.downlink_offered:>8}"
+                         f"  {h.downlink_pdr:8.1%}  {h.root_cpu * 1000:13.1f}")
+        lines.append("")
+        for name, dist in (("uplink latency", self.uplink_latency), ("downlink latency", self.downlink_latency),
+                           ("join time", self.join_time)):
+            if dist["count"]:
+                lines.append(f"{name:<17} n={dist['count']:<6} p50 {dist['p50']:8.2f} s  p90 {dist['p90']:8.2f} s"
+                             f"  p99 {dist['p99']:8.2f} s  max {dist['max']:8.2f} s")
+            else:
+                lines.append(f"{name:<17} n=0")
+        lines.append("")
+        lines.extend(f"{name}: {value}" for name, value in sorted(self.stats.items()))
+        return "\n".join(lines)
+
+
+class NetworkSimulation:
+    """A root running the real LoRaMAC stack and simulated children.
+
+    Attributes:
+        sim: The simulator.
+        channel: The shared channel.
+        phy, mac, frag, ip: The layers of the root.
+        children: The simulated children.
+    """
+
+    def __init__(self, children: int = MAX_PREFIX - MIN_PREFIX + 1, seed: int = 0, loss: float = 0.0,
+                 uplink_interval: float = UPLINK_INTERVAL, downlink_interval: float = DOWNLINK_INTERVAL,
+                 join_spread: float = JOIN_SPREAD, iphc: bool = False, aggregate: bool = False,
+                 window: bool = False, **params):
+        self.rng = random.Random(seed)
+        self.sim = Simulator()
+        self.channel = Channel(self.sim, self.rng, loss)
+        self.cpu = CpuMeter()
+        self.uplink_interval = uplink_interval
+        self.downlink_interval = downlink_interval
+        self.join_spread = join_spread
+        # the capabilities asked by the children at join
+        self.capabilities = ((CAP_IPHC if iphc else 0) | (CAP_AGGREGATE if aggregate else 0)
+                             | (CAP_WINDOW if window else 0))
+
+        self.phy = SimPhy(self.sim, self.channel, self.cpu, **params)
+        self.mac = LoraMac(self.phy, threaded=False, clock=self.sim.clock)
+        self.mac.timers.on_start = lambda: self.sim.schedule(0, self._poll_timers)
+        self.frag = LoraFrag(self.mac, clock=self.sim.clock)
+        self.ip = LoraIP(self.frag)
+        self.ip.register_raw_listener(self._on_uplink)
+
+        node_ids = self.rng.sample(range(1, 0x10000), children)
+        self.children = [SimChild(self, node_id) for node_id in node_ids]
+
+        self.stats = {"uplink_generated": 0, "uplink_rejected": 0, "uplink_failed": 0, "uplink_duplicates": 0,
+                      "downlink_offered": 0, "downlink_queue_full": 0, "downlink_unreachable": 0,
+                      "child_retransmissions": 0}
+        self.uplink_sent = {}  # (node id, number) -> time
+        self.uplink_delivered = set()
+        self.uplink_latencies = []
+        self.downlink_sent = {}  # (node id, number) -> time
+        self.downlink_latencies = []
+        self._hours = {}
+        self._downlink_number = 0
+
+    def airtime(self, size: int) -> float:
+        return self.phy.scheduler.airtime(size)
+
+    def _poll_timers(self):
+        with self.cpu:
+            delay = self.mac.poll_timers()
+        if delay is not None:
+            self.sim.schedule(delay, self._poll_timers)
+
+    def _hour(self, t: float = None) -> HourReport:
+        hour = int((self.sim.now if t is None else t) // HOUR)
+        report = self._hours.get(hour, None)
+        if report is None:
+            report = self._hours[hour] = HourReport(hour)
+        return report
+
+    def run(self, hours: float = 1.0) -> SimReport:
+        """Run the simulation.
+
+        Args:
+            hours (float): The simulated duration in hours.
+
+        Returns:
+            SimReport: The results.
+        """
+        start = time.perf_counter()
+        with self.cpu:
+            self.ip.init()
+        for child in self.children:
+            child.start(self.rng.uniform(0, self.join_spread))
+
+        # sample the root CPU at each simulated hour
+        end = hours * HOUR
+        t = 0.0
+        while t < end:
+            t = min(end, t + HOUR)
+            cpu_before = self.cpu.total
+            self.sim.run(t)
+            self._hour(t - 1e-9).root_cpu += self.cpu.total - cpu_before
+
+        join_times = [c.joined_at for c in self.children if c.joined_at is not None]
+        return SimReport(
+            children=len(self.children),
+            joined=len(join_times),
+            hours=[self._hours[h] for h in sorted(self._hours)],
+            uplink_latency=percentiles(self.uplink_latencies),
+            downlink_latency=percentiles(self.downlink_latencies),
+            join_time=percentiles(join_times),
+            stats={**self.stats, **self.channel.stats,
+                   "root_not_sent": sum(c.not_send_count for c in self.mac.childs.values()),
+                   "root_retransmissions": sum(c.retransmissions for c in self.mac.childs.values()),
+                   "root_cpu_total_ms": round(self.cpu.total * 1000, 1)},
+            wall_time=time.perf_counter() - start,
+        )
+
+    def on_joined(self, child: SimChild):
+        self.sim.schedule(self.rng.expovariate(1 / self.downlink_interval), lambda: self._on_downlink(child))
+
+    def _on_downlink(self, child: SimChild):
+        """Generate a downlink packet for a child, sent by the application of the root."""
+        self.sim.schedule(self.rng.expovariate(1 / self.downlink_interval), lambda: self._on_downlink(child))
+        number = self._downlink_number
+        self._downlink_number += 1
+        payload = elided_packet(APP_PAYLOAD.pack(child.node_id, number))
+        packet = self.ip.restore_addresses(payload, self.mac.addr, child.addr)
+        self.stats["downlink_offered"] += 1
+        self._hour().downlink_offered += 1
+        with self.cpu:
+            try:
+                sent = self.ip.send_bytes(child.addr, packet, block=False)
+            except queue.Full:
+                self.stats["downlink_queue_full"] += 1
+                return
+            if not sent:
+                self.stats["downlink_unreachable"] += 1
+                return
+            self.downlink_sent[(child.node_id, number)] = self.sim.now
+
+    def on_downlink(self, child: SimChild, payload: bytes):
+        key = parse_app_payload(LoraIP.restore_addresses(payload, self.mac.addr, child.addr), IPV6_HEADER_SIZE)
+        sent_at = self.downlink_sent.pop(key, None)
+        if sent_at is None:
+            return  # duplicate
+        self.downlink_latencies.append(self.sim.now - sent_at)
+        self._hour(sent_at).downlink_delivered += 1
+
+    def _on_uplink(self, src: LoraAddr, packet: bytes):
+        key = parse_app_payload(packet, IPV6_HEADER_SIZE)
+        if key in self.uplink_delivered:
+            self.stats["uplink_duplicates"] += 1
+            return
+        sent_at = self.uplink_sent.pop(key, None)
+        if sent_at is None:
+            return
+        self.uplink_delivered.add(key)
+        self.uplink_latencies.append(self.sim.now - sent_at)
+        self._hour(sent_at).uplink_delivered += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a LoRaMAC network with the real root stack.")
+    parser.add_argument("--children", type=int, default=MAX_PREFIX - MIN_PREFIX + 1, help="number of children")
+    parser.add_argument("--hours", type=float, default=1.0, help="simulated duration")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--loss", type=float, default=0.0, help="probability of losing a frame")
+    parser.add_argument("--uplink-interval", type=float, default=UPLINK_INTERVAL,
+                        help="mean time (s) between two uplink packets of a child")
+    parser.add_argument("--downlink-interval", type=float, default=DOWNLINK_INTERVAL,
+                        help="mean time (s) between two downlink packets for a child")
+    parser.add_argument("--join-spread", type=float, default=JOIN_SPREAD,
+                        help="the children boot in the first JOIN_SPREAD seconds")
+    parser.add_argument("--sf", default="sf7", help="spreading factor")
+    parser.add_argument("--no-duty-cycle", action="store_true", help="disable the duty-cycle limit of the root")
+    parser.add_argument("--iphc", action="store_true", help="the children negotiate the header compression")
+    parser.add_argument("--aggregate", action="store_true", help="the children negotiate the AGGREGATE frames")
+    parser.add_argument("--window", action="store_true", help="the children negotiate the sliding window")
+    args = parser.parse_args()
+
+    net = NetworkSimulation(
+        children=args.children, seed=args.seed, loss=args.loss, uplink_interval=args.uplink_interval,
+        downlink_interval=args.downlink_interval, join_spread=args.join_spread, sf=args.sf,
+        duty_cycle=not args.no_duty_cycle, iphc=args.iphc, aggregate=args.aggregate,
+        window=args.window,
+    )
+    print(net.run(args.hours).format())
+
+
+if __name__ == "__main__":
+    main()
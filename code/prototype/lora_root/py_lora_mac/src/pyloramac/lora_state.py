@@ -0,0 +1,183 @@
+"""Persistent state of LoraMac: the child table, saved so that a restarted
+root goes on with the childs instead of waiting for all of them to join again.
+
+The state is an append log of JSON lines, one record per change of a child:
+
+    {"prefix": 2, "child": {"node_id": 25248, "capabilities": 0, "window": 0, "joined": true}}
+    {"prefix": 2, "sn": [5, 3]}      expected SN and next SN
+    {"prefix": 2, "tx": ["0a1b", [2, "0c"]]}   payloads (hex) in the TX buffer,
+                                              with their priority if not NORMAL
+    {"prefix": 2, "removed": true}
+
+Replaying the log gives the last record of each kind for each child. When
+the log holds compact_ratio times more records than the live state, it is
+rewritten with only the live records (in a temporary file, then renamed:
+a crash never leaves a half written log). A truncated last line (crash
+during a write) is ignored.
+
+The log is flushed after each record and synced to the disk at most every
+SYNC_INTERVAL seconds: the owner calls sync() SYNC_INTERVAL seconds after a
+record that was not synced (c.f. dirty). After a power loss the SNs can be
+late by the frames of the last second (c.f. LoraMac._restore).
+"""
+import json
+import os
+import threading
+import time
+from typing import Callable
+
+from loguru import logger as log
+
+COMPACT_RATIO = 4  # records in the log / live records
+MIN_COMPACT_RECORDS = 1024  # no compaction below this number of records
+SYNC_INTERVAL = 1.0  # s
+
+KINDS = ("child", "sn", "tx")
+
+
+class MacStateLog:
+    """Append log of the child table of LoraMac.
+
+    Attributes:
+        path: The path of the log.
+        records: The number of records in the log.
+        dirty: True if records are not synced to the disk yet.
+    """
+
+    def __init__(self, path: str, compact_ratio: int = COMPACT_RATIO, min_compact_records: int = MIN_COMPACT_RECORDS,
+                 clock: Callable[[], float] = time.monotonic):
+        self.path = path
+        self.compact_ratio = compact_ratio
+        self.min_compact_records = min_compact_records
+        self.clock = clock
+        self.records = 0
+        self.dirty = False
+        self._lock = threading.Lock()
+        self._last = {}  # prefix -> {kind: value}, the live state
+        self._live = 0  # number of values in _last, i.e. of live records
+        self._file = None
+        self._synced_at = 0.0
+
+    def load(self) -> dict:
+        """Read the log and open it for the next records.
+
+        Returns:
+            dict: prefix -> {kind: value} for each live child.
+        """
+        with self._lock:
+            self._last = {}
+            self.records = 0
+            try:
+                with open(self.path) as f:
+                    for line in f:
+                        self._replay(line)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                log.warning(f"MAC state not restored: {e}")
+            self._live = sum(len(values) for values in self._last.values())
+            # start from a compact log
+            self._compact()
+            return {prefix: dict(values) for prefix, values in self._last.items()}
+
+    def _replay(self, line: str):
+        try:
+            record = json.loads(line)
+            prefix = int(record.pop("prefix"))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            log.warning("Invalid record in the MAC state ignored")
+            return
+        self.records += 1
+        if record.get("removed", False):
+            self._last.pop(prefix, None)
+            return
+        values = self._last.setdefault(prefix, {})
+        for kind in KINDS:
+            if kind in record:
+                values[kind] = record[kind]
+
+    def save(self, prefix: int, kind: str, value):
+        """Record a value of a child, if it has changed.
+
+        Args:
+            prefix (int): The prefix of the child.
+            kind (str): One of KINDS.
+            value: A JSON serializable value.
+        """
+        with self._lock:
+            values = self._last.setdefault(prefix, {})
+            if values.get(kind, None) == value:
+                return
+            if kind not in values:
+                self._live += 1
+            values[kind] = value
+            self._write({"prefix": prefix, kind: value})
+
+    def remove(self, prefix: int):
+        """Record the removal of a child."""
+        with self._lock:
+            values = self._last.pop(prefix, None)
+            if values is None:
+                return
+            self._live -= len(values)
+            self._write({"prefix": prefix, "removed": True})
+
+    def sync(self):
+        """Sync the records to the disk, if needed."""
+        with self._lock:
+            if self._file is not None and self.dirty:
+                try:
+                    self._sync()
+                except OSError as e:
+                    log.warning(f"MAC state not synced: {e}")
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+                self._file = None
+
+    def _write(self, record: dict):
+        if self._file is None:
+            return
+        try:
+            self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+            self._file.flush()
+            self.dirty = True
+            if self.clock() - self._synced_at >= SYNC_INTERVAL:
+                self._sync()
+        except OSError as e:
+            log.warning(f"MAC state not saved: {e}")
+            return
+        self.records += 1
+        if self.records >= max(self.min_compact_records, self.compact_ratio * self._live):
+            self._compact()
+
+    def _sync(self):
+        os.fsync(self._file.fileno())
+        self.dirty = False
+        self._synced_at = self.clock()
+
+    def _compact(self):
+        """Rewrite the log with the live records only."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        lines = [json.dumps({"prefix": prefix, kind: value}, separators=(",", ":")) + "\n"
+                 for prefix, values in sorted(self._last.items()) for kind, value in values.items()]
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)  # atomic: never a half written log
+            self._file = open(self.path, "a")
+        except OSError as e:
+            log.warning(f"MAC state not saved: {e}")
+            return
+        self.dirty = False
+        self._synced_at = self.clock()
+        self.records = len(lines)
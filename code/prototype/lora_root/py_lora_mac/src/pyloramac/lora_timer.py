@@ -0,0 +1,149 @@
+"""Timers of the MAC layer: a hashed timer wheel and the RTT estimation of
+the childs (c.f. RFC 6298) used for the retransmission timeouts.
+"""
+import time
+from typing import Callable, Optional
+
+TICK = 0.25  # resolution of the timer wheel (s)
+SLOTS = 64  # number of slots of the timer wheel (one turn is 16 s)
+
+# retransmission timeout (s)
+INITIAL_RTO = 3.0
+MIN_RTO = 1.0
+MAX_RTO = 10.0  # a child stops listening after LORAMAC_RETRANSMIT_TIMEOUT (12 s)
+RTT_ALPHA = 1 / 8
+RTT_BETA = 1 / 4
+RTT_K = 4
+
+
+class Timer:
+    """A timer of a TimerWheel.
+
+    Attributes:
+        deadline: The tick at which the timer expires.
+        callback: The function called when the timer expires, None if cancelled.
+    """
+
+    __slots__ = ("deadline", "callback")
+
+    def __init__(self, deadline: int, callback: Callable[[], None]):
+        self.deadline = deadline
+        self.callback = callback
+
+    def cancel(self):
+        self.callback = None  # lazy deletion
+
+    @property
+    def active(self) -> bool:
+        return self.callback is not None
+
+
+class TimerWheel:
+    """A hashed timer wheel.
+
+    The timers are stored in the slot of their deadline tick (modulo the
+    number of slots): scheduling and cancelling are O(1) and advance()
+    only looks at the slots of the elapsed ticks.
+
+    The wheel does not run by itself: advance() must be called at least
+    every tick while timers are pending. on_start is called when a timer
+    is scheduled in an empty wheel, so that the owner starts calling it.
+
+    Attributes:
+        tick: The resolution of the timers in seconds.
+        on_start: Called when a timer is scheduled in an empty wheel.
+    """
+
+    def __init__(self, tick: float = TICK, slots: int = SLOTS, clock: Callable[[], float] = time.monotonic):
+        self.tick = tick
+        self.clock = clock
+        self.on_start = None
+        self._slots = [[] for _ in range(slots)]
+        self._current = self._tick_of(clock())  # the last tick processed
+        self._count = 0  # timers in the wheel, cancelled ones included
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _tick_of(self, t: float) -> int:
+        return int(t // self.tick)
+
+    def schedule(self, delay: float, callback: Callable[[], None]) -> Timer:
+        """Call the callback after delay seconds (rounded up to the next tick).
+
+        Returns:
+            Timer: The timer, to cancel it.
+        """
+        deadline = max(self._tick_of(self.clock() + delay) + 1, self._current + 1)
+        timer = Timer(deadline, callback)
+        self._slots[deadline % len(self._slots)].append(timer)
+        self._count += 1
+        if self._count == 1 and self.on_start is not None:
+            self.on_start()
+        return timer
+
+    def advance(self) -> Optional[float]:
+        """Call the callbacks of the expired timers.
+
+        Returns:
+            Optional[float]: The delay (in seconds) before the next call,
+                             None if the wheel is empty.
+        """
+        now = self._tick_of(self.clock())
+        # no need to turn more than once: the later timers stay in their slot
+        for tick in range(self._current + 1, min(now, self._current + len(self._slots)) + 1):
+            slot = self._slots[tick % len(self._slots)]
+            if not slot:
+                continue
+            expired = [timer for timer in slot if timer.deadline <= now]
+            if not expired:
+                continue
+            slot[:] = [timer for timer in slot if timer.deadline > now]
+            self._count -= len(expired)
+            for timer in expired:
+                callback = timer.callback
+                if callback is not None:
+                    timer.callback = None
+                    callback()
+        self._current = max(self._current, now)
+        return self.tick if self._count else None
+
+
+class RttEstimator:
+    """Estimation of the round trip time with a child and of the
+    retransmission timeout (RFC 6298).
+
+    Attributes:
+        srtt: The smoothed RTT (s), None before the first sample.
+        rttvar: The RTT variation (s).
+        rto: The retransmission timeout (s).
+        samples: The number of RTT samples.
+    """
+
+    def __init__(self, initial_rto: float = INITIAL_RTO, min_rto: float = MIN_RTO, max_rto: float = MAX_RTO):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.samples = 0
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+
+    def sample(self, rtt: float):
+        """Update the estimation with a RTT measured on a frame that has
+        not been retransmitted (Karn's rule)."""
+        rtt = max(0.0, rtt)
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - RTT_BETA) * self.rttvar + RTT_BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - RTT_ALPHA) * self.srtt + RTT_ALPHA * rtt
+        self.samples += 1
+        self.rto = min(self.max_rto, max(self.min_rto, self.srtt + RTT_K * self.rttvar))
+
+    def backoff(self):
+        """Double the timeout after a retransmission."""
+        self.rto = min(self.max_rto, self.rto * 2)
+
+    def to_dict(self) -> dict:
+        return {"srtt": self.srtt, "rttvar": self.rttvar, "rto": self.rto, "samples": self.samples}